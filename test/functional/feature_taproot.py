@@ -96,6 +96,7 @@ from test_framework.script_util import (
     script_to_p2sh_script,
     script_to_p2wsh_script,
 )
+from test_framework.signing import SigningPool
 from test_framework.test_framework import BitcoinTestFramework
 from test_framework.util import assert_raises_rpc_error, assert_equal
 from test_framework import util
@@ -226,6 +227,7 @@ def default_sigmsg(ctx):
     idx = get(ctx, "idx")
     hashtype = get(ctx, "hashtype_actual")
     genesis_hash = get(ctx, "genesis_hash")
+    sighash_cache = get(ctx, "sighash_cache")
     mode = get(ctx, "mode")
     if mode == "taproot":
         # BIP341 signature hash
@@ -235,14 +237,14 @@ def default_sigmsg(ctx):
             codeseppos = get(ctx, "codeseppos")
             leaf_ver = get(ctx, "leafversion")
             script = get(ctx, "script_taproot")
-            return TaprootSignatureMsg(tx, utxos, hashtype, genesis_hash, idx, scriptpath=True, script=script, leaf_ver=leaf_ver, codeseparator_pos=codeseppos, annex=annex)
+            return TaprootSignatureMsg(tx, utxos, hashtype, genesis_hash, idx, scriptpath=True, script=script, leaf_ver=leaf_ver, codeseparator_pos=codeseppos, annex=annex, sighash_cache=sighash_cache)
         else:
-            return TaprootSignatureMsg(tx, utxos, hashtype, genesis_hash, idx, scriptpath=False, annex=annex)
+            return TaprootSignatureMsg(tx, utxos, hashtype, genesis_hash, idx, scriptpath=False, annex=annex, sighash_cache=sighash_cache)
     elif mode == "witv0":
         # BIP143 signature hash
         scriptcode = get(ctx, "scriptcode")
         utxos = get(ctx, "utxos")
-        return SegwitV0SignatureMsg(scriptcode, tx, idx, hashtype, utxos[idx].nValue, enable_sighash_rangeproof=False)
+        return SegwitV0SignatureMsg(scriptcode, tx, idx, hashtype, utxos[idx].nValue, enable_sighash_rangeproof=False, sighash_cache=sighash_cache)
     else:
         # Pre-segwit signature hash
         scriptcode = get(ctx, "scriptcode")
@@ -431,6 +433,8 @@ DEFAULT_CONTEXT = {
     "genesis_hash": None,
     # Use deterministic signing nonces
     "deterministic": False,
+    # A SighashCache of tx and utxos, to share between the inputs of tx (None to not cache)
+    "sighash_cache": None,
 
     # == Parameters to be set before evaluation: ==
     # - mode: what spending style to use ("taproot", "witv0", or "legacy").
@@ -576,12 +580,12 @@ def make_spender(comment, *, tap=None, witv0=False, script=None, pkh=None, p2sh=
 
     conf = {**conf, **kwargs}
 
-    def sat_fn(tx, idx, utxos, valid):
+    def sat_fn(tx, idx, utxos, valid, sighash_cache=None):
         if valid:
-            return spend(tx, idx, utxos, **conf)
+            return spend(tx, idx, utxos, sighash_cache=sighash_cache, **conf)
         else:
             assert failure is not None
-            return spend(tx, idx, utxos, **{**conf, **failure})
+            return spend(tx, idx, utxos, sighash_cache=sighash_cache, **{**conf, **failure})
 
     return Spender(script=spk, comment=comment, is_standard=standard, sat_function=sat_fn, err_msg=err_msg, sigops_weight=sigops_weight, no_fail=failure is None, need_vin_vout_mismatch=need_vin_vout_mismatch)
 
@@ -1284,6 +1288,9 @@ class TaprootTest(BitcoinTestFramework):
                             help="Dump generated test cases to directory set by TEST_DUMP_DIR environment variable")
         parser.add_argument("--previous_release", dest="previous_release", default=False, action="store_true",
                             help="Use a previous release as taproot-inactive node")
+        parser.add_argument("--signing-workers", dest="signing_workers", type=int, default=1,
+                            help="Number of processes signing the inputs of each test transaction (default: %(default)s, "
+                                 "signing in the test process; test_runner.py does not account for more)")
 
     def skip_test_if_missing_module(self):
         self.skip_if_no_wallet()
@@ -1442,6 +1449,17 @@ class TaprootTest(BitcoinTestFramework):
         random.shuffle(mismatching_utxos)
         assert done == len(normal_utxos) + len(mismatching_utxos)
 
+        def sign_input(tx, spent_utxos, idx, sighash_cache, spender_index):
+            """Compute a failing (if any) and a satisfying scriptSig/witness for input idx."""
+            spender = spenders[spender_index]
+            fail = None
+            success = spender.sat_function(tx, idx, spent_utxos, True, sighash_cache)
+            if not spender.no_fail:
+                fail = spender.sat_function(tx, idx, spent_utxos, False, sighash_cache)
+            return (fail, success)
+        spender_indexes = {id(spender): n for n, spender in enumerate(spenders)}
+
+        signing_pool = SigningPool(sign_input, self.options.signing_workers)
         left = done
         while left:
             # Construct CTransaction with random nVersion, nLocktime
@@ -1516,15 +1534,10 @@ class TaprootTest(BitcoinTestFramework):
             sigops_weight += 1 * WITNESS_SCALE_FACTOR
 
             # Precompute one satisfying and one failing scriptSig/witness for each input.
-            input_data = []
-            for i in range(len(input_utxos)):
-                fn = input_utxos[i].spender.sat_function
-                fail = None
-                success = fn(tx, i, [utxo.output for utxo in input_utxos], True)
-                if not input_utxos[i].spender.no_fail:
-                    fail = fn(tx, i, [utxo.output for utxo in input_utxos], False)
-                input_data.append((fail, success))
-                if self.options.dump_tests:
+            spent_utxos = [utxo.output for utxo in input_utxos]
+            input_data = signing_pool.sign(tx, spent_utxos, [(i, (spender_indexes[id(utxo.spender)],)) for i, utxo in enumerate(input_utxos)])
+            if self.options.dump_tests:
+                for i, (fail, success) in enumerate(input_data):
                     dump_json_test(tx, input_utxos, i, success, fail)
 
             # Sign each input incorrectly once on each complete signing pass, except the very last.
@@ -1557,6 +1570,7 @@ class TaprootTest(BitcoinTestFramework):
 
             if (len(spenders) - left) // 200 > (len(spenders) - left - len(input_utxos)) // 200:
                 self.log.info("  - %i tests done" % (len(spenders) - left))
+        signing_pool.close()
 
         assert left == 0
         assert len(normal_utxos) == 0
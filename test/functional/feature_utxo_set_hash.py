@@ -43,6 +43,7 @@ class UTXOSetHashTest(BitcoinTestFramework):
         # Serialize the outputs that should be in the UTXO set and add them to
         # a MuHash object
         muhash = MuHash3072()
+        utxos = []
 
         for height, block in enumerate(blocks):
             # The Genesis block coinbase is not part of the UTXO set and we
@@ -63,8 +64,9 @@ class UTXOSetHashTest(BitcoinTestFramework):
 
                     # ELEMENTS: filter out fee outputs
                     if len(tx_out.scriptPubKey) > 0:
-                        muhash.insert(data)
+                        utxos.append(data)
 
+        muhash.insert_many(utxos)
         finalized = muhash.digest()
         node_muhash = node.gettxoutsetinfo("muhash")['muhash']
 
@@ -35,6 +35,7 @@ from test_framework.messages import (
     P2PHeaderAndShortIDs,
     PrefilledTransaction,
     calculate_shortid,
+    calculate_shortids,
     msg_block,
     msg_blocktxn,
     msg_cmpctblock,
@@ -378,20 +379,13 @@ class CompactBlocksTest(BitcoinTestFramework):
         # Determine the siphash keys to use.
         [k0, k1] = header_and_shortids.get_siphash_keys()
 
-        index = 0
-        while index < len(block.vtx):
-            if (len(header_and_shortids.prefilled_txn) > 0 and
-                    header_and_shortids.prefilled_txn[0].index == index):
-                # Already checked prefilled transactions above
-                header_and_shortids.prefilled_txn.pop(0)
-            else:
-                tx_hash = block.vtx[index].sha256
-                if version == 2:
-                    tx_hash = block.vtx[index].calc_sha256(True)
-                shortid = calculate_shortid(k0, k1, tx_hash)
-                assert_equal(shortid, header_and_shortids.shortids[0])
-                header_and_shortids.shortids.pop(0)
-            index += 1
+        # Already checked prefilled transactions above
+        prefilled_indexes = [entry.index for entry in header_and_shortids.prefilled_txn]
+        tx_hashes = []
+        for index, tx in enumerate(block.vtx):
+            if index not in prefilled_indexes:
+                tx_hashes.append(tx.calc_sha256(True) if version == 2 else tx.sha256)
+        assert_equal(calculate_shortids(k0, k1, tx_hashes), header_and_shortids.shortids)
 
     # Test that bitcoind requests compact blocks when we announce new blocks
     # via header or inv, and that responding to getblocktxn causes the block
@@ -15,10 +15,7 @@ from test_framework.messages import (
     msg_notfound,
     tx_from_hex,
 )
-from test_framework.p2p import (
-    P2PInterface,
-    p2p_lock,
-)
+from test_framework.p2p import P2PInterface
 from test_framework.test_framework import BitcoinTestFramework
 from test_framework.util import (
     assert_equal,
@@ -38,6 +35,10 @@ class TestP2PConn(P2PInterface):
             if i.type & MSG_TYPE_MASK == MSG_TX or i.type & MSG_TYPE_MASK == MSG_WTX:
                 self.tx_getdata_count += 1
 
+    def get_tx_getdata_count(self):
+        with self.lock:
+            return self.tx_getdata_count
+
 
 # Constants from net_processing
 GETDATA_TX_INTERVAL = 60  # seconds
@@ -56,6 +57,9 @@ MAX_GETDATA_INBOUND_WAIT = GETDATA_TX_INTERVAL + INBOUND_PEER_TX_DELAY + TXID_RE
 class TxDownloadTest(BitcoinTestFramework):
     def set_test_params(self):
         self.num_nodes = 2
+        # Spread the peers over several event loops; their state is guarded
+        # by their own lock
+        self.network_loops = 4
 
     def test_tx_requests(self):
         self.log.info("Test that we request transactions from all our peers, eventually")
@@ -71,7 +75,7 @@ class TxDownloadTest(BitcoinTestFramework):
 
         def getdata_found(peer_index):
             p = self.nodes[0].p2ps[peer_index]
-            with p2p_lock:
+            with p.lock:
                 return p.last_message.get("getdata") and p.last_message["getdata"].inv[-1].hash == txid
 
         node_0_mocktime = int(time.time())
@@ -133,7 +137,7 @@ class TxDownloadTest(BitcoinTestFramework):
 
         p = self.nodes[0].p2ps[0]
 
-        with p2p_lock:
+        with p.lock:
             p.tx_getdata_count = 0
 
         mock_time = int(time.time() + 1)
@@ -150,8 +154,7 @@ class TxDownloadTest(BitcoinTestFramework):
         self.log.info("No more than {} requests should be seen within {} seconds after announcement".format(MAX_GETDATA_IN_FLIGHT, INBOUND_PEER_TX_DELAY + OVERLOADED_PEER_DELAY - 1))
         self.nodes[0].setmocktime(mock_time + INBOUND_PEER_TX_DELAY + OVERLOADED_PEER_DELAY - 1)
         p.sync_with_ping()
-        with p2p_lock:
-            assert_equal(p.tx_getdata_count, MAX_GETDATA_IN_FLIGHT)
+        assert_equal(p.get_tx_getdata_count(), MAX_GETDATA_IN_FLIGHT)
         self.log.info("If we wait {} seconds after announcement, we should eventually get more requests".format(INBOUND_PEER_TX_DELAY + OVERLOADED_PEER_DELAY))
         self.nodes[0].setmocktime(mock_time + INBOUND_PEER_TX_DELAY + OVERLOADED_PEER_DELAY)
         p.wait_until(lambda: p.tx_getdata_count == len(txids))
@@ -164,10 +167,9 @@ class TxDownloadTest(BitcoinTestFramework):
         for p in [peer1, peer2]:
             p.send_message(msg_inv([CInv(t=MSG_WTX, h=WTXID)]))
         # One of the peers is asked for the tx
-        peer2.wait_until(lambda: sum(p.tx_getdata_count for p in [peer1, peer2]) == 1)
-        with p2p_lock:
-            peer_expiry, peer_fallback = (peer1, peer2) if peer1.tx_getdata_count == 1 else (peer2, peer1)
-            assert_equal(peer_fallback.tx_getdata_count, 0)
+        self.wait_until(lambda: sum(p.get_tx_getdata_count() for p in [peer1, peer2]) == 1)
+        peer_expiry, peer_fallback = (peer1, peer2) if peer1.get_tx_getdata_count() == 1 else (peer2, peer1)
+        assert_equal(peer_fallback.get_tx_getdata_count(), 0)
         self.nodes[0].setmocktime(int(time.time()) + GETDATA_TX_INTERVAL + 1)  # Wait for request to peer_expiry to expire
         peer_fallback.wait_until(lambda: peer_fallback.tx_getdata_count >= 1, timeout=1)
         self.restart_node(0)  # reset mocktime
@@ -180,10 +182,9 @@ class TxDownloadTest(BitcoinTestFramework):
         for p in [peer1, peer2]:
             p.send_message(msg_inv([CInv(t=MSG_WTX, h=WTXID)]))
         # One of the peers is asked for the tx
-        peer2.wait_until(lambda: sum(p.tx_getdata_count for p in [peer1, peer2]) == 1)
-        with p2p_lock:
-            peer_disconnect, peer_fallback = (peer1, peer2) if peer1.tx_getdata_count == 1 else (peer2, peer1)
-            assert_equal(peer_fallback.tx_getdata_count, 0)
+        self.wait_until(lambda: sum(p.get_tx_getdata_count() for p in [peer1, peer2]) == 1)
+        peer_disconnect, peer_fallback = (peer1, peer2) if peer1.get_tx_getdata_count() == 1 else (peer2, peer1)
+        assert_equal(peer_fallback.get_tx_getdata_count(), 0)
         peer_disconnect.peer_disconnect()
         peer_disconnect.wait_for_disconnect()
         peer_fallback.wait_until(lambda: peer_fallback.tx_getdata_count >= 1, timeout=1)
@@ -196,10 +197,9 @@ class TxDownloadTest(BitcoinTestFramework):
         for p in [peer1, peer2]:
             p.send_message(msg_inv([CInv(t=MSG_WTX, h=WTXID)]))
         # One of the peers is asked for the tx
-        peer2.wait_until(lambda: sum(p.tx_getdata_count for p in [peer1, peer2]) == 1)
-        with p2p_lock:
-            peer_notfound, peer_fallback = (peer1, peer2) if peer1.tx_getdata_count == 1 else (peer2, peer1)
-            assert_equal(peer_fallback.tx_getdata_count, 0)
+        self.wait_until(lambda: sum(p.get_tx_getdata_count() for p in [peer1, peer2]) == 1)
+        peer_notfound, peer_fallback = (peer1, peer2) if peer1.get_tx_getdata_count() == 1 else (peer2, peer1)
+        assert_equal(peer_fallback.get_tx_getdata_count(), 0)
         peer_notfound.send_and_ping(msg_notfound(vec=[CInv(MSG_WTX, WTXID)]))  # Send notfound, so that fallback peer is selected
         peer_fallback.wait_until(lambda: peer_fallback.tx_getdata_count >= 1, timeout=1)
 
@@ -217,8 +217,7 @@ class TxDownloadTest(BitcoinTestFramework):
         if preferred:
             peer.wait_until(lambda: peer.tx_getdata_count >= 1, timeout=1)
         else:
-            with p2p_lock:
-                assert_equal(peer.tx_getdata_count, 0)
+            assert_equal(peer.get_tx_getdata_count(), 0)
             self.nodes[0].setmocktime(mock_time + NONPREF_PEER_TX_DELAY)
             peer.wait_until(lambda: peer.tx_getdata_count >= 1, timeout=1)
 
@@ -234,8 +233,7 @@ class TxDownloadTest(BitcoinTestFramework):
             self.nodes[0].add_p2p_connection(TestP2PConn(wtxidrelay=True))
         peer.send_message(msg_inv([CInv(t=MSG_TX, h=0xff11ff11)]))
         peer.sync_with_ping()
-        with p2p_lock:
-            assert_equal(peer.tx_getdata_count, 0 if glob_wtxid else 1)
+        assert_equal(peer.get_tx_getdata_count(), 0 if glob_wtxid else 1)
         self.nodes[0].setmocktime(mock_time + TXID_RELAY_DELAY)
         peer.wait_until(lambda: peer.tx_getdata_count >= 1, timeout=1)
 
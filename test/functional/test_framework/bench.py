@@ -0,0 +1,538 @@
+#!/usr/bin/env python3
+# Copyright (c) 2022 The Elements Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Micro-benchmarks for the test framework primitives.
+
+These are not run by test_runner.py. Run them from test/functional with:
+
+    python3 -m test_framework.bench [--list] [name ...]
+
+Each benchmark prints the best wall-clock time of a few repetitions of the
+reference code path and of its optimized alternative."""
+
+import argparse
+from contextlib import contextmanager
+import gc
+from io import BytesIO
+import random
+import struct
+import sys
+import time
+from typing import Callable, Dict
+
+from .key import (
+    SECP256K1,
+    SECP256K1_G,
+    compute_xonly_pubkey,
+    generate_privkey,
+    sign_schnorr,
+    verify_schnorr,
+    verify_schnorr_batch,
+)
+from .messages import (
+    ByteReader,
+    CBlock,
+    CBlockHeader,
+    CInv,
+    COutPoint,
+    CTransaction,
+    CTxIn,
+    CTxInWitness,
+    CTxOut,
+    CTxOutAsset,
+    CTxOutNonce,
+    CTxOutValue,
+    CTxOutWitness,
+    calculate_shortid,
+    calculate_shortids,
+    deser_compact_size,
+    deser_string,
+    deser_string_vector,
+    deser_uint256,
+    deser_uint256_vector,
+    deser_vector,
+    from_bytes,
+    msg_block,
+    msg_headers,
+    msg_tx,
+    ser_compact_size,
+    ser_string,
+    ser_string_vector,
+    ser_uint256,
+    ser_uint256_vector,
+    ser_vector,
+    sha256,
+    uint256_from_str,
+)
+from .muhash import MuHash3072
+from .p2p import (
+    MESSAGEMAP,
+    P2PInterface,
+    logger as p2p_logger,
+)
+from .ripemd160 import HASHLIB_RIPEMD160, ripemd160, ripemd160_reference
+
+BENCHMARKS: Dict[str, Callable] = {}
+
+
+def benchmark(func):
+    """Register a benchmark function under its name (minus the bench_ prefix)"""
+    BENCHMARKS[func.__name__[len("bench_"):]] = func
+    return func
+
+
+def best_time(func, *, repeat=7):
+    """Return the fastest of `repeat` runs of func(), in seconds
+
+    Like timeit, the garbage collector is disabled while timing."""
+    best = None
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return best
+
+
+def report(name, baseline, optimized, *, unit="run"):
+    """Print baseline vs. optimized timings for one benchmark"""
+    print("{:<40} {:>10.2f} ms {:>10.2f} ms {:>7.2f}x  (per {})".format(
+        name, baseline * 1000, optimized * 1000, baseline / optimized, unit))
+
+
+def random_bytes(rng, n):
+    return rng.getrandbits(8 * n).to_bytes(n, "little") if n else b""
+
+
+def create_confidential_tx(rng, *, n_inputs=2, n_outputs=3, rangeproof_size=2900):
+    """Build a transaction whose outputs all carry CT commitments and proofs"""
+    tx = CTransaction()
+    for _ in range(n_inputs):
+        tx.vin.append(CTxIn(COutPoint(rng.getrandbits(256), rng.randrange(8)), b"", 0xfffffffe))
+        tx.wit.vtxinwit.append(CTxInWitness())
+        tx.wit.vtxinwit[-1].scriptWitness.stack = [random_bytes(rng, 71), random_bytes(rng, 33)]
+    for _ in range(n_outputs):
+        tx.vout.append(CTxOut(
+            CTxOutValue(), b"\x00\x14" + random_bytes(rng, 20),
+            CTxOutAsset(b"\x0a" + random_bytes(rng, 32)), CTxOutNonce(b"\x02" + random_bytes(rng, 32))))
+        tx.vout[-1].nValue.vchCommitment = b"\x08" + random_bytes(rng, 32)
+        tx.wit.vtxoutwit.append(CTxOutWitness())
+        tx.wit.vtxoutwit[-1].vchSurjectionproof = random_bytes(rng, 67)
+        tx.wit.vtxoutwit[-1].vchRangeproof = random_bytes(rng, rangeproof_size)
+    # Explicit fee output
+    tx.vout.append(CTxOut(1000))
+    tx.wit.vtxoutwit.append(CTxOutWitness())
+    return tx
+
+
+def create_confidential_block(n_tx=500, seed=0):
+    rng = random.Random(seed)
+    block = CBlock()
+    block.vtx = [create_confidential_tx(rng) for _ in range(n_tx)]
+    return block
+
+
+@benchmark
+def bench_deserialize():
+    """BytesIO vs. memoryview (ByteReader) parsing of a block full of CT outputs"""
+    data = create_confidential_block().serialize()
+    parsed = from_bytes(CBlock(), data, zero_copy=True)
+    assert parsed.serialize() == data
+    baseline = best_time(lambda: from_bytes(CBlock(), data))
+    optimized = best_time(lambda: from_bytes(CBlock(), data, zero_copy=True))
+    report("deserialize block (500 CT txs, {} kB)".format(len(data) // 1000), baseline, optimized, unit="block")
+    tx_data = parsed.vtx[0].serialize()
+    baseline = best_time(lambda: [CTransaction().deserialize(BytesIO(tx_data)) for _ in range(1000)])
+    optimized = best_time(lambda: [CTransaction().deserialize(ByteReader(tx_data)) for _ in range(1000)])
+    report("deserialize CT tx", baseline / 1000, optimized / 1000, unit="tx")
+
+
+# Reference implementations of the ser_*/deser_* helpers, as they were
+# written before being optimized. They are the baseline of bench_codecs.
+def ref_ser_compact_size(l):
+    r = b""
+    if l < 253:
+        r = struct.pack("B", l)
+    elif l < 0x10000:
+        r = struct.pack("<BH", 253, l)
+    elif l < 0x100000000:
+        r = struct.pack("<BI", 254, l)
+    else:
+        r = struct.pack("<BQ", 255, l)
+    return r
+
+
+def ref_deser_compact_size(f):
+    nit = struct.unpack("<B", f.read(1))[0]
+    if nit == 253:
+        nit = struct.unpack("<H", f.read(2))[0]
+    elif nit == 254:
+        nit = struct.unpack("<I", f.read(4))[0]
+    elif nit == 255:
+        nit = struct.unpack("<Q", f.read(8))[0]
+    return nit
+
+
+def ref_ser_string(s):
+    return ref_ser_compact_size(len(s)) + s
+
+
+def ref_deser_string(f):
+    nit = ref_deser_compact_size(f)
+    return f.read(nit)
+
+
+def ref_ser_uint256(u):
+    rs = b""
+    for _ in range(8):
+        rs += struct.pack("<I", u & 0xFFFFFFFF)
+        u >>= 32
+    return rs
+
+
+def ref_deser_uint256(f):
+    r = 0
+    for i in range(8):
+        t = struct.unpack("<I", f.read(4))[0]
+        r += t << (i * 32)
+    return r
+
+
+def ref_uint256_from_str(s):
+    r = 0
+    t = struct.unpack("<IIIIIIII", s[:32])
+    for i in range(8):
+        r += t[i] << (i * 32)
+    return r
+
+
+def ref_ser_vector(l):
+    r = ref_ser_compact_size(len(l))
+    for i in l:
+        r += i.serialize()
+    return r
+
+
+def ref_deser_vector(f, c):
+    nit = ref_deser_compact_size(f)
+    r = []
+    for _ in range(nit):
+        t = c()
+        t.deserialize(f)
+        r.append(t)
+    return r
+
+
+def ref_ser_uint256_vector(l):
+    r = ref_ser_compact_size(len(l))
+    for i in l:
+        r += ref_ser_uint256(i)
+    return r
+
+
+def ref_deser_uint256_vector(f):
+    nit = ref_deser_compact_size(f)
+    r = []
+    for _ in range(nit):
+        r.append(ref_deser_uint256(f))
+    return r
+
+
+def ref_ser_string_vector(l):
+    r = ref_ser_compact_size(len(l))
+    for sv in l:
+        r += ref_ser_string(sv)
+    return r
+
+
+def ref_deser_string_vector(f):
+    nit = ref_deser_compact_size(f)
+    r = []
+    for _ in range(nit):
+        r.append(ref_deser_string(f))
+    return r
+
+
+@benchmark
+def bench_codecs():
+    """Reference vs. current ser_*/deser_* helpers in messages.py"""
+    rng = random.Random(0)
+    n = 10000
+    sizes = [rng.choice((1, 252, 253, 0xffff, 0x10000, 0xffffffff, 0x100000000)) for _ in range(n)]
+    hashes = [rng.getrandbits(256) for _ in range(n)]
+    hash_bytes = [h.to_bytes(32, "little") for h in hashes]
+    strings = [random_bytes(rng, rng.randrange(100)) for _ in range(n)]
+    invs = [CInv(1, h) for h in hashes[:1000]]
+
+    def run(ser, deser, values):
+        data = b"".join(ser(v) for v in values)
+
+        def decode():
+            f = BytesIO(data)
+            for _ in range(len(values)):
+                deser(f)
+        return lambda: [ser(v) for v in values], decode
+
+    cases = [
+        ("compact_size", sizes, ser_compact_size, deser_compact_size, ref_ser_compact_size, ref_deser_compact_size),
+        ("uint256", hashes, ser_uint256, deser_uint256, ref_ser_uint256, ref_deser_uint256),
+        ("string", strings, ser_string, deser_string, ref_ser_string, ref_deser_string),
+        ("uint256_vector", [hashes[i:i + 100] for i in range(0, n, 100)],
+         ser_uint256_vector, deser_uint256_vector, ref_ser_uint256_vector, ref_deser_uint256_vector),
+        ("string_vector", [strings[i:i + 100] for i in range(0, n, 100)],
+         ser_string_vector, deser_string_vector, ref_ser_string_vector, ref_deser_string_vector),
+        ("vector", [invs[i:i + 100] for i in range(0, len(invs), 100)],
+         ser_vector, lambda f: deser_vector(f, CInv), ref_ser_vector, lambda f: ref_deser_vector(f, CInv)),
+    ]
+    for name, values, ser, deser, ref_ser, ref_deser in cases:
+        ser_run, deser_run = run(ser, deser, values)
+        ref_ser_run, ref_deser_run = run(ref_ser, ref_deser, values)
+        assert ser_run() == ref_ser_run()
+        report("ser_" + name, best_time(ref_ser_run), best_time(ser_run), unit="{} calls".format(len(values)))
+        report("deser_" + name, best_time(ref_deser_run), best_time(deser_run), unit="{} calls".format(len(values)))
+    assert [uint256_from_str(b) for b in hash_bytes] == hashes
+    report("uint256_from_str", best_time(lambda: [ref_uint256_from_str(b) for b in hash_bytes]),
+           best_time(lambda: [uint256_from_str(b) for b in hash_bytes]), unit="{} calls".format(n))
+
+
+def ref_ec_mul(curve, ps):
+    """Double-and-add multi point multiplication, as EllipticCurve.mul used to do"""
+    r = (0, 1, 0)
+    for i in range(255, -1, -1):
+        r = curve.double(r)
+        for (p, n) in ps:
+            if ((n >> i) & 1):
+                r = curve.add(r, p)
+    return r
+
+
+@contextmanager
+def reference_ec_mul():
+    """Make the secp256k1 code in key.py use ref_ec_mul"""
+    SECP256K1.mul = lambda ps: ref_ec_mul(SECP256K1, ps)
+    try:
+        yield
+    finally:
+        del SECP256K1.mul
+
+
+@benchmark
+def bench_ecmul():
+    """Double-and-add vs. table/wNAF/Strauss scalar multiplication in key.py"""
+    rng = random.Random(0)
+    scalars = [rng.randrange(1, 2**256) for _ in range(20)]
+    point = SECP256K1.mul([(SECP256K1_G, scalars[0])])
+    SECP256K1.mul([(SECP256K1_G, 1)])  # build the generator table outside of the timings
+    for name, ps in (
+        ("G*k", [(SECP256K1_G, scalars[1])]),
+        ("P*k", [(point, scalars[2])]),
+        ("G*k1 + P*k2", [(SECP256K1_G, scalars[3]), (point, scalars[4])]),
+    ):
+        assert SECP256K1.affine(SECP256K1.mul(ps)) == SECP256K1.affine(ref_ec_mul(SECP256K1, ps))
+        report("ecmul " + name, best_time(lambda: [ref_ec_mul(SECP256K1, ps) for _ in range(20)]) / 20,
+               best_time(lambda: [SECP256K1.mul(ps) for _ in range(20)]) / 20, unit="mul")
+
+    keys = [generate_privkey() for _ in range(20)]
+    pubkeys = [compute_xonly_pubkey(key)[0] for key in keys]
+    msgs = [random_bytes(rng, 32) for _ in keys]
+    sigs = [sign_schnorr(key, msg) for key, msg in zip(keys, msgs)]
+
+    def sign():
+        for key, msg in zip(keys, msgs):
+            sign_schnorr(key, msg)
+
+    def verify():
+        for pubkey, sig, msg in zip(pubkeys, sigs, msgs):
+            assert verify_schnorr(pubkey, sig, msg)
+    with reference_ec_mul():
+        baseline_sign, baseline_verify = best_time(sign, repeat=3), best_time(verify, repeat=3)
+    optimized_sign, optimized_verify = best_time(sign, repeat=3), best_time(verify, repeat=3)
+    for name, baseline, optimized in (("sign_schnorr", baseline_sign, optimized_sign),
+                                      ("verify_schnorr", baseline_verify, optimized_verify)):
+        report("{} ({:.0f} -> {:.0f}/s)".format(name, len(keys) / baseline, len(keys) / optimized),
+               baseline / len(keys), optimized / len(keys), unit="signature")
+
+
+@benchmark
+def bench_schnorr_batch():
+    """Individual vs. batch verification of BIP340 signatures"""
+    rng = random.Random(0)
+    items = []
+    for _ in range(100):
+        key, msg = generate_privkey(), random_bytes(rng, 32)
+        items.append((compute_xonly_pubkey(key)[0], sign_schnorr(key, msg), msg))
+    key = generate_privkey()
+    same_key_items = []
+    for _ in range(100):
+        msg = random_bytes(rng, 32)
+        same_key_items.append((compute_xonly_pubkey(key)[0], sign_schnorr(key, msg), msg))
+    for name, batch in (("10 signatures", items[:10]), ("100 signatures", items),
+                        ("100 signatures, one key", same_key_items)):
+        assert verify_schnorr_batch(batch) == [True] * len(batch)
+        report("verify " + name,
+               best_time(lambda: [verify_schnorr(*item) for item in batch], repeat=3),
+               best_time(lambda: verify_schnorr_batch(batch), repeat=3), unit="batch")
+
+
+class RefP2PInterface(P2PInterface):
+    """P2PInterface with the receive path as it was before the ring buffer:
+    the consumed bytes are sliced off recvbuf after every message, payloads
+    are parsed from a BytesIO, and every message is formatted for logging."""
+    def peer_connect_helper(self, *args):
+        super().peer_connect_helper(*args)
+        self.recvbuf = b""
+
+    def data_received(self, t):
+        if len(t) > 0:
+            self.recvbuf += t
+            self._on_data()
+
+    def _on_data(self):
+        while True:
+            if len(self.recvbuf) < 4:
+                return
+            if self.recvbuf[:4] != self.magic_bytes:
+                raise ValueError("magic bytes mismatch")
+            if len(self.recvbuf) < 4 + 12 + 4 + 4:
+                return
+            msgtype = self.recvbuf[4:4+12].split(b"\x00", 1)[0]
+            msglen = struct.unpack("<i", self.recvbuf[4+12:4+12+4])[0]
+            checksum = self.recvbuf[4+12+4:4+12+4+4]
+            if len(self.recvbuf) < 4 + 12 + 4 + 4 + msglen:
+                return
+            msg = self.recvbuf[4+12+4+4:4+12+4+4+msglen]
+            if checksum != sha256(sha256(msg))[:4]:
+                raise ValueError("got bad checksum")
+            self.recvbuf = self.recvbuf[4+12+4+4+msglen:]
+            t = MESSAGEMAP[msgtype]()
+            t.deserialize(BytesIO(msg))
+            p2p_logger.debug("Received message from %s:%d: %s" % (self.dstaddr, self.dstport, repr(t)[:500]))
+            self.on_message(t)
+
+
+def create_p2p_stream(p2p, seed=0):
+    """Serialize a recorded-like stream of tx, headers and block messages"""
+    rng = random.Random(seed)
+    messages = []
+    for i in range(5000):
+        tx = CTransaction()
+        tx.vin.append(CTxIn(COutPoint(rng.getrandbits(256), 0), b"", 0xfffffffe))
+        tx.vout.append(CTxOut(rng.randrange(1, 10**8), b"\x00\x14" + random_bytes(rng, 20)))
+        tx.vout.append(CTxOut(1000))
+        messages.append(msg_tx(tx))
+        if i % 10 == 0:
+            headers = msg_headers()
+            for _ in range(20):
+                header = CBlockHeader()
+                header.hashPrevBlock = rng.getrandbits(256)
+                header.hashMerkleRoot = rng.getrandbits(256)
+                headers.headers.append(header)
+            messages.append(headers)
+        if i % 100 == 0:
+            messages.append(msg_block(CBlock()))
+            messages[-1].block.vtx = [m.tx for m in messages[-100:] if isinstance(m, msg_tx)]
+    return len(messages), b"".join(p2p.build_message(m) for m in messages)
+
+
+def receive_p2p_stream(create_p2p, stream, chunk_size):
+    p2p = create_p2p()
+    p2p.peer_connect_helper("0", 0, "regtest", 1)
+    for i in range(0, len(stream), chunk_size):
+        p2p.data_received(stream[i:i + chunk_size])
+    return p2p
+
+
+@benchmark
+def bench_p2p_receive():
+    """Slicing vs. ring buffer receive path of P2PInterface"""
+    sender = P2PInterface()
+    sender.peer_connect_helper("0", 0, "regtest", 1)
+    n_messages, stream = create_p2p_stream(sender)
+    ref = receive_p2p_stream(RefP2PInterface, stream, len(stream))
+    new = receive_p2p_stream(P2PInterface, stream, len(stream))
+    assert ref.message_count == new.message_count and sum(new.message_count.values()) == n_messages
+    # 256 kB is the most asyncio reads from a socket at once
+    for chunk_size, description in ((256 * 1024, "256 kB reads"), (len(stream), "one read")):
+        report("receive {} msgs, {} kB ({})".format(n_messages, len(stream) // 1000, description),
+               best_time(lambda: receive_p2p_stream(RefP2PInterface, stream, chunk_size), repeat=3),
+               best_time(lambda: receive_p2p_stream(P2PInterface, stream, chunk_size), repeat=3), unit="stream")
+    # A test that only counts the messages it receives
+    lazy = lambda: P2PInterface(decode={"tx": "lazy", "headers": "lazy", "block": "lazy"})
+    report("receive {} msgs, lazy decoding".format(n_messages),
+           best_time(lambda: receive_p2p_stream(P2PInterface, stream, 256 * 1024), repeat=3),
+           best_time(lambda: receive_p2p_stream(lazy, stream, 256 * 1024), repeat=3), unit="stream")
+
+
+@benchmark
+def bench_muhash():
+    """Per-element vs. bulk MuHash3072 hashing of a UTXO set"""
+    rng = random.Random(0)
+    # Outpoint, height/coinbase and an explicit P2WPKH output
+    utxos = [random_bytes(rng, 36 + 4 + 33 + 9 + 1 + 23) for _ in range(100000)]
+
+    def insert(elements):
+        muhash = MuHash3072()
+        for data in elements:
+            muhash.insert(data)
+        return muhash.digest()
+
+    def insert_many(elements):
+        muhash = MuHash3072()
+        muhash.insert_many(elements)
+        return muhash.digest()
+    assert insert(utxos[:100]) == insert_many(utxos[:100])
+    # The per-element path takes about a millisecond per element, so it is
+    # timed on a sample of the set
+    sample = utxos[:1000]
+    report("insert {} UTXOs (baseline: {})".format(len(utxos), len(sample)),
+           best_time(lambda: insert(sample), repeat=1) / len(sample),
+           best_time(lambda: insert_many(utxos), repeat=1) / len(utxos), unit="element")
+
+
+@benchmark
+def bench_hashes():
+    """Pure Python vs. hashlib RIPEMD-160 and per-tx vs. batched shortids"""
+    rng = random.Random(0)
+    if HASHLIB_RIPEMD160:
+        digests = [sha256(random_bytes(rng, 33)) for _ in range(1000)]
+        assert [ripemd160(d) for d in digests] == [ripemd160_reference(d) for d in digests]
+        report("hash160 of {} pubkeys".format(len(digests)),
+               best_time(lambda: [ripemd160_reference(d) for d in digests]),
+               best_time(lambda: [ripemd160(d) for d in digests]))
+    else:
+        print("hashlib lacks RIPEMD-160, skipping the hash160 benchmark")
+    k0, k1 = rng.getrandbits(64), rng.getrandbits(64)
+    tx_hashes = [rng.getrandbits(256) for _ in range(2000)]
+    assert [calculate_shortid(k0, k1, h) for h in tx_hashes] == calculate_shortids(k0, k1, tx_hashes)
+    report("shortids of a {} tx block".format(len(tx_hashes)),
+           best_time(lambda: [calculate_shortid(k0, k1, h) for h in tx_hashes]),
+           best_time(lambda: calculate_shortids(k0, k1, tx_hashes)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--list", action="store_true", help="list the available benchmarks and exit")
+    parser.add_argument("names", nargs="*", help="benchmarks to run (default: all)")
+    args = parser.parse_args()
+    if args.list:
+        for name, func in BENCHMARKS.items():
+            print("{:<20} {}".format(name, func.__doc__))
+        return
+    unknown = [name for name in args.names if name not in BENCHMARKS]
+    if unknown:
+        sys.exit("Unknown benchmark(s): {}".format(", ".join(unknown)))
+    print("{:<40} {:>13} {:>13} {:>8}".format("benchmark", "baseline", "optimized", "speedup"))
+    for name in args.names or BENCHMARKS:
+        BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+    main()
@@ -10,7 +10,10 @@ testing.
 
 import os
 
-from .authproxy import AuthServiceProxy
+from .authproxy import (
+    AuthServiceProxy,
+    RPCBatch,
+)
 
 REFERENCE_FILENAME = 'rpc_interface.txt'
 
@@ -66,6 +69,12 @@ class AuthServiceProxyWrapper():
         self._log_call()
         return self.auth_service_proxy_instance.get_request(*args, **kwargs)
 
+    def batch(self, rpc_call_list=None):
+        if rpc_call_list is None:
+            # Record the calls through this wrapper, so that they are logged
+            return RPCBatch(self)
+        return self.auth_service_proxy_instance.batch(rpc_call_list)
+
 def get_filename(dirname, n_node):
     """
     Get a filename unique to the test process ID and node.
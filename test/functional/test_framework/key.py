@@ -7,14 +7,41 @@ WARNING: This code is slow, uses bad randomness, does not properly protect
 keys, and is trivially vulnerable to side channel attacks. Do not use for
 anything but tests."""
 import csv
+import functools
 import hashlib
 import hmac
 import os
 import random
 import unittest
 
+from . import libsecp256k1
 from .util import modinv
 
+# Optional libsecp256k1 backend (see libsecp256k1.py), enabled by setting
+# TEST_FRAMEWORK_LIBSECP256K1 to the path of a shared library. The build only
+# links secp256k1 statically, so there is no library to pick up by default.
+# Set TEST_FRAMEWORK_SECP256K1_CROSSCHECK=1 to run both implementations and
+# assert that their results match.
+LIBSECP256K1 = libsecp256k1.load_library(os.getenv("TEST_FRAMEWORK_LIBSECP256K1"))
+SECP256K1_CROSSCHECK = os.getenv("TEST_FRAMEWORK_SECP256K1_CROSSCHECK") == "1"
+
+def libsecp256k1_backend(func):
+    """Dispatch func to the method of the same name of LIBSECP256K1 when it is loaded.
+
+    The Python implementation runs instead if the backend returns NotImplemented."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if LIBSECP256K1 is None:
+            return func(*args, **kwargs)
+        result = getattr(LIBSECP256K1, func.__name__)(*args, **kwargs)
+        if result is NotImplemented:
+            return func(*args, **kwargs)
+        if SECP256K1_CROSSCHECK:
+            expected = func(*args, **kwargs)
+            assert result == expected, "libsecp256k1 and Python %s() disagree: %r != %r" % (func.__name__, result, expected)
+        return result
+    return wrapper
+
 def TaggedHash(tag, data):
     ss = hashlib.sha256(tag.encode('utf-8')).digest()
     ss += ss
@@ -61,11 +88,18 @@ def modsqrt(a, p):
     return None
 
 class EllipticCurve:
+    # Window sizes (in bits) of the fixed base table and of the wNAF
+    # representation of the other scalars in mul()
+    FIXED_WINDOW = 8
+    WNAF_WINDOW = 5
+
     def __init__(self, p, a, b):
         """Initialize elliptic curve y^2 = x^3 + a*x + b over GF(p)."""
         self.p = p
         self.a = a % p
         self.b = b % p
+        self.fixed_base = None
+        self.fixed_base_table = None
 
     def affine(self, p1):
         """Convert a Jacobian point tuple p1 to affine form, or None if at infinity.
@@ -116,17 +150,17 @@ class EllipticCurve:
         x1, y1, z1 = p1
         if z1 == 0:
             return (0, 1, 0)
-        y1_2 = (y1**2) % self.p
-        y1_4 = (y1_2**2) % self.p
-        x1_2 = (x1**2) % self.p
-        s = (4*x1*y1_2) % self.p
-        m = 3*x1_2
+        p = self.p
+        y1_2 = (y1 * y1) % p
+        y1_4 = (y1_2 * y1_2) % p
+        s = (4 * x1 * y1_2) % p
+        m = 3 * x1 * x1
         if self.a:
-            m += self.a * pow(z1, 4, self.p)
-        m = m % self.p
-        x2 = (m**2 - 2*s) % self.p
-        y2 = (m*(s - x2) - 8*y1_4) % self.p
-        z2 = (2*y1*z1) % self.p
+            m += self.a * pow(z1, 4, p)
+        m = m % p
+        x2 = (m * m - 2 * s) % p
+        y2 = (m * (s - x2) - 8 * y1_4) % p
+        z2 = (2 * y1 * z1) % p
         return (x2, y2, z2)
 
     def add_mixed(self, p1, p2):
@@ -139,10 +173,11 @@ class EllipticCurve:
         # Adding to the point at infinity is a no-op
         if z1 == 0:
             return p2
-        z1_2 = (z1**2) % self.p
-        z1_3 = (z1_2 * z1) % self.p
-        u2 = (x2 * z1_2) % self.p
-        s2 = (y2 * z1_3) % self.p
+        p = self.p
+        z1_2 = (z1 * z1) % p
+        z1_3 = (z1_2 * z1) % p
+        u2 = (x2 * z1_2) % p
+        s2 = (y2 * z1_3) % p
         if x1 == u2:
             if (y1 != s2):
                 # p1 and p2 are inverses. Return the point at infinity.
@@ -151,12 +186,12 @@ class EllipticCurve:
             return self.double(p1)
         h = u2 - x1
         r = s2 - y1
-        h_2 = (h**2) % self.p
-        h_3 = (h_2 * h) % self.p
-        u1_h_2 = (x1 * h_2) % self.p
-        x3 = (r**2 - h_3 - 2*u1_h_2) % self.p
-        y3 = (r*(u1_h_2 - x3) - y1*h_3) % self.p
-        z3 = (h*z1) % self.p
+        h_2 = (h * h) % p
+        h_3 = (h_2 * h) % p
+        u1_h_2 = (x1 * h_2) % p
+        x3 = (r * r - h_3 - 2 * u1_h_2) % p
+        y3 = (r * (u1_h_2 - x3) - y1 * h_3) % p
+        z3 = (h * z1) % p
         return (x3, y3, z3)
 
     def add(self, p1, p2):
@@ -199,22 +234,131 @@ class EllipticCurve:
         z3 = (h*z1*z2) % self.p
         return (x3, y3, z3)
 
+    def affine_batch(self, ps):
+        """Convert a list of Jacobian tuples to affine form with a single modular inversion.
+
+        Uses Montgomery's trick. None of the points may be at infinity."""
+        prods = []
+        acc = 1
+        for (_, _, z) in ps:
+            acc = (acc * z) % self.p
+            prods.append(acc)
+        inv = modinv(acc, self.p)
+        result = [None] * len(ps)
+        for i in range(len(ps) - 1, -1, -1):
+            x, y, z = ps[i]
+            inv_z = (inv * prods[i - 1]) % self.p if i else inv
+            inv = (inv * z) % self.p
+            inv_2 = (inv_z**2) % self.p
+            result[i] = ((inv_2 * x) % self.p, (inv_2 * inv_z * y) % self.p, 1)
+        return result
+
+    def set_fixed_base(self, p1):
+        """Register a point that is multiplied often (i.e. the generator).
+
+        mul() computes multiples of it from a table of precomputed affine
+        points, built on first use, instead of by doubling and adding."""
+        self.fixed_base = p1
+        self.fixed_base_table = None
+
+    def _fixed_base_table(self):
+        """Return the table of j*2^(FIXED_WINDOW*i)*G for all windows i and 1 <= j < 2^FIXED_WINDOW."""
+        if self.fixed_base_table is None:
+            points = []
+            base = self.fixed_base
+            for _ in range(0, 256, self.FIXED_WINDOW):
+                multiple = base
+                for _ in range((1 << self.FIXED_WINDOW) - 1):
+                    points.append(multiple)
+                    multiple = self.add(multiple, base)
+                base = multiple
+            points = self.affine_batch(points)
+            size = (1 << self.FIXED_WINDOW) - 1
+            self.fixed_base_table = [points[i:i + size] for i in range(0, len(points), size)]
+        return self.fixed_base_table
+
+    @staticmethod
+    def wnaf(n, w):
+        """Return the width-w non-adjacent form of n, least significant digit first.
+
+        Every nonzero digit is odd and less than 2^(w-1) in absolute value,
+        and is followed by at least w-1 zeroes."""
+        digits = []
+        while n:
+            if n & 1:
+                d = n & ((1 << w) - 1)
+                if d >= (1 << (w - 1)):
+                    d -= (1 << w)
+                n -= d
+            else:
+                d = 0
+            digits.append(d)
+            n >>= 1
+        return digits
+
     def mul(self, ps):
         """Compute a (multi) point multiplication
 
-        ps is a list of (Jacobian tuple, scalar) pairs.
+        ps is a list of (Jacobian tuple, scalar) pairs. Scalars are taken modulo
+        2^256. Multiples of the fixed base (see set_fixed_base) are looked up
+        in its precomputed table. All other points are multiplied together
+        through their wNAF representation, sharing one chain of doublings
+        (Strauss-Shamir).
         """
         r = (0, 1, 0)
-        for i in range(255, -1, -1):
-            r = self.double(r)
-            for (p, n) in ps:
-                if ((n >> i) & 1):
-                    r = self.add(r, p)
-        return r
+        wnafs = []
+        for (p, n) in ps:
+            n &= (1 << 256) - 1
+            if n == 0 or p[2] == 0:
+                continue
+            if self.fixed_base is not None and p == self.fixed_base:
+                table = self._fixed_base_table()
+                mask = (1 << self.FIXED_WINDOW) - 1
+                for window in table:
+                    j = n & mask
+                    if j:
+                        r = self.add_mixed(r, window[j - 1])
+                    n >>= self.FIXED_WINDOW
+                continue
+            # Odd multiples p, 3p, 5p, ... for the wNAF digits
+            p_2 = self.double(p)
+            odd = [p]
+            for _ in range((1 << (self.WNAF_WINDOW - 2)) - 1):
+                odd.append(self.add(odd[-1], p_2))
+            if any(q[2] == 0 for q in odd):
+                # Only possible for points of small order, which secp256k1 does
+                # not have. Fall back to plain double-and-add.
+                q = (0, 1, 0)
+                for i in range(255, -1, -1):
+                    q = self.double(q)
+                    if (n >> i) & 1:
+                        q = self.add(q, p)
+                r = self.add(r, q)
+                continue
+            wnafs.append((self.wnaf(n, self.WNAF_WINDOW), odd))
+        if not wnafs:
+            return r
+        # Convert the odd multiples of all points to affine form at once
+        size = 1 << (self.WNAF_WINDOW - 2)
+        odd = self.affine_batch([q for _, odd in wnafs for q in odd])
+        wnafs = [(digits, odd[i * size:(i + 1) * size], [self.negate(q) for q in odd[i * size:(i + 1) * size]])
+                 for i, (digits, _) in enumerate(wnafs)]
+        q = (0, 1, 0)
+        for i in range(max(len(digits) for digits, _, _ in wnafs) - 1, -1, -1):
+            q = self.double(q)
+            for (digits, odd, neg) in wnafs:
+                if i < len(digits):
+                    d = digits[i]
+                    if d > 0:
+                        q = self.add_mixed(q, odd[d >> 1])
+                    elif d < 0:
+                        q = self.add_mixed(q, neg[(-d) >> 1])
+        return self.add(r, q)
 
 SECP256K1_FIELD_SIZE = 2**256 - 2**32 - 977
 SECP256K1 = EllipticCurve(SECP256K1_FIELD_SIZE, 0, 7)
 SECP256K1_G = (0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798, 0x483ADA7726A3C4655DA4FBFC0E1108A8FD17B448A68554199C47D08FFB10D4B8, 1)
+SECP256K1.set_fixed_base(SECP256K1_G)
 SECP256K1_ORDER = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
 SECP256K1_ORDER_HALF = SECP256K1_ORDER // 2
 
@@ -267,6 +411,7 @@ class ECPubKey():
         else:
             return bytes([0x04]) + p[0].to_bytes(32, 'big') + p[1].to_bytes(32, 'big')
 
+    @libsecp256k1_backend
     def verify_ecdsa(self, sig, msg, low_s=True):
         """Verify a strictly DER-encoded ECDSA signature against this pubkey.
 
@@ -379,6 +524,7 @@ class ECKey():
         ret.compressed = self.compressed
         return ret
 
+    @libsecp256k1_backend
     def sign_ecdsa(self, msg, low_s=True, rfc6979=False):
         """Construct a DER-encoded ECDSA signature with this key.
 
@@ -403,6 +549,7 @@ class ECKey():
         sb = s.to_bytes((s.bit_length() + 8) // 8, 'big')
         return b'\x30' + bytes([4 + len(rb) + len(sb), 2, len(rb)]) + rb + bytes([2, len(sb)]) + sb
 
+@libsecp256k1_backend
 def compute_xonly_pubkey(key):
     """Compute an x-only (32 byte) public key from a (32 byte) private key.
 
@@ -435,6 +582,7 @@ def tweak_add_privkey(key, tweak):
         return None
     return x.to_bytes(32, 'big')
 
+@libsecp256k1_backend
 def tweak_add_pubkey(key, tweak):
     """Tweak a public key and return whether the result had to be negated."""
 
@@ -455,6 +603,7 @@ def tweak_add_pubkey(key, tweak):
         return None
     return (Q[0].to_bytes(32, 'big'), not SECP256K1.has_even_y(Q))
 
+@libsecp256k1_backend
 def verify_schnorr(key, sig, msg):
     """Verify a Schnorr signature (see BIP 340).
 
@@ -486,6 +635,63 @@ def verify_schnorr(key, sig, msg):
         return False
     return True
 
+@libsecp256k1_backend
+def verify_schnorr_batch(items):
+    """Verify a list of Schnorr signatures at once (see BIP 340, Batch Verification).
+
+    - items is a list of (key, sig, msg) tuples, as passed to verify_schnorr.
+
+    Returns a list with the verify_schnorr result for each item. All
+    signatures are checked with one randomized linear combination, which
+    costs a single multi-point multiplication. Only if that fails are the
+    signatures verified one by one, to find the invalid ones.
+    """
+    results = [False] * len(items)
+    batch = []
+    s_sum = 0
+    for i, (key, sig, msg) in enumerate(items):
+        assert len(key) == 32
+        assert len(msg) == 32
+        assert len(sig) == 64
+        x_coord = int.from_bytes(key, 'big')
+        if x_coord == 0 or x_coord >= SECP256K1_FIELD_SIZE:
+            continue
+        P = SECP256K1.lift_x(x_coord)
+        if P is None:
+            continue
+        r = int.from_bytes(sig[0:32], 'big')
+        if r >= SECP256K1_FIELD_SIZE:
+            continue
+        R = SECP256K1.lift_x(r)
+        if R is None:
+            continue
+        s = int.from_bytes(sig[32:64], 'big')
+        if s >= SECP256K1_ORDER:
+            continue
+        e = int.from_bytes(TaggedHash("BIP0340/challenge", sig[0:32] + key + msg), 'big') % SECP256K1_ORDER
+        # The first signature doesn't need a random factor
+        a = random.randrange(1, SECP256K1_ORDER) if batch else 1
+        s_sum = (s_sum + a * s) % SECP256K1_ORDER
+        batch.append((i, R, P, a, e))
+    if not batch:
+        return results
+    # s_sum*G - sum(a*R) - sum(a*e*P) is the point at infinity iff all signatures are valid.
+    # Signatures by the same key share one term.
+    key_scalars = {}
+    for (_, _, P, a, e) in batch:
+        key_scalars[P] = (key_scalars.get(P, 0) + a * e) % SECP256K1_ORDER
+    ps = [(SECP256K1_G, s_sum)]
+    ps += [(R, SECP256K1_ORDER - a) for (_, R, _, a, _) in batch]
+    ps += [(P, SECP256K1_ORDER - n) for P, n in key_scalars.items()]
+    if SECP256K1.mul(ps)[2] == 0:
+        for (i, _, _, _, _) in batch:
+            results[i] = True
+    else:
+        for (i, _, _, _, _) in batch:
+            results[i] = verify_schnorr(*items[i])
+    return results
+
+@libsecp256k1_backend
 def sign_schnorr(key, msg, aux=None, flip_p=False, flip_r=False):
     """Create a Schnorr signature (see BIP 340)."""
 
@@ -530,9 +736,72 @@ class TestFrameworkKey(unittest.TestCase):
                         sig = bytes(sig)
                     self.assertFalse(verify_schnorr(verify_pubkey, sig, msg))
 
+    def test_mul(self):
+        """Test the table/wNAF multiplication against plain double-and-add."""
+        def naive_mul(ps):
+            r = (0, 1, 0)
+            for i in range(255, -1, -1):
+                r = SECP256K1.double(r)
+                for (p, n) in ps:
+                    if (n >> i) & 1:
+                        r = SECP256K1.add(r, p)
+            return r
+        P = SECP256K1.mul([(SECP256K1_G, random.randrange(1, SECP256K1_ORDER))])
+        scalars = [0, 1, 2, 0xff, 0x100, SECP256K1_ORDER - 1, SECP256K1_ORDER, 2**256 - 1] + \
+                  [random.randrange(2**256) for _ in range(4)]
+        for n in scalars:
+            for ps in ([(SECP256K1_G, n)], [(P, n)], [(SECP256K1_G, n), (P, n + 1)], [(P, n), (SECP256K1.affine(P), n)]):
+                self.assertEqual(SECP256K1.affine(SECP256K1.mul(ps)), SECP256K1.affine(naive_mul(ps)))
+        self.assertEqual(SECP256K1.mul([(SECP256K1_G, SECP256K1_ORDER)])[2], 0)
+
+    def test_schnorr_batch(self):
+        """Test batch verification of Schnorr signatures."""
+        items = []
+        for _ in range(8):
+            privkey, msg = generate_privkey(), generate_privkey()
+            items.append((compute_xonly_pubkey(privkey)[0], sign_schnorr(privkey, msg), msg))
+        self.assertEqual(verify_schnorr_batch([]), [])
+        self.assertEqual(verify_schnorr_batch(items), [True] * 8)
+        # Damaged signatures, a wrong message and an invalid key are located
+        items[1] = (items[1][0], items[1][1][:40] + bytes([items[1][1][40] ^ 1]) + items[1][1][41:], items[1][2])
+        items[4] = (items[4][0], items[4][1], items[5][2])
+        items[6] = (b'\xff' * 32, items[6][1], items[6][2])
+        expected = [True, False, True, True, False, True, False, True]
+        self.assertEqual(verify_schnorr_batch(items), expected)
+        self.assertEqual([verify_schnorr(*item) for item in items], expected)
+
+    @unittest.skipIf(LIBSECP256K1 is None, "TEST_FRAMEWORK_LIBSECP256K1 does not name a usable libsecp256k1")
+    def test_libsecp256k1_backend(self):
+        """Cross-check the libsecp256k1 backend against the Python implementation."""
+        global SECP256K1_CROSSCHECK
+        crosscheck, SECP256K1_CROSSCHECK = SECP256K1_CROSSCHECK, True
+        try:
+            for privkey in [generate_privkey() for _ in range(5)] + [bytes(32), b'\xff' * 32]:
+                msg = generate_privkey()
+                xonly, _ = compute_xonly_pubkey(privkey)
+                if xonly is None:
+                    continue
+                tweak_add_pubkey(xonly, msg)
+                self.assertTrue(verify_schnorr(xonly, sign_schnorr(privkey, msg, msg), msg))
+                key = ECKey()
+                key.set(privkey, True)
+                pubkey = key.get_pubkey()
+                sig = key.sign_ecdsa(msg, rfc6979=True)
+                self.assertTrue(pubkey.verify_ecdsa(sig, msg))
+                self.assertFalse(pubkey.verify_ecdsa(sig, bytes(32)))
+                # A high-S signature only passes without the low-S rule
+                high_s_sig = key.sign_ecdsa(msg, low_s=False)
+                pubkey.verify_ecdsa(high_s_sig, msg)
+                self.assertTrue(pubkey.verify_ecdsa(high_s_sig, msg, low_s=False))
+            self.assertIsNone(tweak_add_pubkey(b'\xff' * 32, bytes(32)))
+            self.assertIsNone(tweak_add_pubkey(compute_xonly_pubkey(generate_privkey())[0], b'\xff' * 32))
+        finally:
+            SECP256K1_CROSSCHECK = crosscheck
+
     def test_schnorr_testvectors(self):
         """Implement the BIP340 test vectors (read from bip340_test_vectors.csv)."""
         num_tests = 0
+        batch, batch_expected = [], []
         vectors_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'bip340_test_vectors.csv')
         with open(vectors_file, newline='', encoding='utf8') as csvfile:
             reader = csv.reader(csvfile)
@@ -555,9 +824,12 @@ class TestFrameworkKey(unittest.TestCase):
                     except RuntimeError as e:
                         self.fail("BIP340 test vector %i (%s): signing raised exception %s" % (i, comment, e))
                 result_actual = verify_schnorr(pubkey, sig, msg)
+                batch.append((pubkey, sig, msg))
+                batch_expected.append(result)
                 if result:
                     self.assertEqual(result, result_actual, "BIP340 test vector %i (%s): verification failed" % (i, comment))
                 else:
                     self.assertEqual(result, result_actual, "BIP340 test vector %i (%s): verification succeeded unexpectedly" % (i, comment))
                 num_tests += 1
         self.assertTrue(num_tests >= 15) # expect at least 15 test vectors
+        self.assertEqual(verify_schnorr_batch(batch), batch_expected)
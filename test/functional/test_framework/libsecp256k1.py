@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# Copyright (c) 2022 The Elements Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""ctypes bindings to a shared libsecp256k1, for use as a backend of key.py
+
+The backend is only used when TEST_FRAMEWORK_LIBSECP256K1 names a shared
+library: configure builds src/secp256k1 with --disable-shared, so a separate
+shared build is needed (e.g. configure a copy of src/secp256k1 with
+--enable-shared --enable-module-schnorrsig, or cmake with
+-DBUILD_SHARED_LIBS=ON). The library must include the extrakeys and schnorrsig
+modules.
+
+Each method below mirrors the key.py function of the same name, and returns
+NotImplemented for the arguments it does not handle (e.g. non-deterministic or
+high-S ECDSA signing), so that the caller falls back to the Python
+implementation."""
+
+import ctypes
+import os
+
+SECP256K1_CONTEXT_SIGN_VERIFY = (1 << 0) | (1 << 8) | (1 << 9)
+SECP256K1_EC_COMPRESSED = (1 << 1) | (1 << 8)
+
+# Sizes of the opaque structures of the library API
+PUBKEY_SIZE = 64
+XONLY_PUBKEY_SIZE = 64
+KEYPAIR_SIZE = 96
+ECDSA_SIGNATURE_SIZE = 64
+
+
+class LibSecp256k1:
+    """A loaded libsecp256k1 with a signing and verification context"""
+
+    def __init__(self, path):
+        lib = ctypes.CDLL(path)
+        c_buf = ctypes.c_char_p
+        prototypes = {
+            "secp256k1_context_create": (ctypes.c_void_p, [ctypes.c_uint]),
+            "secp256k1_ec_pubkey_parse": (ctypes.c_int, [ctypes.c_void_p, c_buf, c_buf, ctypes.c_size_t]),
+            "secp256k1_ecdsa_signature_parse_der": (ctypes.c_int, [ctypes.c_void_p, c_buf, c_buf, ctypes.c_size_t]),
+            "secp256k1_ecdsa_signature_serialize_der": (ctypes.c_int, [ctypes.c_void_p, c_buf, ctypes.POINTER(ctypes.c_size_t), c_buf]),
+            "secp256k1_ecdsa_signature_normalize": (ctypes.c_int, [ctypes.c_void_p, c_buf, c_buf]),
+            "secp256k1_ecdsa_sign": (ctypes.c_int, [ctypes.c_void_p, c_buf, c_buf, c_buf, ctypes.c_void_p, ctypes.c_void_p]),
+            "secp256k1_ecdsa_verify": (ctypes.c_int, [ctypes.c_void_p, c_buf, c_buf, c_buf]),
+            "secp256k1_keypair_create": (ctypes.c_int, [ctypes.c_void_p, c_buf, c_buf]),
+            "secp256k1_keypair_xonly_pub": (ctypes.c_int, [ctypes.c_void_p, c_buf, ctypes.POINTER(ctypes.c_int), c_buf]),
+            "secp256k1_xonly_pubkey_parse": (ctypes.c_int, [ctypes.c_void_p, c_buf, c_buf]),
+            "secp256k1_xonly_pubkey_serialize": (ctypes.c_int, [ctypes.c_void_p, c_buf, c_buf]),
+            "secp256k1_xonly_pubkey_from_pubkey": (ctypes.c_int, [ctypes.c_void_p, c_buf, ctypes.POINTER(ctypes.c_int), c_buf]),
+            "secp256k1_xonly_pubkey_tweak_add": (ctypes.c_int, [ctypes.c_void_p, c_buf, c_buf, c_buf]),
+            "secp256k1_schnorrsig_sign32": (ctypes.c_int, [ctypes.c_void_p, c_buf, c_buf, c_buf, c_buf]),
+            "secp256k1_schnorrsig_verify": (ctypes.c_int, [ctypes.c_void_p, c_buf, c_buf, ctypes.c_size_t, c_buf]),
+        }
+        for name, (restype, argtypes) in prototypes.items():
+            func = getattr(lib, name)
+            func.restype = restype
+            func.argtypes = argtypes
+        self.lib = lib
+        self.ctx = lib.secp256k1_context_create(SECP256K1_CONTEXT_SIGN_VERIFY)
+        if not self.ctx:
+            raise OSError("secp256k1_context_create failed")
+
+    def _xonly_pubkey(self, key):
+        pubkey = ctypes.create_string_buffer(XONLY_PUBKEY_SIZE)
+        if not self.lib.secp256k1_xonly_pubkey_parse(self.ctx, pubkey, key):
+            return None
+        return pubkey
+
+    def _serialize_xonly_pubkey(self, pubkey):
+        output = ctypes.create_string_buffer(32)
+        self.lib.secp256k1_xonly_pubkey_serialize(self.ctx, output, pubkey)
+        return output.raw
+
+    def sign_ecdsa(self, key, msg, low_s=True, rfc6979=False):
+        # The library always signs with an RFC6979 nonce and a low S value
+        if not low_s or not rfc6979 or len(msg) != 32:
+            return NotImplemented
+        assert key.valid
+        sig = ctypes.create_string_buffer(ECDSA_SIGNATURE_SIZE)
+        if not self.lib.secp256k1_ecdsa_sign(self.ctx, sig, msg, key.get_bytes(), None, None):
+            return NotImplemented
+        output = ctypes.create_string_buffer(72)
+        output_len = ctypes.c_size_t(len(output))
+        self.lib.secp256k1_ecdsa_signature_serialize_der(self.ctx, output, ctypes.byref(output_len), sig)
+        return output.raw[:output_len.value]
+
+    def verify_ecdsa(self, pubkey, sig, msg, low_s=True):
+        if len(msg) != 32:
+            return NotImplemented
+        assert pubkey.valid
+        data = pubkey.get_bytes()
+        if data is None:
+            return NotImplemented
+        parsed_pubkey = ctypes.create_string_buffer(PUBKEY_SIZE)
+        if not self.lib.secp256k1_ec_pubkey_parse(self.ctx, parsed_pubkey, data, len(data)):
+            return NotImplemented
+        parsed_sig = ctypes.create_string_buffer(ECDSA_SIGNATURE_SIZE)
+        if not self.lib.secp256k1_ecdsa_signature_parse_der(self.ctx, parsed_sig, sig, len(sig)):
+            return False
+        if not low_s:
+            self.lib.secp256k1_ecdsa_signature_normalize(self.ctx, parsed_sig, parsed_sig)
+        return self.lib.secp256k1_ecdsa_verify(self.ctx, parsed_sig, msg, parsed_pubkey) == 1
+
+    def compute_xonly_pubkey(self, key):
+        assert len(key) == 32
+        keypair = ctypes.create_string_buffer(KEYPAIR_SIZE)
+        if not self.lib.secp256k1_keypair_create(self.ctx, keypair, key):
+            return (None, None)
+        pubkey = ctypes.create_string_buffer(XONLY_PUBKEY_SIZE)
+        parity = ctypes.c_int()
+        self.lib.secp256k1_keypair_xonly_pub(self.ctx, pubkey, ctypes.byref(parity), keypair)
+        return (self._serialize_xonly_pubkey(pubkey), parity.value == 1)
+
+    def tweak_add_pubkey(self, key, tweak):
+        assert len(key) == 32
+        assert len(tweak) == 32
+        internal_pubkey = self._xonly_pubkey(key)
+        if internal_pubkey is None:
+            return None
+        output_pubkey = ctypes.create_string_buffer(PUBKEY_SIZE)
+        if not self.lib.secp256k1_xonly_pubkey_tweak_add(self.ctx, output_pubkey, internal_pubkey, tweak):
+            return None
+        pubkey = ctypes.create_string_buffer(XONLY_PUBKEY_SIZE)
+        parity = ctypes.c_int()
+        self.lib.secp256k1_xonly_pubkey_from_pubkey(self.ctx, pubkey, ctypes.byref(parity), output_pubkey)
+        return (self._serialize_xonly_pubkey(pubkey), parity.value == 1)
+
+    def sign_schnorr(self, key, msg, aux=None, flip_p=False, flip_r=False):
+        # Deliberately broken signatures and variable length messages are
+        # left to the Python implementation
+        if flip_p or flip_r or len(msg) != 32:
+            return NotImplemented
+        if aux is None:
+            aux = bytes(32)
+        assert len(key) == 32
+        assert len(aux) == 32
+        keypair = ctypes.create_string_buffer(KEYPAIR_SIZE)
+        if not self.lib.secp256k1_keypair_create(self.ctx, keypair, key):
+            return None
+        sig = ctypes.create_string_buffer(64)
+        if not self.lib.secp256k1_schnorrsig_sign32(self.ctx, sig, msg, keypair, aux):
+            return NotImplemented
+        return sig.raw
+
+    def verify_schnorr(self, key, sig, msg):
+        assert len(key) == 32
+        assert len(msg) == 32
+        assert len(sig) == 64
+        pubkey = self._xonly_pubkey(key)
+        if pubkey is None:
+            return False
+        return self.lib.secp256k1_schnorrsig_verify(self.ctx, sig, msg, len(msg), pubkey) == 1
+
+    def verify_schnorr_batch(self, items):
+        # The library verifies single signatures faster than a batch in Python
+        return [self.verify_schnorr(*item) for item in items]
+
+
+def load_library(path):
+    """Return a LibSecp256k1 for the shared library at path, or None if path is
+    unset, the library is missing or it lacks a required function"""
+    if not path or not os.path.isfile(path):
+        return None
+    try:
+        return LibSecp256k1(path)
+    except (OSError, AttributeError):
+        return None
@@ -27,8 +27,10 @@ import random
 import socket
 import struct
 import time
+from typing import Callable, Dict, Optional, Tuple
+import unittest
 
-from test_framework.siphash import siphash256
+from test_framework.siphash import siphash256, siphash256_many
 from test_framework.util import calcfastmerkleroot, BITCOIN_ASSET_OUT, assert_equal
 
 MAX_LOCATOR_SZ = 101
@@ -66,6 +68,19 @@ FILTER_TYPE_BASIC = 0
 WITNESS_SCALE_FACTOR = 4
 
 
+# Precompiled struct codecs for the fixed-width integer fields used below
+_U8 = struct.Struct("<B")
+_U16 = struct.Struct("<H")
+_I32 = struct.Struct("<i")
+_U32 = struct.Struct("<I")
+_U64 = struct.Struct("<Q")
+_COMPACT_SIZE_16 = struct.Struct("<BH")
+_COMPACT_SIZE_32 = struct.Struct("<BI")
+_COMPACT_SIZE_64 = struct.Struct("<BQ")
+_UINT256 = struct.Struct("32s")
+_UINT256_MASK = (1 << 256) - 1
+
+
 def sha256(s):
     return hashlib.sha256(s).digest()
 
@@ -75,56 +90,73 @@ def hash256(s):
 
 
 def ser_compact_size(l):
-    r = b""
     if l < 253:
-        r = struct.pack("B", l)
+        return _U8.pack(l)
     elif l < 0x10000:
-        r = struct.pack("<BH", 253, l)
+        return _COMPACT_SIZE_16.pack(253, l)
     elif l < 0x100000000:
-        r = struct.pack("<BI", 254, l)
+        return _COMPACT_SIZE_32.pack(254, l)
     else:
-        r = struct.pack("<BQ", 255, l)
-    return r
+        return _COMPACT_SIZE_64.pack(255, l)
 
 def deser_compact_size(f):
-    nit = struct.unpack("<B", f.read(1))[0]
-    if nit == 253:
-        nit = struct.unpack("<H", f.read(2))[0]
+    if type(f) is ByteReader:
+        nit, f.pos = _zc_compact_size(f.buf, f.pos)
+        return nit
+    nit = _U8.unpack(f.read(1))[0]
+    if nit < 253:
+        return nit
+    elif nit == 253:
+        nit = _U16.unpack(f.read(2))[0]
     elif nit == 254:
-        nit = struct.unpack("<I", f.read(4))[0]
+        nit = _U32.unpack(f.read(4))[0]
     elif nit == 255:
-        nit = struct.unpack("<Q", f.read(8))[0]
+        nit = _U64.unpack(f.read(8))[0]
     return nit
 
 def deser_string(f):
-    nit = deser_compact_size(f)
-    return f.read(nit)
+    if type(f) is ByteReader:
+        r, f.pos = _zc_string(f.buf, f.pos)
+        return r
+    return f.read(deser_compact_size(f))
 
 def ser_string(s):
     return ser_compact_size(len(s)) + s
 
+def ser_compact_size_into(buf, l):
+    if l < 253:
+        buf.append(l)
+    else:
+        buf += ser_compact_size(l)
+    return buf
+
+def ser_string_into(buf, s):
+    ser_compact_size_into(buf, len(s))
+    buf += s
+    return buf
+
 def deser_uint256(f):
-    r = 0
-    for i in range(8):
-        t = struct.unpack("<I", f.read(4))[0]
-        r += t << (i * 32)
-    return r
+    if type(f) is ByteReader:
+        pos = f.pos
+        f.pos = pos + 32
+        return int.from_bytes(f.buf[pos:pos + 32], "little")
+    # Unpacking through a struct keeps raising struct.error on a short read
+    return int.from_bytes(_UINT256.unpack(f.read(32))[0], "little")
 
 
 def ser_uint256(u):
-    rs = b""
-    for _ in range(8):
-        rs += struct.pack("<I", u & 0xFFFFFFFF)
-        u >>= 32
-    return rs
+    # Masking keeps the truncation (and two's complement) of the former
+    # eight 32-bit packs for out-of-range values
+    return (u & _UINT256_MASK).to_bytes(32, "little")
+
+
+def ser_uint256_into(buf, u):
+    buf += (u & _UINT256_MASK).to_bytes(32, "little")
+    return buf
 
 
 def uint256_from_str(s):
-    r = 0
-    t = struct.unpack("<IIIIIIII", s[:32])
-    for i in range(8):
-        r += t[i] << (i * 32)
-    return r
+    return int.from_bytes(_UINT256.unpack_from(s)[0], "little")
 
 
 def uint256_from_compact(c):
@@ -148,42 +180,104 @@ def deser_vector(f, c, deser_function_name=None):
     return r
 
 
+# Writer-based serialization: serialize_into(buf, ...) methods append to a
+# caller-provided bytearray and return it, so a whole block or message is
+# emitted into one growing buffer. The bytes-returning serialize*() methods
+# map onto serialize_into() as follows.
+SER_INTO_METHODS = {
+    "serialize": ("serialize_into", {}),
+    "serialize_with_witness": ("serialize_into", {"with_witness": True}),
+    "serialize_without_witness": ("serialize_into", {"with_witness": False}),
+    "serialize_v2": ("serialize_v2_into", {}),
+}
+# (class, ser_function_name) -> result of _get_ser_into()
+_ser_into_dispatch: Dict[Tuple[type, str], Tuple[Optional[Callable], Optional[dict]]] = {}
+
+
+def _get_ser_into(cls, ser_function_name):
+    """Return (writer function, kwargs) to use for cls, or (None, None)
+
+    Subclasses (e.g. in individual tests) may override only the bytes-returning
+    serializer. Whichever of the two is defined lower in the MRO wins, so such
+    overrides keep being honoured when the object is nested in another one."""
+    key = (cls, ser_function_name)
+    if key not in _ser_into_dispatch:
+        into_name, kwargs = SER_INTO_METHODS[ser_function_name]
+        result = (None, None)
+        for klass in cls.__mro__:
+            if into_name in vars(klass):
+                result = (vars(klass)[into_name], kwargs)
+                break
+            if ser_function_name in vars(klass):
+                break
+        _ser_into_dispatch[key] = result
+    return _ser_into_dispatch[key]
+
+
+def ser_object_into(buf, obj, ser_function_name="serialize", **kwargs):
+    """Append the serialization of obj to buf, using its serialize_into() writer
+    when it has one and falling back to buf += obj.serialize() otherwise.
+    Extra keyword arguments are passed on to either method."""
+    try:
+        writer, extra = _ser_into_dispatch[type(obj), ser_function_name]
+    except KeyError:
+        writer, extra = _get_ser_into(type(obj), ser_function_name)
+    if writer is None:
+        buf += getattr(obj, ser_function_name)(**kwargs)
+    elif extra:
+        writer(obj, buf, **extra, **kwargs)
+    elif kwargs:
+        writer(obj, buf, **kwargs)
+    else:
+        writer(obj, buf)
+    return buf
+
+
 # ser_function_name: Allow for an alternate serialization function on the
 # entries in the vector (we use this for serializing the vector of transactions
 # for a witness block).
 def ser_vector(l, ser_function_name=None):
-    r = ser_compact_size(len(l))
+    return bytes(ser_vector_into(bytearray(), l, ser_function_name))
+
+
+def ser_vector_into(buf, l, ser_function_name=None):
+    ser_compact_size_into(buf, len(l))
+    name = ser_function_name or "serialize"
+    cls = writer = None
     for i in l:
-        if ser_function_name:
-            r += getattr(i, ser_function_name)()
+        # Vectors are almost always homogeneous, resolve the writer once
+        if type(i) is not cls:
+            cls = type(i)
+            writer, extra = _get_ser_into(cls, name)
+        if writer is None or extra:
+            ser_object_into(buf, i, name)
         else:
-            r += i.serialize()
-    return r
+            writer(i, buf)
+    return buf
 
 
 def deser_uint256_vector(f):
     nit = deser_compact_size(f)
-    r = []
-    for _ in range(nit):
-        t = deser_uint256(f)
-        r.append(t)
-    return r
+    return [deser_uint256(f) for _ in range(nit)]
 
 
 def ser_uint256_vector(l):
-    r = ser_compact_size(len(l))
+    return bytes(ser_uint256_vector_into(bytearray(), l))
+
+
+def ser_uint256_vector_into(buf, l):
+    ser_compact_size_into(buf, len(l))
     for i in l:
-        r += ser_uint256(i)
-    return r
+        buf += (i & _UINT256_MASK).to_bytes(32, "little")
+    return buf
 
 
 def deser_string_vector(f):
+    if type(f) is ByteReader:
+        r, f.pos = _zc_string_vector(f.buf, f.pos)
+        return r
     nit = deser_compact_size(f)
-    r = []
-    for _ in range(nit):
-        t = deser_string(f)
-        r.append(t)
-    return r
+    return [f.read(deser_compact_size(f)) for _ in range(nit)]
 
 
 def ser_string_vector(l):
@@ -193,19 +287,184 @@ def ser_string_vector(l):
     return r
 
 
-def from_hex(obj, hex_string):
+def ser_string_vector_into(buf, l):
+    ser_compact_size_into(buf, len(l))
+    for sv in l:
+        ser_string_into(buf, sv)
+    return buf
+
+
+class ByteReader:
+    """Zero-copy alternative to BytesIO for deserialize()
+
+    Walks a single memoryview with an offset cursor. It implements read(), so
+    it can be passed to any deserialize() method, but the deser_* helpers and
+    the transaction and block primitives recognize it and decode their fields
+    in place (see the _zc_* functions below) with precompiled struct.Struct
+    objects and unpack_from, instead of going through one f.read() plus one
+    struct.unpack() per field. Only variable-length byte strings (scripts,
+    commitments, proofs) are copied out of the buffer."""
+    __slots__ = ("buf", "pos")
+
+    def __init__(self, data, pos=0):
+        self.buf = memoryview(data)
+        self.pos = pos
+
+    def read(self, n=-1):
+        start = self.pos
+        end = len(self.buf) if n < 0 else min(start + n, len(self.buf))
+        self.pos = end
+        return self.buf[start:end].tobytes()
+
+
+# Zero-copy decoders used when deserializing from a ByteReader. They take the
+# underlying memoryview and an offset, and return the decoded value together
+# with the offset just past it. Truncated input raises (IndexError or
+# struct.error) instead of silently producing short fields.
+
+def _zc_compact_size(buf, pos):
+    nit = buf[pos]
+    if nit < 253:
+        return nit, pos + 1
+    if nit == 253:
+        return _U16.unpack_from(buf, pos + 1)[0], pos + 3
+    if nit == 254:
+        return _U32.unpack_from(buf, pos + 1)[0], pos + 5
+    return _U64.unpack_from(buf, pos + 1)[0], pos + 9
+
+
+def _zc_string(buf, pos):
+    nit = buf[pos]
+    if nit < 253:
+        pos += 1
+    else:
+        nit, pos = _zc_compact_size(buf, pos)
+    end = pos + nit
+    if end > len(buf):
+        raise IndexError("string of length %d exceeds buffer" % nit)
+    return buf[pos:end].tobytes(), end
+
+
+def _zc_string_vector(buf, pos):
+    nit, pos = _zc_compact_size(buf, pos)
+    r = []
+    for _ in range(nit):
+        t, pos = _zc_string(buf, pos)
+        r.append(t)
+    return r, pos
+
+
+def _zc_commitment(buf, pos, sizes, cls):
+    """Read a version-prefixed confidential commitment into a new cls object.
+    sizes maps each valid version byte to the length of the payload after it."""
+    size = sizes.get(buf[pos])
+    if size is None:
+        raise ValueError("invalid %s in deserialize. version %d" % (cls.__name__, buf[pos]))
+    end = pos + 1 + size
+    if end > len(buf):
+        raise IndexError("%s exceeds buffer" % cls.__name__)
+    obj = cls.__new__(cls)
+    obj.vchCommitment = buf[pos:end].tobytes()
+    return obj, end
+
+
+def _zc_deser_txin(txin, buf, pos):
+    prevout = txin.prevout
+    prevout.hash = int.from_bytes(buf[pos:pos + 32], "little")
+    n = prevout.n = _U32.unpack_from(buf, pos + 32)[0]
+    pos += 36
+    has_asset_issuance = False
+    if not prevout.isNull():  # ignore coinbase for issuance/pegin
+        if n & OUTPOINT_ISSUANCE_FLAG:
+            has_asset_issuance = True
+        if n & OUTPOINT_PEGIN_FLAG:
+            txin.m_is_pegin = True
+        prevout.n = n & OUTPOINT_INDEX_MASK
+    txin.scriptSig, pos = _zc_string(buf, pos)
+    txin.nSequence = _U32.unpack_from(buf, pos)[0]
+    pos += 4
+    if has_asset_issuance:
+        issuance = txin.assetIssuance = CAssetIssuance()
+        issuance.assetBlindingNonce = int.from_bytes(buf[pos:pos + 32], "little")
+        issuance.assetEntropy = int.from_bytes(buf[pos + 32:pos + 64], "little")
+        issuance.nAmount, pos = _zc_commitment(buf, pos + 64, VALUE_COMMITMENT_SIZES, CTxOutValue)
+        issuance.nInflationKeys, pos = _zc_commitment(buf, pos, VALUE_COMMITMENT_SIZES, CTxOutValue)
+    return pos
+
+
+def _zc_deser_txout(txout, buf, pos):
+    txout.nAsset, pos = _zc_commitment(buf, pos, ASSET_COMMITMENT_SIZES, CTxOutAsset)
+    txout.nValue, pos = _zc_commitment(buf, pos, VALUE_COMMITMENT_SIZES, CTxOutValue)
+    txout.nNonce, pos = _zc_commitment(buf, pos, NONCE_COMMITMENT_SIZES, CTxOutNonce)
+    txout.scriptPubKey, pos = _zc_string(buf, pos)
+    return pos
+
+
+def _zc_deser_tx(tx, buf, pos):
+    tx.nVersion = _I32.unpack_from(buf, pos)[0]
+    flags = buf[pos + 4]
+    nit, pos = _zc_compact_size(buf, pos + 5)
+    vin = tx.vin = []
+    for _ in range(nit):
+        txin = CTxIn()
+        pos = _zc_deser_txin(txin, buf, pos)
+        vin.append(txin)
+    nit, pos = _zc_compact_size(buf, pos)
+    vout = tx.vout = []
+    for _ in range(nit):
+        # Every slot is assigned by _zc_deser_txout, skip the default values
+        txout = CTxOut.__new__(CTxOut)
+        pos = _zc_deser_txout(txout, buf, pos)
+        vout.append(txout)
+    tx.nLockTime = _U32.unpack_from(buf, pos)[0]
+    pos += 4
+    tx.wit = CTxWitness()
+    if flags & 1 > 0:
+        vtxinwit = tx.wit.vtxinwit
+        for _ in range(len(vin)):
+            wit = CTxInWitness()
+            wit.vchIssuanceAmountRangeproof, pos = _zc_string(buf, pos)
+            wit.vchInflationKeysRangeproof, pos = _zc_string(buf, pos)
+            wit.scriptWitness.stack, pos = _zc_string_vector(buf, pos)
+            wit.peginWitness.stack, pos = _zc_string_vector(buf, pos)
+            vtxinwit.append(wit)
+        vtxoutwit = tx.wit.vtxoutwit
+        for _ in range(len(vout)):
+            wit = CTxOutWitness.__new__(CTxOutWitness)
+            wit.vchSurjectionproof, pos = _zc_string(buf, pos)
+            wit.vchRangeproof, pos = _zc_string(buf, pos)
+            vtxoutwit.append(wit)
+    if flags > 1:
+        raise TypeError('Extra witness flags:' + str(flags))
+    tx.sha256 = None
+    tx.hash = None
+    return pos
+
+
+def from_hex(obj, hex_string, *, zero_copy=False):
     """Deserialize from a hex string representation (e.g. from RPC)
 
+    Pass zero_copy=True to parse through a ByteReader instead of a BytesIO.
+
     Note that there is no complementary helper like e.g. `to_hex` for the
     inverse operation. To serialize a message object to a hex string, simply
     use obj.serialize().hex()"""
-    obj.deserialize(BytesIO(bytes.fromhex(hex_string)))
+    return from_bytes(obj, bytes.fromhex(hex_string), zero_copy=zero_copy)
+
+
+def from_bytes(obj, data, *, zero_copy=False):
+    """Deserialize obj from a bytes-like object and return it
+
+    With zero_copy=True the data is parsed by walking a single memoryview (see
+    ByteReader), which is considerably faster for large blocks and
+    transactions. Both engines produce identical objects."""
+    obj.deserialize(ByteReader(data) if zero_copy else BytesIO(data))
     return obj
 
 
-def tx_from_hex(hex_string):
+def tx_from_hex(hex_string, *, zero_copy=False):
     """Deserialize from hex string to a transaction object"""
-    return from_hex(CTransaction(), hex_string)
+    return from_hex(CTransaction(), hex_string, zero_copy=zero_copy)
 
 
 # Objects that map to bitcoind objects, which can be serialized/deserialized
@@ -254,16 +513,18 @@ class CAddress:
 
     def serialize(self, *, with_time=True):
         """Serialize in addrv1 format (pre-BIP155)"""
+        return bytes(self.serialize_into(bytearray(), with_time=with_time))
+
+    def serialize_into(self, buf, *, with_time=True):
         assert self.net == self.NET_IPV4
-        r = b""
         if with_time:
             # VERSION messages serialize CAddress objects without time
-            r += struct.pack("<I", self.time)
-        r += struct.pack("<Q", self.nServices)
-        r += b"\x00" * 10 + b"\xff" * 2
-        r += socket.inet_aton(self.ip)
-        r += struct.pack(">H", self.port)
-        return r
+            buf += struct.pack("<I", self.time)
+        buf += struct.pack("<Q", self.nServices)
+        buf += b"\x00" * 10 + b"\xff" * 2
+        buf += socket.inet_aton(self.ip)
+        buf += struct.pack(">H", self.port)
+        return buf
 
     def deserialize_v2(self, f):
         """Deserialize from addrv2 format (BIP155)"""
@@ -287,20 +548,22 @@ class CAddress:
 
     def serialize_v2(self):
         """Serialize in addrv2 format (BIP155)"""
+        return bytes(self.serialize_v2_into(bytearray()))
+
+    def serialize_v2_into(self, buf):
         assert self.net in (self.NET_IPV4, self.NET_I2P)
-        r = b""
-        r += struct.pack("<I", self.time)
-        r += ser_compact_size(self.nServices)
-        r += struct.pack("B", self.net)
-        r += ser_compact_size(self.ADDRV2_ADDRESS_LENGTH[self.net])
+        buf += struct.pack("<I", self.time)
+        ser_compact_size_into(buf, self.nServices)
+        buf += struct.pack("B", self.net)
+        ser_compact_size_into(buf, self.ADDRV2_ADDRESS_LENGTH[self.net])
         if self.net == self.NET_IPV4:
-            r += socket.inet_aton(self.ip)
+            buf += socket.inet_aton(self.ip)
         else:
             sfx = ".b32.i2p"
             assert self.ip.endswith(sfx)
-            r += b32decode(self.ip[0:-len(sfx)] + self.I2P_PAD, True)
-        r += struct.pack(">H", self.port)
-        return r
+            buf += b32decode(self.ip[0:-len(sfx)] + self.I2P_PAD, True)
+        buf += struct.pack(">H", self.port)
+        return buf
 
     def __repr__(self):
         return ("CAddress(nServices=%i net=%s addr=%s port=%i)"
@@ -330,10 +593,12 @@ class CInv:
         self.hash = deser_uint256(f)
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<I", self.type)
-        r += ser_uint256(self.hash)
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        buf += struct.pack("<I", self.type)
+        ser_uint256_into(buf, self.hash)
+        return buf
 
     def __repr__(self):
         return "CInv(type=%s hash=%064x)" \
@@ -354,10 +619,12 @@ class CBlockLocator:
         self.vHave = deser_uint256_vector(f)
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<i", 0)  # Bitcoin Core ignores version field. Set it to 0.
-        r += ser_uint256_vector(self.vHave)
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        buf += struct.pack("<i", 0)  # Bitcoin Core ignores version field. Set it to 0.
+        ser_uint256_vector_into(buf, self.vHave)
+        return buf
 
     def __repr__(self):
         return "CBlockLocator(vHave=%s)" % (repr(self.vHave))
@@ -378,10 +645,12 @@ class COutPoint:
         self.n = struct.unpack("<I", f.read(4))[0]
 
     def serialize(self):
-        r = b""
-        r += ser_uint256(self.hash)
-        r += struct.pack("<I", self.n)
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        ser_uint256_into(buf, self.hash)
+        buf += struct.pack("<I", self.n)
+        return buf
 
     def __repr__(self):
         return "COutPoint(hash=%064x n=%i)" % (self.hash, self.n)
@@ -411,12 +680,14 @@ class CAssetIssuance():
         self.nInflationKeys.deserialize(f)
 
     def serialize(self):
-        r = b""
-        r += ser_uint256(self.assetBlindingNonce)
-        r += ser_uint256(self.assetEntropy)
-        r += self.nAmount.serialize()
-        r += self.nInflationKeys.serialize()
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        ser_uint256_into(buf, self.assetBlindingNonce)
+        ser_uint256_into(buf, self.assetEntropy)
+        ser_object_into(buf, self.nAmount)
+        ser_object_into(buf, self.nInflationKeys)
+        return buf
 
     # serialization of asset issuance used in taproot sighash
     def taphash_asset_issuance_serialize(self):
@@ -444,6 +715,9 @@ class CTxIn:
 
     def deserialize(self, f):
         self.prevout = COutPoint()
+        if type(f) is ByteReader:
+            f.pos = _zc_deser_txin(self, f.buf, f.pos)
+            return
         self.prevout.deserialize(f)
 
         has_asset_issuance = False
@@ -463,29 +737,36 @@ class CTxIn:
             self.assetIssuance.deserialize(f)
 
     def serialize(self):
-        outpoint = COutPoint()
-        outpoint.hash = self.prevout.hash
-        outpoint.n = self.prevout.n
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        n = self.prevout.n
         # First apply peg-in and issuance logic to prevout.n, before serializing
-        if self.prevout.n != 4294967295: # ignore coinbase for issuance/pegin
+        if n != 4294967295: # ignore coinbase for issuance/pegin
             if not self.assetIssuance.isNull():
-                outpoint.n |= OUTPOINT_ISSUANCE_FLAG
+                n |= OUTPOINT_ISSUANCE_FLAG
             if self.m_is_pegin:
-                outpoint.n |= OUTPOINT_PEGIN_FLAG
+                n |= OUTPOINT_PEGIN_FLAG
 
-        r = b""
-        r += outpoint.serialize()
-        r += ser_string(self.scriptSig)
-        r += struct.pack("<I", self.nSequence)
-        if self.prevout.n != 4294967295 and outpoint.n & OUTPOINT_ISSUANCE_FLAG:
-            r += self.assetIssuance.serialize()
-        return r
+        ser_uint256_into(buf, self.prevout.hash)
+        buf += _U32.pack(n)
+        ser_string_into(buf, self.scriptSig)
+        buf += _U32.pack(self.nSequence)
+        if self.prevout.n != 4294967295 and n & OUTPOINT_ISSUANCE_FLAG:
+            ser_object_into(buf, self.assetIssuance)
+        return buf
 
     def __repr__(self):
         return "CTxIn(prevout=%s scriptSig=%s nSequence=%i m_is_pegin=%s assetIssuance=%s)" \
             % (repr(self.prevout), self.scriptSig.hex(),
                self.nSequence, self.m_is_pegin, self.assetIssuance)
 
+# Payload length following each valid version byte of a confidential asset,
+# value or nonce commitment
+ASSET_COMMITMENT_SIZES = {0: 0, 1: 32, 0xff: 32, 10: 32, 11: 32}
+VALUE_COMMITMENT_SIZES = {0: 0, 1: 8, 0xff: 8, 8: 32, 9: 32}
+NONCE_COMMITMENT_SIZES = {0: 0, 1: 32, 0xff: 32, 2: 32, 3: 32}
+
 class CTxOutAsset:
     __slots__ = ("vchCommitment")
 
@@ -509,9 +790,11 @@ class CTxOutAsset:
             raise 'invalid CTxOutAsset in deserialize'
 
     def serialize(self):
-        r = b""
-        r += self.vchCommitment
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        buf += self.vchCommitment
+        return buf
 
     def setToAsset(self, val):
        if len(val) != 32:
@@ -549,11 +832,13 @@ class CTxOutValue:
             raise Exception('invalid CTxOutValue in deserialize. version %d' % version)
 
     def serialize(self):
-        r = b""
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
         if len(self.vchCommitment) < 1:
             raise ValueError('invalid commitment')
-        r += self.vchCommitment
-        return r
+        buf += self.vchCommitment
+        return buf
 
     def setToAmount(self, amount):
         if type(amount) == int:
@@ -601,9 +886,11 @@ class CTxOutNonce:
             raise ValueError('invalid CTxOutNonce in deserialize')
 
     def serialize(self):
-        r = b""
-        r += self.vchCommitment
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        buf += self.vchCommitment
+        return buf
 
     def __repr__(self):
         return "CTxOutNonce(vchCommitment=%s)" % self.vchCommitment
@@ -631,6 +918,9 @@ class CTxOut():
         return len(self.scriptPubKey) == 0
 
     def deserialize(self, f):
+        if type(f) is ByteReader:
+            f.pos = _zc_deser_txout(self, f.buf, f.pos)
+            return
         self.nAsset = CTxOutAsset()
         self.nAsset.deserialize(f)
         self.nValue = CTxOutValue()
@@ -640,12 +930,14 @@ class CTxOut():
         self.scriptPubKey = deser_string(f)
 
     def serialize(self):
-        r = b""
-        r += self.nAsset.serialize()
-        r += self.nValue.serialize()
-        r += self.nNonce.serialize()
-        r += ser_string(self.scriptPubKey)
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        ser_object_into(buf, self.nAsset)
+        ser_object_into(buf, self.nValue)
+        ser_object_into(buf, self.nNonce)
+        ser_string_into(buf, self.scriptPubKey)
+        return buf
 
     def from_pegin_witness_data(self, peg_witness):
         self.nAsset = CTxOutAsset()
@@ -693,12 +985,14 @@ class CTxInWitness:
         self.peginWitness.stack = deser_string_vector(f)
 
     def serialize(self):
-        r = b''
-        r += ser_string(self.vchIssuanceAmountRangeproof)
-        r += ser_string(self.vchInflationKeysRangeproof)
-        r += ser_string_vector(self.scriptWitness.stack)
-        r += ser_string_vector(self.peginWitness.stack)
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        ser_string_into(buf, self.vchIssuanceAmountRangeproof)
+        ser_string_into(buf, self.vchInflationKeysRangeproof)
+        ser_string_vector_into(buf, self.scriptWitness.stack)
+        ser_string_vector_into(buf, self.peginWitness.stack)
+        return buf
 
     # Used in taproot sighash calculation
     def serialize_issuance_proofs(self):
@@ -739,10 +1033,12 @@ class CTxOutWitness:
         self.vchRangeproof = deser_string(f)
 
     def serialize(self):
-        r = b''
-        r += ser_string(self.vchSurjectionproof)
-        r += ser_string(self.vchRangeproof)
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        ser_string_into(buf, self.vchSurjectionproof)
+        ser_string_into(buf, self.vchRangeproof)
+        return buf
 
     def calc_witness_hash(self):
         leaves = [
@@ -773,15 +1069,17 @@ class CTxWitness:
             self.vtxoutwit[i].deserialize(f)
 
     def serialize(self):
-        r = b""
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
         # This is different than the usual vector serialization --
         # we omit the length of the vector, which is required to be
         # the same length as the transaction's vin vector.
         for x in self.vtxinwit:
-            r += x.serialize()
+            ser_object_into(buf, x)
         for x in self.vtxoutwit:
-            r += x.serialize()
-        return r
+            ser_object_into(buf, x)
+        return buf
 
     def __repr__(self):
         return "CTxWitness([%s], [%s])" % \
@@ -800,7 +1098,7 @@ class CTxWitness:
 
 class CTransaction:
     __slots__ = ("hash", "nLockTime", "nVersion", "sha256", "vin", "vout",
-                 "wit")
+                 "wit", "_memo")
 
     def __init__(self, tx=None):
         if tx is None:
@@ -819,8 +1117,12 @@ class CTransaction:
             self.sha256 = tx.sha256
             self.hash = tx.hash
             self.wit = copy.deepcopy(tx.wit)
+        self._memo = None
 
     def deserialize(self, f):
+        if type(f) is ByteReader:
+            f.pos = _zc_deser_tx(self, f.buf, f.pos)
+            return
         self.nVersion = struct.unpack("<i", f.read(4))[0]
         flags = struct.unpack("<B", f.read(1))[0]
         self.vin = deser_vector(f, CTxIn)
@@ -837,27 +1139,85 @@ class CTransaction:
         self.sha256 = None
         self.hash = None
 
+    def _state(self):
+        """Snapshot of all serialized fields, or None if not memoizable
+
+        Only immutable values (ints and bytes) are recorded, so comparing the
+        snapshot with the one taken when a result was memoized detects any
+        change to the transaction, including in-place changes to the vin,
+        vout and witness lists. Taking it still walks the whole transaction,
+        but does not build or hash any bytes. Subclasses (e.g. in individual
+        tests) may serialize differently and are never memoized."""
+        wit = self.wit
+        if type(self) is not CTransaction or type(wit) is not CTxWitness:
+            return None
+        state = [self.nVersion, self.nLockTime, len(self.vin), len(self.vout),
+                 len(wit.vtxinwit), len(wit.vtxoutwit)]
+        for txin in self.vin:
+            if type(txin) is not CTxIn:
+                return None
+            prevout = txin.prevout
+            issuance = txin.assetIssuance
+            state += (prevout.hash, prevout.n, txin.scriptSig, txin.nSequence, txin.m_is_pegin,
+                      issuance.assetBlindingNonce, issuance.assetEntropy,
+                      issuance.nAmount.vchCommitment, issuance.nInflationKeys.vchCommitment)
+        for txout in self.vout:
+            if type(txout) is not CTxOut:
+                return None
+            state += (txout.nAsset.vchCommitment, txout.nValue.vchCommitment,
+                      txout.nNonce.vchCommitment, txout.scriptPubKey)
+        for txinwit in wit.vtxinwit:
+            if type(txinwit) is not CTxInWitness:
+                return None
+            stack = txinwit.scriptWitness.stack
+            pegin_stack = txinwit.peginWitness.stack
+            state += (txinwit.vchIssuanceAmountRangeproof, txinwit.vchInflationKeysRangeproof,
+                      len(stack), len(pegin_stack))
+            state += stack
+            state += pegin_stack
+        for txoutwit in wit.vtxoutwit:
+            if type(txoutwit) is not CTxOutWitness:
+                return None
+            state += (txoutwit.vchSurjectionproof, txoutwit.vchRangeproof)
+        return state
+
+    def _memoized(self, key, func):
+        """Return func(), reusing the last result for key as long as the
+        transaction has not been modified since"""
+        state = self._state()
+        if state is None:
+            return func()
+        memo = self._memo
+        if memo is None or memo[0] != state:
+            memo = self._memo = (state, {})
+        results = memo[1]
+        if key not in results:
+            results[key] = func()
+        return results[key]
+
     # Only applicable for non-CT, non-segwit transactions
     def serialize_without_witness(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += struct.pack("B", 0)
-        r += ser_vector(self.vin)
-        r += ser_vector(self.vout)
-        r += struct.pack("<I", self.nLockTime)
-        return r
+        return self._memoized("without_witness", lambda: bytes(self.serialize_into(bytearray(), with_witness=False)))
 
     # Only serialize with witness when explicitly called for
     def serialize_with_witness(self):
+        return self._memoized("with_witness", lambda: bytes(self.serialize_into(bytearray(), with_witness=True)))
+
+    def serialize(self, with_witness=True):
+        if with_witness:
+            return self.serialize_with_witness()
+        else:
+            return self.serialize_without_witness()
+
+    def serialize_into(self, buf, with_witness=True):
         flags = 0
-        if not self.wit.is_null():
+        if with_witness and not self.wit.is_null():
             flags |= 1
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += struct.pack("<B", flags)
-        r += ser_vector(self.vin)
-        r += ser_vector(self.vout)
-        r += struct.pack("<I", self.nLockTime)
+        buf += struct.pack("<i", self.nVersion)
+        buf += struct.pack("<B", flags)
+        ser_vector_into(buf, self.vin)
+        ser_vector_into(buf, self.vout)
+        buf += struct.pack("<I", self.nLockTime)
         if flags & 1:
             if len(self.wit.vtxinwit) != len(self.vin):
                 # vtxinwit must have the same length as vin
@@ -869,17 +1229,11 @@ class CTransaction:
                 self.wit.vtxoutwit = self.wit.vtxoutwit[:len(self.vout)]
                 for i in range(len(self.wit.vtxoutwit), len(self.vout)):
                     self.wit.vtxoutwit.append(CTxOutWitness())
-            r += self.wit.serialize()
-        return r
-
-    def serialize(self, with_witness=True):
-        if with_witness:
-            return self.serialize_with_witness()
-        else:
-            return self.serialize_without_witness()
+            ser_object_into(buf, self.wit)
+        return buf
 
     def getwtxid(self):
-        return hash256(self.serialize())[::-1].hex()
+        return self._memoized("wtxid", lambda: hash256(self.serialize())[::-1].hex())
 
     # Recalculate the txid (transaction hash without witness)
     def rehash(self):
@@ -891,12 +1245,13 @@ class CTransaction:
     # self.sha256 and self.hash -- those are expected to be the txid.
     def calc_sha256(self, with_witness=False):
         if with_witness:
-            # Don't cache the result, just return it
-            return uint256_from_str(hash256(self.serialize_with_witness()))
+            # Don't cache the result in self.sha256, just return it
+            return uint256_from_str(self._memoized("wtxid_raw", lambda: hash256(self.serialize_with_witness())))
 
+        txid = self._memoized("txid_raw", lambda: hash256(self.serialize_without_witness()))
         if self.sha256 is None:
-            self.sha256 = uint256_from_str(hash256(self.serialize_without_witness()))
-        self.hash = hash256(self.serialize_without_witness())[::-1].hex()
+            self.sha256 = uint256_from_str(txid)
+        self.hash = txid[::-1].hex()
 
     def calc_witness_hash(self):
         leaves = []
@@ -956,10 +1311,12 @@ class CProof:
         self.solution = deser_string(f)
 
     def serialize(self):
-        r = b""
-        r += ser_string(self.challenge)
-        r += ser_string(self.solution)
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        ser_string_into(buf, self.challenge)
+        ser_string_into(buf, self.solution)
+        return buf
 
     def serialize_for_hash(self):
         r = b""
@@ -1009,21 +1366,23 @@ class DynaFedParamEntry:
                 self.m_extension_space == []
 
     def serialize(self):
-        r = b""
-        r += struct.pack("B", self.m_serialize_type)
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        buf += struct.pack("B", self.m_serialize_type)
         if self.m_serialize_type == 1:
-            r += ser_string(self.m_signblockscript)
-            r += struct.pack("<I", self.m_signblock_witness_limit)
-            r += ser_uint256(self.m_elided_root)
+            ser_string_into(buf, self.m_signblockscript)
+            buf += struct.pack("<I", self.m_signblock_witness_limit)
+            ser_uint256_into(buf, self.m_elided_root)
         elif self.m_serialize_type == 2:
-            r += ser_string(self.m_signblockscript)
-            r += struct.pack("<I", self.m_signblock_witness_limit)
-            r += ser_string(self.m_fedpeg_program)
-            r += ser_string(self.m_fedpegscript)
-            r += ser_string_vector(self.m_extension_space)
+            ser_string_into(buf, self.m_signblockscript)
+            buf += struct.pack("<I", self.m_signblock_witness_limit)
+            ser_string_into(buf, self.m_fedpeg_program)
+            ser_string_into(buf, self.m_fedpegscript)
+            ser_string_vector_into(buf, self.m_extension_space)
         elif self.m_serialize_type > 2:
             raise Exception("Invalid serialization type for DynaFedParamEntry")
-        return r
+        return buf
 
     def deserialize(self, f):
         self.m_serialize_type = struct.unpack("B", f.read(1))[0]
@@ -1057,10 +1416,12 @@ class DynaFedParams:
         return self.m_current.is_null() and self.m_proposed.is_null()
 
     def serialize(self):
-        r = b""
-        r += self.m_current.serialize()
-        r += self.m_proposed.serialize()
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        ser_object_into(buf, self.m_current)
+        ser_object_into(buf, self.m_proposed)
+        return buf
 
     def deserialize(self, f):
         self.m_current.deserialize(f)
@@ -1107,17 +1468,26 @@ class CBlockHeader:
         self.hash = None
 
     def deserialize(self, f):
-        self.nVersion = struct.unpack("<i", f.read(4))[0]
-        is_dyna = False
+        if type(f) is ByteReader:
+            buf, pos = f.buf, f.pos
+            self.nVersion = _I32.unpack_from(buf, pos)[0]
+            self.hashPrevBlock = int.from_bytes(buf[pos + 4:pos + 36], "little")
+            self.hashMerkleRoot = int.from_bytes(buf[pos + 36:pos + 68], "little")
+            self.nTime = _U32.unpack_from(buf, pos + 68)[0]
+            self.block_height = _U32.unpack_from(buf, pos + 72)[0]
+            f.pos = pos + 76
+        else:
+            self.nVersion = struct.unpack("<i", f.read(4))[0]
+            self.hashPrevBlock = deser_uint256(f)
+            self.hashMerkleRoot = deser_uint256(f)
+            self.nTime = struct.unpack("<I", f.read(4))[0]
+            self.block_height = struct.unpack("<I", f.read(4))[0]
 
+        is_dyna = False
         if self.nVersion < 0:
             is_dyna = True
             self.nVersion = HEADER_DYNAFED_HF_MASK & self.nVersion
 
-        self.hashPrevBlock = deser_uint256(f)
-        self.hashMerkleRoot = deser_uint256(f)
-        self.nTime = struct.unpack("<I", f.read(4))[0]
-        self.block_height = struct.unpack("<I", f.read(4))[0]
         if is_dyna:
             self.m_dynafed_params.deserialize(f)
             self.m_signblock_witness.stack = deser_string_vector(f)
@@ -1127,24 +1497,28 @@ class CBlockHeader:
         self.hash = None
 
     def serialize(self):
-        r = b""
+        # Not dispatched through self, so that subclasses of CBlock can still
+        # serialize just the header with super(CBlock, self).serialize()
+        return bytes(CBlockHeader.serialize_into(self, bytearray()))
+
+    def serialize_into(self, buf):
         nVersion = self.nVersion
         is_dyna = False
         if not self.m_dynafed_params.is_null():
             nVersion -= HEADER_HF_BIT
             is_dyna = True
 
-        r += struct.pack("<i", nVersion)
-        r += ser_uint256(self.hashPrevBlock)
-        r += ser_uint256(self.hashMerkleRoot)
-        r += struct.pack("<I", self.nTime)
-        r += struct.pack("<I", self.block_height)
+        buf += struct.pack("<i", nVersion)
+        ser_uint256_into(buf, self.hashPrevBlock)
+        ser_uint256_into(buf, self.hashMerkleRoot)
+        buf += struct.pack("<I", self.nTime)
+        buf += struct.pack("<I", self.block_height)
         if is_dyna:
-            r += self.m_dynafed_params.serialize()
-            r += ser_string_vector(self.m_signblock_witness.stack)
+            ser_object_into(buf, self.m_dynafed_params)
+            ser_string_vector_into(buf, self.m_signblock_witness.stack)
         else:
-            r += self.proof.serialize()
-        return r
+            ser_object_into(buf, self.proof)
+        return buf
 
     def calc_sha256(self):
         if self.sha256 is None:
@@ -1192,13 +1566,15 @@ class CBlock(CBlockHeader):
         self.vtx = deser_vector(f, CTransaction)
 
     def serialize(self, with_witness=True):
-        r = b""
-        r += super().serialize()
+        return bytes(self.serialize_into(bytearray(), with_witness=with_witness))
+
+    def serialize_into(self, buf, with_witness=True):
+        super().serialize_into(buf)
         if with_witness:
-            r += ser_vector(self.vtx, "serialize_with_witness")
+            ser_vector_into(buf, self.vtx, "serialize_with_witness")
         else:
-            r += ser_vector(self.vtx, "serialize_without_witness")
-        return r
+            ser_vector_into(buf, self.vtx, "serialize_without_witness")
+        return buf
 
     # Calculate the merkle root given a vector of transaction hashes
     @classmethod
@@ -1273,13 +1649,15 @@ class PrefilledTransaction:
         self.tx.deserialize(f)
 
     def serialize(self, with_witness=True):
-        r = b""
-        r += ser_compact_size(self.index)
+        return bytes(self.serialize_into(bytearray(), with_witness=with_witness))
+
+    def serialize_into(self, buf, with_witness=True):
+        ser_compact_size_into(buf, self.index)
         if with_witness:
-            r += self.tx.serialize_with_witness()
+            ser_object_into(buf, self.tx, "serialize_with_witness")
         else:
-            r += self.tx.serialize_without_witness()
-        return r
+            ser_object_into(buf, self.tx, "serialize_without_witness")
+        return buf
 
     def serialize_without_witness(self):
         return self.serialize(with_witness=False)
@@ -1317,18 +1695,20 @@ class P2PHeaderAndShortIDs:
 
     # When using version 2 compact blocks, we must serialize with_witness.
     def serialize(self, with_witness=False):
-        r = b""
-        r += self.header.serialize()
-        r += struct.pack("<Q", self.nonce)
-        r += ser_compact_size(self.shortids_length)
+        return bytes(self.serialize_into(bytearray(), with_witness=with_witness))
+
+    def serialize_into(self, buf, with_witness=False):
+        ser_object_into(buf, self.header)
+        buf += struct.pack("<Q", self.nonce)
+        ser_compact_size_into(buf, self.shortids_length)
         for x in self.shortids:
             # We only want the first 6 bytes
-            r += struct.pack("<Q", x)[0:6]
+            buf += struct.pack("<Q", x)[0:6]
         if with_witness:
-            r += ser_vector(self.prefilled_txn, "serialize_with_witness")
+            ser_vector_into(buf, self.prefilled_txn, "serialize_with_witness")
         else:
-            r += ser_vector(self.prefilled_txn, "serialize_without_witness")
-        return r
+            ser_vector_into(buf, self.prefilled_txn, "serialize_without_witness")
+        return buf
 
     def __repr__(self):
         return "P2PHeaderAndShortIDs(header=%s, nonce=%d, shortids_length=%d, shortids=%s, prefilled_txn_length=%d, prefilledtxn=%s" % (repr(self.header), self.nonce, self.shortids_length, repr(self.shortids), self.prefilled_txn_length, repr(self.prefilled_txn))
@@ -1341,6 +1721,9 @@ class P2PHeaderAndShortWitnessIDs(P2PHeaderAndShortIDs):
     def serialize(self):
         return super().serialize(with_witness=True)
 
+    def serialize_into(self, buf):
+        return super().serialize_into(buf, with_witness=True)
+
 # Calculate the BIP 152-compact blocks shortid for a given transaction hash
 def calculate_shortid(k0, k1, tx_hash):
     expected_shortid = siphash256(k0, k1, tx_hash)
@@ -1348,6 +1731,11 @@ def calculate_shortid(k0, k1, tx_hash):
     return expected_shortid
 
 
+# Calculate the shortids for a list of transaction hashes all at once
+def calculate_shortids(k0, k1, tx_hashes):
+    return [shortid & 0x0000ffffffffffff for shortid in siphash256_many(k0, k1, tx_hashes)]
+
+
 # This version gets rid of the array lengths, and reinterprets the differential
 # encoding into indices that can be used for lookup.
 class HeaderAndShortIDs:
@@ -1401,15 +1789,16 @@ class HeaderAndShortIDs:
         self.header = CBlockHeader(block)
         self.nonce = nonce
         self.prefilled_txn = [ PrefilledTransaction(i, block.vtx[i]) for i in prefill_list ]
-        self.shortids = []
         self.use_witness = use_witness
         [k0, k1] = self.get_siphash_keys()
+        tx_hashes = []
         for i in range(len(block.vtx)):
             if i not in prefill_list:
                 tx_hash = block.vtx[i].sha256
                 if use_witness:
                     tx_hash = block.vtx[i].calc_sha256(with_witness=True)
-                self.shortids.append(calculate_shortid(k0, k1, tx_hash))
+                tx_hashes.append(tx_hash)
+        self.shortids = calculate_shortids(k0, k1, tx_hashes)
 
     def __repr__(self):
         return "HeaderAndShortIDs(header=%s, nonce=%d, shortids=%s, prefilledtxn=%s" % (repr(self.header), self.nonce, repr(self.shortids), repr(self.prefilled_txn))
@@ -1429,12 +1818,14 @@ class BlockTransactionsRequest:
             self.indexes.append(deser_compact_size(f))
 
     def serialize(self):
-        r = b""
-        r += ser_uint256(self.blockhash)
-        r += ser_compact_size(len(self.indexes))
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        ser_uint256_into(buf, self.blockhash)
+        ser_compact_size_into(buf, len(self.indexes))
         for x in self.indexes:
-            r += ser_compact_size(x)
-        return r
+            ser_compact_size_into(buf, x)
+        return buf
 
     # helper to set the differentially encoded indexes from absolute ones
     def from_absolute(self, absolute_indexes):
@@ -1468,13 +1859,15 @@ class BlockTransactions:
         self.transactions = deser_vector(f, CTransaction)
 
     def serialize(self, with_witness=True):
-        r = b""
-        r += ser_uint256(self.blockhash)
+        return bytes(self.serialize_into(bytearray(), with_witness=with_witness))
+
+    def serialize_into(self, buf, with_witness=True):
+        ser_uint256_into(buf, self.blockhash)
         if with_witness:
-            r += ser_vector(self.transactions, "serialize_with_witness")
+            ser_vector_into(buf, self.transactions, "serialize_with_witness")
         else:
-            r += ser_vector(self.transactions, "serialize_without_witness")
-        return r
+            ser_vector_into(buf, self.transactions, "serialize_without_witness")
+        return buf
 
     def __repr__(self):
         return "BlockTransactions(hash=%064x transactions=%s)" % (self.blockhash, repr(self.transactions))
@@ -1497,14 +1890,16 @@ class CPartialMerkleTree:
             self.vBits.append(vBytes[i//8] & (1 << (i % 8)) != 0)
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<i", self.nTransactions)
-        r += ser_uint256_vector(self.vHash)
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        buf += struct.pack("<i", self.nTransactions)
+        ser_uint256_vector_into(buf, self.vHash)
         vBytesArray = bytearray([0x00] * ((len(self.vBits) + 7)//8))
         for i in range(len(self.vBits)):
             vBytesArray[i // 8] |= self.vBits[i] << (i % 8)
-        r += ser_string(bytes(vBytesArray))
-        return r
+        ser_string_into(buf, bytes(vBytesArray))
+        return buf
 
     def __repr__(self):
         return "CPartialMerkleTree(nTransactions=%d, vHash=%s, vBits=%s)" % (self.nTransactions, repr(self.vHash), repr(self.vBits))
@@ -1522,10 +1917,12 @@ class CMerkleBlock:
         self.txn.deserialize(f)
 
     def serialize(self):
-        r = b""
-        r += self.header.serialize()
-        r += self.txn.serialize()
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        ser_object_into(buf, self.header)
+        ser_object_into(buf, self.txn)
+        return buf
 
     def __repr__(self):
         return "CMerkleBlock(header=%s, txn=%s)" % (repr(self.header), repr(self.txn))
@@ -1570,17 +1967,19 @@ class msg_version:
             self.relay = 0
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += struct.pack("<Q", self.nServices)
-        r += struct.pack("<q", self.nTime)
-        r += self.addrTo.serialize(with_time=False)
-        r += self.addrFrom.serialize(with_time=False)
-        r += struct.pack("<Q", self.nNonce)
-        r += ser_string(self.strSubVer.encode('utf-8'))
-        r += struct.pack("<i", self.nStartingHeight)
-        r += struct.pack("<b", self.relay)
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        buf += struct.pack("<i", self.nVersion)
+        buf += struct.pack("<Q", self.nServices)
+        buf += struct.pack("<q", self.nTime)
+        ser_object_into(buf, self.addrTo, with_time=False)
+        ser_object_into(buf, self.addrFrom, with_time=False)
+        buf += struct.pack("<Q", self.nNonce)
+        ser_string_into(buf, self.strSubVer.encode('utf-8'))
+        buf += struct.pack("<i", self.nStartingHeight)
+        buf += struct.pack("<b", self.relay)
+        return buf
 
     def __repr__(self):
         return 'msg_version(nVersion=%i nServices=%i nTime=%s addrTo=%s addrFrom=%s nNonce=0x%016X strSubVer=%s nStartingHeight=%i relay=%i)' \
@@ -1602,6 +2001,9 @@ class msg_verack:
     def serialize(self):
         return b""
 
+    def serialize_into(self, buf):
+        return buf
+
     def __repr__(self):
         return "msg_verack()"
 
@@ -1617,7 +2019,10 @@ class msg_addr:
         self.addrs = deser_vector(f, CAddress)
 
     def serialize(self):
-        return ser_vector(self.addrs)
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        return ser_vector_into(buf, self.addrs)
 
     def __repr__(self):
         return "msg_addr(addrs=%s)" % (repr(self.addrs))
@@ -1634,7 +2039,10 @@ class msg_addrv2:
         self.addrs = deser_vector(f, CAddress, "deserialize_v2")
 
     def serialize(self):
-        return ser_vector(self.addrs, "serialize_v2")
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        return ser_vector_into(buf, self.addrs, "serialize_v2")
 
     def __repr__(self):
         return "msg_addrv2(addrs=%s)" % (repr(self.addrs))
@@ -1653,6 +2061,9 @@ class msg_sendaddrv2:
     def serialize(self):
         return b""
 
+    def serialize_into(self, buf):
+        return buf
+
     def __repr__(self):
         return "msg_sendaddrv2()"
 
@@ -1671,7 +2082,10 @@ class msg_inv:
         self.inv = deser_vector(f, CInv)
 
     def serialize(self):
-        return ser_vector(self.inv)
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        return ser_vector_into(buf, self.inv)
 
     def __repr__(self):
         return "msg_inv(inv=%s)" % (repr(self.inv))
@@ -1688,7 +2102,10 @@ class msg_getdata:
         self.inv = deser_vector(f, CInv)
 
     def serialize(self):
-        return ser_vector(self.inv)
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        return ser_vector_into(buf, self.inv)
 
     def __repr__(self):
         return "msg_getdata(inv=%s)" % (repr(self.inv))
@@ -1708,10 +2125,12 @@ class msg_getblocks:
         self.hashstop = deser_uint256(f)
 
     def serialize(self):
-        r = b""
-        r += self.locator.serialize()
-        r += ser_uint256(self.hashstop)
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        ser_object_into(buf, self.locator)
+        ser_uint256_into(buf, self.hashstop)
+        return buf
 
     def __repr__(self):
         return "msg_getblocks(locator=%s hashstop=%064x)" \
@@ -1729,7 +2148,10 @@ class msg_tx:
         self.tx.deserialize(f)
 
     def serialize(self):
-        return self.tx.serialize_with_witness()
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        return ser_object_into(buf, self.tx, "serialize_with_witness")
 
     def __repr__(self):
         return "msg_tx(tx=%s)" % (repr(self.tx))
@@ -1747,6 +2169,9 @@ class msg_wtxidrelay:
     def serialize(self):
         return b""
 
+    def serialize_into(self, buf):
+        return buf
+
     def __repr__(self):
         return "msg_wtxidrelay()"
 
@@ -1755,7 +2180,10 @@ class msg_no_witness_tx(msg_tx):
     __slots__ = ()
 
     def serialize(self):
-        return self.tx.serialize_without_witness()
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        return ser_object_into(buf, self.tx, "serialize_without_witness")
 
 
 class msg_block:
@@ -1772,7 +2200,10 @@ class msg_block:
         self.block.deserialize(f)
 
     def serialize(self):
-        return self.block.serialize()
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        return ser_object_into(buf, self.block)
 
     def __repr__(self):
         return "msg_block(block=%s)" % (repr(self.block))
@@ -1790,6 +2221,10 @@ class msg_generic:
     def serialize(self):
         return self.data
 
+    def serialize_into(self, buf):
+        buf += self.data
+        return buf
+
     def __repr__(self):
         return "msg_generic()"
 
@@ -1797,7 +2232,10 @@ class msg_generic:
 class msg_no_witness_block(msg_block):
     __slots__ = ()
     def serialize(self):
-        return self.block.serialize(with_witness=False)
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        return ser_object_into(buf, self.block, with_witness=False)
 
 
 class msg_getaddr:
@@ -1813,6 +2251,9 @@ class msg_getaddr:
     def serialize(self):
         return b""
 
+    def serialize_into(self, buf):
+        return buf
+
     def __repr__(self):
         return "msg_getaddr()"
 
@@ -1828,9 +2269,11 @@ class msg_ping:
         self.nonce = struct.unpack("<Q", f.read(8))[0]
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<Q", self.nonce)
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        buf += struct.pack("<Q", self.nonce)
+        return buf
 
     def __repr__(self):
         return "msg_ping(nonce=%08x)" % self.nonce
@@ -1847,9 +2290,11 @@ class msg_pong:
         self.nonce = struct.unpack("<Q", f.read(8))[0]
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<Q", self.nonce)
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        buf += struct.pack("<Q", self.nonce)
+        return buf
 
     def __repr__(self):
         return "msg_pong(nonce=%08x)" % self.nonce
@@ -1868,6 +2313,9 @@ class msg_mempool:
     def serialize(self):
         return b""
 
+    def serialize_into(self, buf):
+        return buf
+
     def __repr__(self):
         return "msg_mempool()"
 
@@ -1883,7 +2331,10 @@ class msg_notfound:
         self.vec = deser_vector(f, CInv)
 
     def serialize(self):
-        return ser_vector(self.vec)
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        return ser_vector_into(buf, self.vec)
 
     def __repr__(self):
         return "msg_notfound(vec=%s)" % (repr(self.vec))
@@ -1902,6 +2353,9 @@ class msg_sendheaders:
     def serialize(self):
         return b""
 
+    def serialize_into(self, buf):
+        return buf
+
     def __repr__(self):
         return "msg_sendheaders()"
 
@@ -1924,10 +2378,12 @@ class msg_getheaders:
         self.hashstop = deser_uint256(f)
 
     def serialize(self):
-        r = b""
-        r += self.locator.serialize()
-        r += ser_uint256(self.hashstop)
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        ser_object_into(buf, self.locator)
+        ser_uint256_into(buf, self.hashstop)
+        return buf
 
     def __repr__(self):
         return "msg_getheaders(locator=%s, stop=%064x)" \
@@ -1950,8 +2406,11 @@ class msg_headers:
             self.headers.append(CBlockHeader(x))
 
     def serialize(self):
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
         blocks = [CBlock(x) for x in self.headers]
-        return ser_vector(blocks)
+        return ser_vector_into(buf, blocks)
 
     def __repr__(self):
         return "msg_headers(headers=%s)" % repr(self.headers)
@@ -1971,7 +2430,10 @@ class msg_merkleblock:
         self.merkleblock.deserialize(f)
 
     def serialize(self):
-        return self.merkleblock.serialize()
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        return ser_object_into(buf, self.merkleblock)
 
     def __repr__(self):
         return "msg_merkleblock(merkleblock=%s)" % (repr(self.merkleblock))
@@ -1994,12 +2456,14 @@ class msg_filterload:
         self.nFlags = struct.unpack("<B", f.read(1))[0]
 
     def serialize(self):
-        r = b""
-        r += ser_string(self.data)
-        r += struct.pack("<I", self.nHashFuncs)
-        r += struct.pack("<I", self.nTweak)
-        r += struct.pack("<B", self.nFlags)
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        ser_string_into(buf, self.data)
+        buf += struct.pack("<I", self.nHashFuncs)
+        buf += struct.pack("<I", self.nTweak)
+        buf += struct.pack("<B", self.nFlags)
+        return buf
 
     def __repr__(self):
         return "msg_filterload(data={}, nHashFuncs={}, nTweak={}, nFlags={})".format(
@@ -2017,9 +2481,11 @@ class msg_filteradd:
         self.data = deser_string(f)
 
     def serialize(self):
-        r = b""
-        r += ser_string(self.data)
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        ser_string_into(buf, self.data)
+        return buf
 
     def __repr__(self):
         return "msg_filteradd(data={})".format(self.data)
@@ -2038,6 +2504,9 @@ class msg_filterclear:
     def serialize(self):
         return b""
 
+    def serialize_into(self, buf):
+        return buf
+
     def __repr__(self):
         return "msg_filterclear()"
 
@@ -2053,9 +2522,11 @@ class msg_feefilter:
         self.feerate = struct.unpack("<Q", f.read(8))[0]
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<Q", self.feerate)
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        buf += struct.pack("<Q", self.feerate)
+        return buf
 
     def __repr__(self):
         return "msg_feefilter(feerate=%08x)" % self.feerate
@@ -2074,10 +2545,12 @@ class msg_sendcmpct:
         self.version = struct.unpack("<Q", f.read(8))[0]
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<?", self.announce)
-        r += struct.pack("<Q", self.version)
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        buf += struct.pack("<?", self.announce)
+        buf += struct.pack("<Q", self.version)
+        return buf
 
     def __repr__(self):
         return "msg_sendcmpct(announce=%s, version=%lu)" % (self.announce, self.version)
@@ -2095,9 +2568,11 @@ class msg_cmpctblock:
         self.header_and_shortids.deserialize(f)
 
     def serialize(self):
-        r = b""
-        r += self.header_and_shortids.serialize()
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        ser_object_into(buf, self.header_and_shortids)
+        return buf
 
     def __repr__(self):
         return "msg_cmpctblock(HeaderAndShortIDs=%s)" % repr(self.header_and_shortids)
@@ -2115,9 +2590,11 @@ class msg_getblocktxn:
         self.block_txn_request.deserialize(f)
 
     def serialize(self):
-        r = b""
-        r += self.block_txn_request.serialize()
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        ser_object_into(buf, self.block_txn_request)
+        return buf
 
     def __repr__(self):
         return "msg_getblocktxn(block_txn_request=%s)" % (repr(self.block_txn_request))
@@ -2134,9 +2611,11 @@ class msg_blocktxn:
         self.block_transactions.deserialize(f)
 
     def serialize(self):
-        r = b""
-        r += self.block_transactions.serialize()
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        ser_object_into(buf, self.block_transactions)
+        return buf
 
     def __repr__(self):
         return "msg_blocktxn(block_transactions=%s)" % (repr(self.block_transactions))
@@ -2146,7 +2625,10 @@ class msg_no_witness_blocktxn(msg_blocktxn):
     __slots__ = ()
 
     def serialize(self):
-        return self.block_transactions.serialize(with_witness=False)
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        return ser_object_into(buf, self.block_transactions, with_witness=False)
 
 
 class msg_getcfilters:
@@ -2164,11 +2646,13 @@ class msg_getcfilters:
         self.stop_hash = deser_uint256(f)
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<B", self.filter_type)
-        r += struct.pack("<I", self.start_height)
-        r += ser_uint256(self.stop_hash)
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        buf += struct.pack("<B", self.filter_type)
+        buf += struct.pack("<I", self.start_height)
+        ser_uint256_into(buf, self.stop_hash)
+        return buf
 
     def __repr__(self):
         return "msg_getcfilters(filter_type={:#x}, start_height={}, stop_hash={:x})".format(
@@ -2189,11 +2673,13 @@ class msg_cfilter:
         self.filter_data = deser_string(f)
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<B", self.filter_type)
-        r += ser_uint256(self.block_hash)
-        r += ser_string(self.filter_data)
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        buf += struct.pack("<B", self.filter_type)
+        ser_uint256_into(buf, self.block_hash)
+        ser_string_into(buf, self.filter_data)
+        return buf
 
     def __repr__(self):
         return "msg_cfilter(filter_type={:#x}, block_hash={:x})".format(
@@ -2214,11 +2700,13 @@ class msg_getcfheaders:
         self.stop_hash = deser_uint256(f)
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<B", self.filter_type)
-        r += struct.pack("<I", self.start_height)
-        r += ser_uint256(self.stop_hash)
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        buf += struct.pack("<B", self.filter_type)
+        buf += struct.pack("<I", self.start_height)
+        ser_uint256_into(buf, self.stop_hash)
+        return buf
 
     def __repr__(self):
         return "msg_getcfheaders(filter_type={:#x}, start_height={}, stop_hash={:x})".format(
@@ -2241,12 +2729,14 @@ class msg_cfheaders:
         self.hashes = deser_uint256_vector(f)
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<B", self.filter_type)
-        r += ser_uint256(self.stop_hash)
-        r += ser_uint256(self.prev_header)
-        r += ser_uint256_vector(self.hashes)
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        buf += struct.pack("<B", self.filter_type)
+        ser_uint256_into(buf, self.stop_hash)
+        ser_uint256_into(buf, self.prev_header)
+        ser_uint256_vector_into(buf, self.hashes)
+        return buf
 
     def __repr__(self):
         return "msg_cfheaders(filter_type={:#x}, stop_hash={:x})".format(
@@ -2265,10 +2755,12 @@ class msg_getcfcheckpt:
         self.stop_hash = deser_uint256(f)
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<B", self.filter_type)
-        r += ser_uint256(self.stop_hash)
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        buf += struct.pack("<B", self.filter_type)
+        ser_uint256_into(buf, self.stop_hash)
+        return buf
 
     def __repr__(self):
         return "msg_getcfcheckpt(filter_type={:#x}, stop_hash={:x})".format(
@@ -2289,12 +2781,141 @@ class msg_cfcheckpt:
         self.headers = deser_uint256_vector(f)
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<B", self.filter_type)
-        r += ser_uint256(self.stop_hash)
-        r += ser_uint256_vector(self.headers)
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        buf += struct.pack("<B", self.filter_type)
+        ser_uint256_into(buf, self.stop_hash)
+        ser_uint256_vector_into(buf, self.headers)
+        return buf
 
     def __repr__(self):
         return "msg_cfcheckpt(filter_type={:#x}, stop_hash={:x})".format(
             self.filter_type, self.stop_hash)
+
+
+class TestFrameworkMessages(unittest.TestCase):
+    def check_zero_copy(self, obj_class, data):
+        reference = from_bytes(obj_class(), data)
+        parsed = from_bytes(obj_class(), data, zero_copy=True)
+        self.assertEqual(repr(parsed), repr(reference))
+        self.assertEqual(parsed.serialize(), data)
+
+    def test_zero_copy_deserialize(self):
+        tx = CTransaction()
+        tx.vin.append(CTxIn(COutPoint(0x1234, 1), b"\x51", 0xfffffffe))
+        tx.vin[0].assetIssuance.assetEntropy = 0xabcd
+        tx.vin[0].assetIssuance.nAmount = CTxOutValue(5 * COIN)
+        tx.vin[0].assetIssuance.nInflationKeys.vchCommitment = b"\x09" + b"\x11" * 32
+        tx.vin.append(CTxIn(COutPoint(0x5678, 0)))
+        tx.vin[1].m_is_pegin = True
+        tx.vout.append(CTxOut(CTxOutValue(), b"\x00\x14" + b"\x22" * 20, CTxOutAsset(b"\x0a" + b"\x33" * 32), CTxOutNonce(b"\x02" + b"\x44" * 32)))
+        tx.vout[0].nValue.vchCommitment = b"\x08" + b"\x55" * 32
+        tx.vout.append(CTxOut(1000))
+        self.check_zero_copy(CTransaction, tx.serialize())
+
+        tx.wit.vtxinwit = [CTxInWitness(), CTxInWitness()]
+        tx.wit.vtxinwit[0].vchIssuanceAmountRangeproof = b"\x66" * 300
+        tx.wit.vtxinwit[1].peginWitness.stack = [b"\x77" * 8, b"", b"\x88" * 33]
+        tx.wit.vtxoutwit = [CTxOutWitness(), CTxOutWitness()]
+        tx.wit.vtxoutwit[0].vchRangeproof = b"\x99" * 70000
+        self.check_zero_copy(CTransaction, tx.serialize())
+
+        coinbase = CTransaction()
+        coinbase.vin.append(CTxIn(COutPoint(0, 0xffffffff), b"\x01\x01"))
+        coinbase.vout.append(CTxOut(0, b"\x6a"))
+        block = CBlock()
+        block.vtx = [coinbase, tx]
+        block.hashMerkleRoot = block.calc_merkle_root()
+        self.check_zero_copy(CBlock, block.serialize())
+        self.check_zero_copy(msg_block, msg_block(block).serialize())
+
+    def test_serialize_into(self):
+        tx = CTransaction()
+        tx.vin.append(CTxIn(COutPoint(0x1234, 1), b"\x51"))
+        tx.vin[0].assetIssuance.nAmount = CTxOutValue(5 * COIN)
+        tx.vout.append(CTxOut(1000, b"\x51"))
+        tx.wit.vtxinwit.append(CTxInWitness())
+        tx.wit.vtxinwit[0].scriptWitness.stack = [b"\x01" * 72]
+        block = CBlock()
+        block.vtx = [tx]
+        buf = bytearray(b"\xff")
+        self.assertIs(block.serialize_into(buf), buf)
+        self.assertEqual(bytes(buf), b"\xff" + block.serialize())
+        self.assertEqual(msg_no_witness_block(block).serialize(), block.serialize(with_witness=False))
+
+        # Subclasses overriding only the bytes-returning serializer are honoured
+        class EmptyScriptSigTxIn(CTxIn):
+            def serialize(self):
+                return CTxIn(self.prevout, b"", self.nSequence).serialize()
+        expected = CTransaction(tx)
+        expected.vin[0] = CTxIn(COutPoint(0x1234, 1), b"")
+        tx.vin[0] = EmptyScriptSigTxIn(COutPoint(0x1234, 1), b"\x51")
+        self.assertEqual(msg_tx(tx).serialize(), expected.serialize())
+
+    def test_memoized_hashes(self):
+        def fresh(tx):
+            return CTransaction(tx)  # a copy has an empty memo
+        tx = CTransaction()
+        tx.vin.append(CTxIn(COutPoint(0x1234, 1), b"\x51"))
+        tx.vout.append(CTxOut(1000, b"\x51"))
+        tx.rehash()
+        txid, wtxid, weight = tx.hash, tx.getwtxid(), tx.get_weight()
+        self.assertEqual(tx.serialize_without_witness(), fresh(tx).serialize_without_witness())
+
+        # In-place changes anywhere in the transaction invalidate the memo
+        tx.vout[0].nValue.setToAmount(999)
+        self.assertNotEqual(tx.rehash(), txid)
+        self.assertEqual(tx.hash, fresh(tx).rehash())
+        tx.wit.vtxinwit.append(CTxInWitness())
+        tx.wit.vtxinwit[0].scriptWitness.stack.append(b"\x01" * 72)
+        self.assertNotEqual(tx.getwtxid(), wtxid)
+        self.assertEqual(tx.getwtxid(), fresh(tx).getwtxid())
+        self.assertNotEqual(tx.get_weight(), weight)
+        self.assertEqual(tx.get_weight(), fresh(tx).get_weight())
+        tx.vin[0].scriptSig = b"\x52"
+        self.assertEqual(tx.calc_sha256(with_witness=True), fresh(tx).calc_sha256(with_witness=True))
+
+        # getwtxid() is recomputed after replacing a witness stack item, and
+        # after changing an output value, in place
+        wtxid = tx.getwtxid()
+        tx.wit.vtxinwit[0].scriptWitness.stack[0] = b"\x02" * 72
+        self.assertNotEqual(tx.getwtxid(), wtxid)
+        self.assertEqual(tx.getwtxid(), fresh(tx).getwtxid())
+        wtxid = tx.getwtxid()
+        tx.vout[0].nValue.setToAmount(998)
+        self.assertNotEqual(tx.getwtxid(), wtxid)
+        self.assertEqual(tx.getwtxid(), fresh(tx).getwtxid())
+
+        # A manually set sha256 is kept until rehash(), as before
+        tx.sha256 = 1
+        tx.calc_sha256()
+        self.assertEqual(tx.sha256, 1)
+        self.assertEqual(tx.rehash(), fresh(tx).rehash())
+
+    def test_uint256_compact_size_codecs(self):
+        for u in (0, 1, 0xffffffff, (1 << 256) - 1, 1 << 256 | 5, -1):
+            expected = b"".join(struct.pack("<I", (u >> (32 * i)) & 0xffffffff) for i in range(8))
+            self.assertEqual(ser_uint256(u), expected)
+            self.assertEqual(ser_uint256_into(bytearray(), u), expected)
+            self.assertEqual(uint256_from_str(expected + b"\xff"), u & ((1 << 256) - 1))
+            self.assertEqual(deser_uint256(BytesIO(expected)), u & ((1 << 256) - 1))
+        self.assertEqual(ser_uint256_vector([1, 2]), b"\x02" + ser_uint256(1) + ser_uint256(2))
+        self.assertEqual(deser_uint256_vector(BytesIO(ser_uint256_vector([1, 2]))), [1, 2])
+        with self.assertRaises(struct.error):
+            deser_uint256(BytesIO(b"\x00" * 31))
+        with self.assertRaises(struct.error):
+            uint256_from_str(b"\x00" * 31)
+        for n, encoded in ((252, "fc"), (253, "fdfd00"), (0xffff, "fdffff"), (0x10000, "fe00000100"),
+                           (0x100000000, "ff0000000001000000")):
+            self.assertEqual(ser_compact_size(n).hex(), encoded)
+            self.assertEqual(deser_compact_size(BytesIO(bytes.fromhex(encoded))), n)
+
+    def test_zero_copy_truncated(self):
+        tx = CTransaction()
+        tx.vin.append(CTxIn(COutPoint(1, 0)))
+        tx.vout.append(CTxOut(1000, b"\x51"))
+        data = tx.serialize()
+        for end in (3, 20, len(data) - 5, len(data) - 1):
+            with self.assertRaises((IndexError, struct.error)):
+                from_bytes(CTransaction(), data[:end], zero_copy=True)
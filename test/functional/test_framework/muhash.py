@@ -13,20 +13,23 @@ def rot32(v, bits):
     bits %= 32  # Make sure the term below does not throw an exception
     return ((v << bits) & 0xffffffff) | (v >> (32 - bits))
 
+QUARTER_ROUNDS = [(0, 4, 8, 12),
+                  (1, 5, 9, 13),
+                  (2, 6, 10, 14),
+                  (3, 7, 11, 15),
+                  (0, 5, 10, 15),
+                  (1, 6, 11, 12),
+                  (2, 7, 8, 13),
+                  (3, 4, 9, 14)]
+
+# See RFC 8439 section 2.3 for chacha20 parameters
+CHACHA20_CONSTANTS = [0x61707865, 0x3320646e, 0x79622d32, 0x6b206574]
+
 def chacha20_doubleround(s):
     """Apply a ChaCha20 double round to 16-element state array s.
 
     See https://cr.yp.to/chacha/chacha-20080128.pdf and https://tools.ietf.org/html/rfc8439
     """
-    QUARTER_ROUNDS = [(0, 4, 8, 12),
-                      (1, 5, 9, 13),
-                      (2, 6, 10, 14),
-                      (3, 7, 11, 15),
-                      (0, 5, 10, 15),
-                      (1, 6, 11, 12),
-                      (2, 7, 8, 13),
-                      (3, 4, 9, 14)]
-
     for a, b, c, d in QUARTER_ROUNDS:
         s[a] = (s[a] + s[b]) & 0xffffffff
         s[d] = rot32(s[d] ^ s[a], 16)
@@ -39,15 +42,12 @@ def chacha20_doubleround(s):
 
 def chacha20_32_to_384(key32):
     """Specialized ChaCha20 implementation with 32-byte key, 0 IV, 384-byte output."""
-    # See RFC 8439 section 2.3 for chacha20 parameters
-    CONSTANTS = [0x61707865, 0x3320646e, 0x79622d32, 0x6b206574]
-
     key_bytes = [0]*8
     for i in range(8):
         key_bytes[i] = int.from_bytes(key32[(4 * i):(4 * (i+1))], 'little')
 
     INITIALIZATION_VECTOR = [0] * 4
-    init = CONSTANTS + key_bytes + INITIALIZATION_VECTOR
+    init = CHACHA20_CONSTANTS + key_bytes + INITIALIZATION_VECTOR
     out = bytearray()
     for counter in range(6):
         init[12] = counter
@@ -58,11 +58,73 @@ def chacha20_32_to_384(key32):
             out.extend(((s[i] + init[i]) & 0xffffffff).to_bytes(4, 'little'))
     return bytes(out)
 
+def chacha20_32_to_384_many(keys):
+    """chacha20_32_to_384 for a list of 32-byte keys, computed all at once.
+
+    Python integers serve as vector registers: each state word holds one 32-bit
+    lane per (block counter, key) pair, 64 bits apart so that the carries of
+    additions stay out of the neighbouring lane until they are masked off."""
+    n = len(keys)
+    if n == 0:
+        return []
+    lanes = 6 * n
+
+    def lanes_to_int(words):
+        """Spread the 4-byte little endian words of all lanes over 64-bit slots"""
+        buf = bytearray(8 * lanes)
+        for t in range(4):
+            buf[t::8] = words[t::4]
+        return int.from_bytes(buf, 'little')
+
+    def key_words(i):
+        """Word i of each key, for one block counter"""
+        words = bytearray(4 * n)
+        for t in range(4):
+            words[t::4] = key_bytes[(4 * i + t)::32]
+        return bytes(words)
+
+    mask = lanes_to_int(b'\xff' * (4 * lanes))
+    key_bytes = b"".join(keys)
+    init = [lanes_to_int(c.to_bytes(4, 'little') * lanes) for c in CHACHA20_CONSTANTS]
+    init += [lanes_to_int(key_words(i) * 6) for i in range(8)]
+    init += [lanes_to_int(b"".join(counter.to_bytes(4, 'little') * n for counter in range(6)))]
+    init += [0] * 3
+
+    s = list(init)
+    for _ in range(10):
+        for a, b, c, d in QUARTER_ROUNDS:
+            sa, sb, sc, sd = s[a], s[b], s[c], s[d]
+            sa = (sa + sb) & mask
+            x = sd ^ sa
+            sd = ((x << 16) | (x >> 16)) & mask
+            sc = (sc + sd) & mask
+            x = sb ^ sc
+            sb = ((x << 12) | (x >> 20)) & mask
+            sa = (sa + sb) & mask
+            x = sd ^ sa
+            sd = ((x << 8) | (x >> 24)) & mask
+            sc = (sc + sd) & mask
+            x = sb ^ sc
+            sb = ((x << 7) | (x >> 25)) & mask
+            s[a], s[b], s[c], s[d] = sa, sb, sc, sd
+
+    out = bytearray(384 * n)
+    for i in range(16):
+        word = ((s[i] + init[i]) & mask).to_bytes(8 * lanes, 'little')
+        for counter in range(6):
+            for t in range(4):
+                out[(64 * counter + 4 * i + t)::384] = word[(8 * n * counter + t):(8 * n * (counter + 1)):8]
+    return [bytes(out[(384 * k):(384 * (k + 1))]) for k in range(n)]
+
 def data_to_num3072(data):
     """Hash a 32-byte array data to a 3072-bit number using 6 Chacha20 operations."""
     bytes384 = chacha20_32_to_384(data)
     return int.from_bytes(bytes384, 'little')
 
+def data_to_num3072_many(data_list):
+    """data_to_num3072 for a list of 32-byte arrays."""
+    return [int.from_bytes(bytes384, 'little') for bytes384 in chacha20_32_to_384_many(data_list)]
+
 class MuHash3072:
     """Class representing the MuHash3072 computation of a set.
 
@@ -70,6 +132,8 @@ class MuHash3072:
     """
 
     MODULUS = 2**3072 - 1103717
+    # Number of elements hashed at once by insert_many/remove_many
+    BATCH_SIZE = 4096
 
     def __init__(self):
         """Initialize for an empty set."""
@@ -86,6 +150,29 @@ class MuHash3072:
         data_hash = hashlib.sha256(data).digest()
         self.denominator = (self.denominator * data_to_num3072(data_hash)) % self.MODULUS
 
+    def _mul_many(self, value, data_list):
+        """Multiply value by the hashes of the byte arrays in data_list."""
+        hashes = [hashlib.sha256(data).digest() for data in data_list]
+        # MODULUS is 2**3072 - c for a small c, so the product is cheaply
+        # folded below 2**3073 after each multiplication, and only fully
+        # reduced at the end.
+        c = 2**3072 - self.MODULUS
+        low = 2**3072 - 1
+        for i in range(0, len(hashes), self.BATCH_SIZE):
+            for num in data_to_num3072_many(hashes[i:i + self.BATCH_SIZE]):
+                value *= num
+                value = (value & low) + (value >> 3072) * c
+                value = (value & low) + (value >> 3072) * c
+        return value % self.MODULUS
+
+    def insert_many(self, data_list):
+        """Insert the byte arrays of data_list in the set."""
+        self.numerator = self._mul_many(self.numerator, data_list)
+
+    def remove_many(self, data_list):
+        """Remove the byte arrays of data_list from the set."""
+        self.denominator = self._mul_many(self.denominator, data_list)
+
     def digest(self):
         """Extract the final hash. Does not modify this object."""
         val = (self.numerator * modinv(self.denominator, self.MODULUS)) % self.MODULUS
@@ -102,6 +189,24 @@ class TestFrameworkMuhash(unittest.TestCase):
         # This mirrors the result in the C++ MuHash3072 unit test
         self.assertEqual(finalized[::-1].hex(), "10d312b100cbd32ada024a6646e40d3482fcff103668d2625f10002a607d5863")
 
+        muhash = MuHash3072()
+        muhash.insert_many([b'\x00' * 32, b'\x01' + b'\x00' * 31])
+        muhash.remove_many([b'\x02' + b'\x00' * 31])
+        self.assertEqual(muhash.digest(), finalized)
+
+    def test_muhash_many(self):
+        elements = [i.to_bytes(36, 'little') for i in range(300)]
+        muhash = MuHash3072()
+        for data in elements[:200]:
+            muhash.insert(data)
+        muhash.remove(elements[0])
+        muhash_many = MuHash3072()
+        muhash_many.BATCH_SIZE = 64
+        muhash_many.insert_many(elements[:200])
+        muhash_many.remove_many([elements[0]])
+        muhash_many.insert_many([])
+        self.assertEqual(muhash_many.digest(), muhash.digest())
+
     def test_chacha20(self):
         def chacha_check(key, result):
             self.assertEqual(chacha20_32_to_384(key)[:64].hex(), result)
@@ -110,3 +215,6 @@ class TestFrameworkMuhash(unittest.TestCase):
         # Since the nonce is hardcoded to 0 in our function we only use those vectors.
         chacha_check([0]*32, "76b8e0ada0f13d90405d6ae55386bd28bdd219b8a08ded1aa836efcc8b770dc7da41597c5157488d7724e03fb8d84a376a43b8f41518a11cc387b669b2ee6586")
         chacha_check([0]*31 + [1], "4540f05a9f1fb296d7736e7b208e3c96eb4fe1834688d2604f450952ed432d41bbe2a0b6ea7566d2a5d1e7e20d42af2c53d792b1c43fea817e9ad275ae546963")
+
+        keys = [bytes([0] * 32), bytes([0] * 31 + [1])] + [hashlib.sha256(bytes([i])).digest() for i in range(10)]
+        self.assertEqual(chacha20_32_to_384_many(keys), [chacha20_32_to_384(key) for key in keys])
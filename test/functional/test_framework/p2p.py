@@ -13,6 +13,12 @@ node. Messages are sent to/received from the node on an asyncio event loop.
 State held inside the objects must be guarded by the p2p_lock to avoid data
 races between the main testing thread and the event loop.
 
+For tests with many connections, the NetworkThread can run several event
+loops (see BitcoinTestFramework.network_loops), each in a thread of its own.
+Connections are then spread over the loops, and each one guards its state with
+its own lock (the `lock` attribute of the connection) instead of the p2p_lock,
+which may then not be used at all.
+
 P2PConnection: A low-level connection object to a node's P2P interface
 P2PInterface: A high-level interface object for communicating to a node over P2P
 P2PDataStore: A p2p interface class that keeps a store of transactions and blocks
@@ -22,14 +28,19 @@ P2PTxInvStore: A p2p interface class that inherits from P2PDataStore, and keeps
 
 import asyncio
 from collections import defaultdict
-from io import BytesIO
+import itertools
 import logging
 import struct
 import sys
 import threading
+from typing import Any, Dict, List
+import unittest
 
 from test_framework.messages import (
+    ByteReader,
+    CBlock,
     CBlockHeader,
+    CTransaction,
     MAX_HEADERS_RESULTS,
     msg_addr,
     msg_addrv2,
@@ -68,6 +79,7 @@ from test_framework.messages import (
     msg_wtxidrelay,
     NODE_NETWORK,
     NODE_WITNESS,
+    ser_object_into,
     sha256,
 )
 from test_framework.util import (
@@ -134,6 +146,80 @@ MAGIC_BYTES = {
     "elementsregtest": b"\x53\x19\xf2\x0e",
 }
 
+# P2P message header: magic bytes, msgtype, payload length and checksum
+MSG_HEADER = struct.Struct("<4s12si4s")
+MSG_HEADER_SIZE = MSG_HEADER.size
+
+
+class LazyMessage:
+    """Base of the classes of received P2P messages whose payload is
+    deserialized only when one of their fields is first accessed
+
+    lazy_message() creates them as instances of a subclass of both this class
+    and the message class, so that they are real messages once decoded. The
+    checksum of the payload has already been verified. msgtype and the raw
+    payload (serialize()) are available without decoding. Errors in the
+    payload are raised on first access instead of when the message is
+    received."""
+    __slots__ = ()
+    # Set on each subclass by lazy_message()
+    _message_class: Any = None
+
+    def decode(self):
+        """Deserialize the payload in place, unless done already, and return
+        the message"""
+        # Not set yet while copy or pickle restore the message
+        payload = getattr(self, "_lazy_payload", None)
+        if payload is not None:
+            object.__setattr__(self, "_lazy_payload", None)
+            try:
+                self._message_class.__init__(self)
+                self.deserialize(ByteReader(payload))
+            except BaseException:
+                object.__setattr__(self, "_lazy_payload", payload)
+                raise
+        return self
+
+    def is_decoded(self):
+        return self._lazy_payload is None
+
+    def serialize(self):
+        if self._lazy_payload is not None:
+            return self._lazy_payload
+        return self._message_class.serialize(self)
+
+    def __getattr__(self, name):
+        # Only reached for fields that are not set yet, i.e. before decoding
+        if name == "_lazy_payload" or self._lazy_payload is None:
+            raise AttributeError(name)
+        return getattr(self.decode(), name)
+
+    def __setattr__(self, name, value):
+        if name != "_lazy_payload":
+            self.decode()
+        object.__setattr__(self, name, value)
+
+    def __repr__(self):
+        if self._lazy_payload is not None:
+            return "%s(<%d bytes, not decoded>)" % (self._message_class.__name__, len(self._lazy_payload))
+        return self._message_class.__repr__(self)
+
+
+# Message class -> its LazyMessage subclass
+_lazy_message_classes: Dict[type, type] = {}
+
+
+def lazy_message(cls, payload):
+    """Return a LazyMessage instance of (a subclass of) cls for payload"""
+    lazy_cls = _lazy_message_classes.get(cls)
+    if lazy_cls is None:
+        lazy_cls = _lazy_message_classes[cls] = type("Lazy" + cls.__name__, (LazyMessage, cls),
+                                                     {"__slots__": ("_lazy_payload",), "_message_class": cls})
+    # cls.__init__() only runs when decoding
+    message = object.__new__(lazy_cls)
+    object.__setattr__(message, "_lazy_payload", payload)
+    return message
+
 
 class P2PConnection(asyncio.Protocol):
     """A low-level connection object to a node's P2P interface.
@@ -146,12 +232,33 @@ class P2PConnection(asyncio.Protocol):
     - logging messages as they are sent and received
 
     This class contains no logic for handing the P2P message payloads. It must be
-    sub-classed and the on_message() callback overridden."""
+    sub-classed and the on_message() callback overridden.
 
-    def __init__(self):
+    Received payloads are deserialized as they arrive, unless the decode
+    policy maps their msgtype to "lazy" (e.g. decode={"block": "lazy"}), in
+    which case on_message() gets a LazyMessage that decodes on first use."""
+
+    def __init__(self, decode=None):
         # The underlying transport of the connection.
         # Should only call methods on this from the NetworkThread, c.f. call_soon_threadsafe
         self._transport = None
+        # The event loop of the connection, see NetworkThread.assign_loop()
+        self._loop = None
+        # Guards the state of the connection, see NetworkThread.connection_lock()
+        self.lock = NetworkThread.connection_lock()
+        self.set_decode_policy(decode or {})
+
+    def set_decode_policy(self, decode):
+        """Set which msgtypes are decoded "eager"ly (the default) or "lazy"ly"""
+        lazy_msgtypes = set()
+        for msgtype, policy in decode.items():
+            if msgtype.encode() not in MESSAGEMAP:
+                raise ValueError("Unknown msgtype in decode policy: {}".format(msgtype))
+            if policy not in ("eager", "lazy"):
+                raise ValueError("Decode policy for {} must be 'eager' or 'lazy', not {!r}".format(msgtype, policy))
+            if policy == "lazy":
+                lazy_msgtypes.add(msgtype.encode())
+        self.lazy_msgtypes = frozenset(lazy_msgtypes)
 
     @property
     def is_connected(self):
@@ -164,26 +271,29 @@ class P2PConnection(asyncio.Protocol):
         self.dstport = dstport
         # The initial message to send after the connection was made:
         self.on_connection_send_msg = None
-        self.recvbuf = b""
+        self.recvbuf = bytearray()
+        self.recvpos = 0
         self.magic_bytes = MAGIC_BYTES[net]
 
     def peer_connect(self, dstaddr, dstport, *, net, timeout_factor):
         self.peer_connect_helper(dstaddr, dstport, net, timeout_factor)
 
-        loop = NetworkThread.network_event_loop
+        loop = self._loop = NetworkThread.assign_loop()
         logger.debug('Connecting to Bitcoin Node: %s:%d' % (self.dstaddr, self.dstport))
         coroutine = loop.create_connection(lambda: self, host=self.dstaddr, port=self.dstport)
         return lambda: loop.call_soon_threadsafe(loop.create_task, coroutine)
 
     def peer_accept_connection(self, connect_id, connect_cb=lambda: None, *, net, timeout_factor):
         self.peer_connect_helper('0', 0, net, timeout_factor)
+        # Inbound connections are handled on the loop of the listening server
+        self._loop = NetworkThread.network_event_loop
 
         logger.debug('Listening for Bitcoin Node with id: {}'.format(connect_id))
         return lambda: NetworkThread.listen(self, connect_cb, idx=connect_id)
 
     def peer_disconnect(self):
         # Connection could have already been closed by other end.
-        NetworkThread.network_event_loop.call_soon_threadsafe(lambda: self._transport and self._transport.abort())
+        (self._loop or NetworkThread.network_event_loop).call_soon_threadsafe(lambda: self._transport and self._transport.abort())
 
     # Connection and disconnection methods
 
@@ -196,6 +306,7 @@ class P2PConnection(asyncio.Protocol):
             self.send_message(self.on_connection_send_msg)
             self.on_connection_send_msg = None  # Never used again
         self.on_open()
+        self._notify_waiters()
 
     def connection_lost(self, exc):
         """asyncio callback when a connection is closed."""
@@ -204,14 +315,27 @@ class P2PConnection(asyncio.Protocol):
         else:
             logger.debug("Closed connection to: %s:%d" % (self.dstaddr, self.dstport))
         self._transport = None
-        self.recvbuf = b""
+        self.recvbuf = bytearray()
+        self.recvpos = 0
         self.on_close()
+        self._notify_waiters()
+
+    def _notify_waiters(self):
+        """Wake up the wait_until() calls waiting on the connection lock"""
+        with self.lock:
+            self.lock.notify_all()
 
     # Socket read methods
 
     def data_received(self, t):
         """asyncio callback when data is read from the socket."""
         if len(t) > 0:
+            if self.recvpos and self.recvpos * 2 >= len(self.recvbuf):
+                # Drop the consumed messages once they make up at least half of
+                # the buffer, so that the unread bytes are moved at most O(1)
+                # times on average
+                del self.recvbuf[:self.recvpos]
+                self.recvpos = 0
             self.recvbuf += t
             self._on_data()
 
@@ -220,31 +344,37 @@ class P2PConnection(asyncio.Protocol):
 
         This method reads data from the buffer in a loop. It deserializes,
         parses and verifies the P2P header, then passes the P2P payload to
-        the on_message callback for processing."""
+        the on_message callback for processing. Consumed messages are not
+        removed from recvbuf, but skipped by advancing recvpos."""
         try:
+            recvbuf = self.recvbuf
             while True:
-                if len(self.recvbuf) < 4:
+                pos = self.recvpos
+                available = len(recvbuf) - pos
+                if available < 4:
                     return
-                if self.recvbuf[:4] != self.magic_bytes:
-                    raise ValueError("magic bytes mismatch: {} != {}".format(repr(self.magic_bytes), repr(self.recvbuf)))
-                if len(self.recvbuf) < 4 + 12 + 4 + 4:
+                if recvbuf[pos:pos+4] != self.magic_bytes:
+                    raise ValueError("magic bytes mismatch: {} != {}".format(repr(self.magic_bytes), repr(bytes(recvbuf[pos:]))))
+                if available < MSG_HEADER_SIZE:
                     return
-                msgtype = self.recvbuf[4:4+12].split(b"\x00", 1)[0]
-                msglen = struct.unpack("<i", self.recvbuf[4+12:4+12+4])[0]
-                checksum = self.recvbuf[4+12+4:4+12+4+4]
-                if len(self.recvbuf) < 4 + 12 + 4 + 4 + msglen:
+                _, msgtype, msglen, checksum = MSG_HEADER.unpack_from(recvbuf, pos)
+                msgtype = msgtype.split(b"\x00", 1)[0]
+                if available < MSG_HEADER_SIZE + msglen:
                     return
-                msg = self.recvbuf[4+12+4+4:4+12+4+4+msglen]
+                start = pos + MSG_HEADER_SIZE
+                msg = bytes(recvbuf[start:start+msglen])
                 th = sha256(msg)
                 h = sha256(th)
                 if checksum != h[:4]:
-                    raise ValueError("got bad checksum " + repr(self.recvbuf))
-                self.recvbuf = self.recvbuf[4+12+4+4+msglen:]
+                    raise ValueError("got bad checksum " + repr(bytes(recvbuf[pos:])))
+                self.recvpos = start + msglen
                 if msgtype not in MESSAGEMAP:
                     raise ValueError("Received unknown msgtype from %s:%d: '%s' %s" % (self.dstaddr, self.dstport, msgtype, repr(msg)))
-                f = BytesIO(msg)
-                t = MESSAGEMAP[msgtype]()
-                t.deserialize(f)
+                if msgtype in self.lazy_msgtypes:
+                    t = lazy_message(MESSAGEMAP[msgtype], msg)
+                else:
+                    t = MESSAGEMAP[msgtype]()
+                    t.deserialize(ByteReader(msg))
                 self._log_message("receive", t)
                 self.on_message(t)
         except Exception as e:
@@ -276,26 +406,34 @@ class P2PConnection(asyncio.Protocol):
             if self._transport.is_closing():
                 return
             self._transport.write(raw_message_bytes)
-        NetworkThread.network_event_loop.call_soon_threadsafe(maybe_write)
+        self._loop.call_soon_threadsafe(maybe_write)
 
     # Class utility methods
 
     def build_message(self, message):
-        """Build a serialized P2P message"""
+        """Build a serialized P2P message
+
+        The payload is serialized directly behind the header into a single
+        buffer; the length and checksum fields are filled in afterwards."""
         msgtype = message.msgtype
-        data = message.serialize()
-        tmsg = self.magic_bytes
+        tmsg = bytearray(self.magic_bytes)
         tmsg += msgtype
         tmsg += b"\x00" * (12 - len(msgtype))
-        tmsg += struct.pack("<I", len(data))
+        tmsg += b"\x00" * 8
+        ser_object_into(tmsg, message)
+        data = memoryview(tmsg)[4+12+4+4:]
         th = sha256(data)
         h = sha256(th)
-        tmsg += h[:4]
-        tmsg += data
-        return tmsg
+        struct.pack_into("<I", tmsg, 4+12, len(data))
+        data.release()
+        tmsg[4+12+4:4+12+4+4] = h[:4]
+        return bytes(tmsg)
 
     def _log_message(self, direction, msg):
         """Logs a message being sent or received over the connection."""
+        if not logger.isEnabledFor(logging.DEBUG):
+            # Don't pay for repr() of messages that are not logged
+            return
         if direction == "send":
             log_message = "Send message to "
         elif direction == "receive":
@@ -315,8 +453,8 @@ class P2PInterface(P2PConnection):
 
     Individual testcases should subclass this and override the on_* methods
     if they want to alter message handling behaviour."""
-    def __init__(self, support_addrv2=False, wtxidrelay=True):
-        super().__init__()
+    def __init__(self, support_addrv2=False, wtxidrelay=True, decode=None):
+        super().__init__(decode=decode)
 
         # Track number of messages of each type received.
         # Should be read-only in a test.
@@ -372,7 +510,7 @@ class P2PInterface(P2PConnection):
 
         We keep a count of how many of each message type has been received
         and the most recent message of each type."""
-        with p2p_lock:
+        with self.lock:
             try:
                 msgtype = message.msgtype.decode('ascii')
                 self.message_count[msgtype] += 1
@@ -381,6 +519,8 @@ class P2PInterface(P2PConnection):
             except:
                 print("ERROR delivering %s (%s)" % (repr(message), sys.exc_info()[0]))
                 raise
+            finally:
+                self.lock.notify_all()
 
     # Callback methods. Can be overridden by subclasses in individual test
     # cases to provide custom message handling behaviour.
@@ -451,11 +591,11 @@ class P2PInterface(P2PConnection):
                 assert self.is_connected
             return test_function_in()
 
-        wait_until_helper(test_function, timeout=timeout, lock=p2p_lock, timeout_factor=self.timeout_factor)
+        wait_until_helper(test_function, timeout=timeout, lock=self.lock, timeout_factor=self.timeout_factor)
 
     def wait_for_connect(self, timeout=60):
         test_function = lambda: self.is_connected
-        wait_until_helper(test_function, timeout=timeout, lock=p2p_lock)
+        wait_until_helper(test_function, timeout=timeout, lock=self.lock)
 
     def wait_for_disconnect(self, timeout=60):
         test_function = lambda: not self.is_connected
@@ -567,35 +707,81 @@ class P2PInterface(P2PConnection):
 # P2PConnection acquires this lock whenever delivering a message to a P2PInterface.
 # This lock should be acquired in the thread running the test logic to synchronize
 # access to any data shared with the P2PInterface or P2PConnection.
-p2p_lock = threading.Lock()
+# With several network event loops, every connection has its own lock instead,
+# and acquiring this one is an error.
+# It is a condition, notified whenever a P2PInterface received a message or
+# (dis)connected, so that wait_until() wakes up immediately.
+class _P2PLock(threading.Condition):
+    def __enter__(self):
+        assert len(NetworkThread.event_loops) <= 1, \
+            "p2p_lock does not guard any P2PInterface with several network event loops, use its lock attribute instead"
+        return super().__enter__()
+
+
+p2p_lock = _P2PLock(threading.Lock())
 
 
 class NetworkThread(threading.Thread):
     network_event_loop = None
+    # All event loops, the first being network_event_loop. Each of the others
+    # runs in a helper thread.
+    event_loops: List[asyncio.AbstractEventLoop] = []
 
-    def __init__(self):
+    def __init__(self, num_loops=1):
         super().__init__(name="NetworkThread")
         # There is only one event loop and no more than one thread must be created
         assert not self.network_event_loop
+        assert num_loops >= 1
 
         NetworkThread.listeners = {}
         NetworkThread.protos = {}
         if sys.platform == 'win32':
             asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
         NetworkThread.network_event_loop = asyncio.new_event_loop()
+        NetworkThread.event_loops = [self.network_event_loop] + [asyncio.new_event_loop() for _ in range(num_loops - 1)]
+        NetworkThread._loop_cycle = itertools.cycle(self.event_loops)
+        self.helper_threads = [threading.Thread(target=loop.run_forever, name="NetworkThread-{}".format(i), daemon=True)
+                               for i, loop in enumerate(self.event_loops) if i > 0]
 
     def run(self):
         """Start the network thread."""
+        for thread in self.helper_threads:
+            thread.start()
         self.network_event_loop.run_forever()
 
     def close(self, timeout=10):
-        """Close the connections and network event loop."""
-        self.network_event_loop.call_soon_threadsafe(self.network_event_loop.stop)
-        wait_until_helper(lambda: not self.network_event_loop.is_running(), timeout=timeout)
-        self.network_event_loop.close()
+        """Close the connections and network event loops."""
+        for loop in self.event_loops:
+            loop.call_soon_threadsafe(loop.stop)
+        wait_until_helper(lambda: not any(loop.is_running() for loop in self.event_loops), timeout=timeout)
+        for loop in self.event_loops:
+            loop.close()
         self.join(timeout)
+        for thread in self.helper_threads:
+            thread.join(timeout)
         # Safe to remove event loop.
         NetworkThread.network_event_loop = None
+        NetworkThread.event_loops = []
+
+    @classmethod
+    def assign_loop(cls):
+        """Return the event loop for a new outbound connection. Connections are
+        spread over the event loops round-robin."""
+        return next(cls._loop_cycle)
+
+    @classmethod
+    def connection_lock(cls):
+        """Return the lock guarding the state of a new connection: the global
+        p2p_lock, unless there are several event loops"""
+        if len(cls.event_loops) > 1:
+            return threading.Condition(threading.Lock())
+        return p2p_lock
+
+    @classmethod
+    def run_coroutine(cls, coroutine, timeout=None):
+        """Run a coroutine on the network event loop from another thread and
+        return its result."""
+        return asyncio.run_coroutine_threadsafe(coroutine, cls.network_event_loop).result(timeout)
 
     @classmethod
     def listen(cls, p2p, callback, port=None, addr=None, idx=1):
@@ -707,7 +893,7 @@ class P2PDataStore(P2PInterface):
          - if success is False: assert that the node's tip doesn't advance
          - if reject_reason is set: assert that the correct reject message is logged"""
 
-        with p2p_lock:
+        with self.lock:
             for block in blocks:
                 self.block_store[block.sha256] = block
                 self.last_block_hash = block.sha256
@@ -744,7 +930,7 @@ class P2PDataStore(P2PInterface):
          - if expect_disconnect is True: Skip the sync with ping
          - if reject_reason is set: assert that the correct reject message is logged."""
 
-        with p2p_lock:
+        with self.lock:
             for tx in txs:
                 self.tx_store[tx.sha256] = tx
 
@@ -783,7 +969,7 @@ class P2PTxInvStore(P2PInterface):
                 self.tx_invs_received[i.hash] += 1
 
     def get_invs(self):
-        with p2p_lock:
+        with self.lock:
             return list(self.tx_invs_received.keys())
 
     def wait_for_broadcast(self, txns, timeout=60):
@@ -794,3 +980,82 @@ class P2PTxInvStore(P2PInterface):
         self.wait_until(lambda: set(self.tx_invs_received.keys()) == set([int(tx, 16) for tx in txns]), timeout=timeout)
         # Flush messages and wait for the getdatas to be processed
         self.sync_with_ping()
+
+
+class TestFrameworkP2P(unittest.TestCase):
+    def test_receive(self):
+        sender = P2PInterface()
+        sender.peer_connect_helper("0", 0, "regtest", 1)
+        block = CBlock()
+        block.vtx = [CTransaction() for _ in range(3)]
+        messages = [msg_ping(i) for i in range(100)] + [msg_block(block), msg_headers([CBlockHeader()] * 10)]
+        stream = b"".join(sender.build_message(m) for m in messages)
+
+        for decode in ({}, {"block": "lazy", "ping": "eager"}):
+            p2p = P2PInterface(decode=decode)
+            p2p.peer_connect_helper("0", 0, "regtest", 1)
+            p2p.on_ping = lambda message: None
+            # Feed the stream in small reads, splitting headers and payloads
+            for i in range(0, len(stream), 7):
+                p2p.data_received(stream[i:i + 7])
+            self.assertEqual(dict(p2p.message_count), {"ping": 100, "block": 1, "headers": 1})
+            self.assertEqual(p2p.last_message["ping"].nonce, 99)
+            received = p2p.last_message["block"]
+            self.assertIsInstance(received, msg_block)
+            self.assertEqual(isinstance(received, LazyMessage), bool(decode))
+            self.assertEqual(received.serialize(), msg_block(block).serialize())
+            if decode:
+                self.assertIs(type(received), type(lazy_message(msg_block, b"")))
+                self.assertFalse(received.is_decoded())
+                self.assertIn("not decoded", repr(received))
+            self.assertEqual(len(received.block.vtx), 3)
+            if decode:
+                self.assertTrue(received.is_decoded())
+                self.assertEqual(received.serialize(), msg_block(block).serialize())
+            self.assertEqual(p2p.recvbuf[p2p.recvpos:], b"")
+
+        with self.assertRaises(ValueError):
+            P2PInterface(decode={"block": "never"})
+        with self.assertRaises(ValueError):
+            P2PInterface(decode={"blocks": "lazy"})
+
+    def test_network_loops(self):
+        network_thread = NetworkThread(num_loops=3)
+        network_thread.start()
+        try:
+            sender = P2PInterface()
+            sender.peer_connect_helper("0", 0, "regtest", 1)
+            stream = b"".join(sender.build_message(msg_ping(i)) for i in range(10))
+
+            async def serve(reader, writer):
+                writer.write(stream)
+                await writer.drain()
+                await reader.read()
+                writer.close()
+            server = NetworkThread.run_coroutine(asyncio.start_server(serve, "127.0.0.1", 0), timeout=10)
+            port = server.sockets[0].getsockname()[1]
+
+            peers = []
+            for _ in range(6):
+                peer = P2PInterface()
+                peer.on_ping = lambda message: None
+                peer.peer_connect("127.0.0.1", port, net="regtest", timeout_factor=1, send_version=False)()
+                peers.append(peer)
+            for peer in peers:
+                peer.wait_until(lambda: peer.message_count["ping"] == 10, timeout=10, check_connected=False)
+            self.assertEqual({id(peer._loop) for peer in peers}, {id(loop) for loop in NetworkThread.event_loops})
+            self.assertEqual(len({id(peer.lock) for peer in peers}), 6)
+            with self.assertRaises(AssertionError):
+                with p2p_lock:
+                    pass
+            for peer in peers:
+                peer.peer_disconnect()
+                peer.wait_for_disconnect(timeout=10)
+
+            async def close_server():
+                server.close()
+                await server.wait_closed()
+            NetworkThread.run_coroutine(close_server(), timeout=10)
+        finally:
+            network_thread.close()
+        self.assertIs(P2PInterface().lock, p2p_lock)
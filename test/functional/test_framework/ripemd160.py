@@ -1,10 +1,21 @@
 # Copyright (c) 2021 Pieter Wuille
 # Distributed under the MIT software license, see the accompanying
 # file COPYING or http://www.opensource.org/licenses/mit-license.php.
-"""Test-only pure Python RIPEMD160 implementation."""
+"""Test-only RIPEMD160 implementation.
 
+ripemd160 uses hashlib when the OpenSSL it is linked against provides
+RIPEMD-160 (OpenSSL 3 only does with the legacy provider loaded), and the pure
+Python ripemd160_reference otherwise. Set TEST_FRAMEWORK_PYTHON_HASHES=1 to
+always use the latter, or TEST_FRAMEWORK_HASH_CROSSCHECK=1 to check the former
+against it."""
+
+import hashlib
+import os
 import unittest
 
+PYTHON_HASHES = os.getenv("TEST_FRAMEWORK_PYTHON_HASHES") == "1"
+HASH_CROSSCHECK = os.getenv("TEST_FRAMEWORK_HASH_CROSSCHECK") == "1"
+
 # Message schedule indexes for the left path.
 ML = [
     0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15,
@@ -92,7 +103,7 @@ def compress(h0, h1, h2, h3, h4, block):
     return h1 + cl + dr, h2 + dl + er, h3 + el + ar, h4 + al + br, h0 + bl + cr
 
 
-def ripemd160(data):
+def ripemd160_reference(data):
     """Compute the RIPEMD-160 hash of data."""
     # Initialize state.
     state = (0x67452301, 0xefcdab89, 0x98badcfe, 0x10325476, 0xc3d2e1f0)
@@ -109,6 +120,30 @@ def ripemd160(data):
     return b"".join((h & 0xffffffff).to_bytes(4, 'little') for h in state)
 
 
+def hashlib_ripemd160(data):
+    return hashlib.new("ripemd160", data).digest()
+
+
+def _hashlib_ripemd160_works():
+    try:
+        return hashlib_ripemd160(b"abc").hex() == "8eb208f7e05d987a9b044a8e98c6b087f15a0bfc"
+    except ValueError:
+        return False
+
+
+HASHLIB_RIPEMD160 = not PYTHON_HASHES and _hashlib_ripemd160_works()
+
+
+def ripemd160(data):
+    """Compute the RIPEMD-160 hash of data, with hashlib if it supports it."""
+    if not HASHLIB_RIPEMD160:
+        return ripemd160_reference(data)
+    result = hashlib_ripemd160(data)
+    if HASH_CROSSCHECK:
+        assert result == ripemd160_reference(data)
+    return result
+
+
 class TestFrameworkKey(unittest.TestCase):
     def test_ripemd160(self):
         """RIPEMD-160 test vectors."""
@@ -127,4 +162,7 @@ class TestFrameworkKey(unittest.TestCase):
             (b"1234567890" * 8, "9b752e45573d4b39f4dbd3323cab82bf63326bfb"),
             (b"a" * 1000000, "52783243c1697bdbe16d37f97f68f08325dc1528")
         ]:
+            self.assertEqual(ripemd160_reference(msg).hex(), hexout)
             self.assertEqual(ripemd160(msg).hex(), hexout)
+            if _hashlib_ripemd160_works():
+                self.assertEqual(hashlib_ripemd160(msg).hex(), hexout)
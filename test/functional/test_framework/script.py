@@ -15,15 +15,17 @@ from typing import List, Dict
 from .key import TaggedHash, tweak_add_pubkey
 
 from .messages import (
+    COutPoint,
     CTransaction,
+    CTxIn,
     CTxOut,
     CTxOutAsset,
     CTxOutValue,
     hash256,
-    ser_compact_size,
+    ser_compact_size_into,
     ser_string,
+    ser_string_into,
     ser_uint256,
-    ser_vector,
     sha256,
     uint256_from_str,
 )
@@ -723,75 +725,68 @@ def LegacySignatureMsg(script, txTo, inIdx, hashtype, enable_sighash_rangeproof=
 
     Returns either (None, err) to indicate error (which translates to sighash 1),
     or (msg, None).
+
+    The preimage is serialized directly from txTo, substituting the blanked
+    scriptSigs, nSequences and outputs rather than modifying a copy of it.
     """
 
     if inIdx >= len(txTo.vin):
         return (None, "inIdx %d out of range (%d)" % (inIdx, len(txTo.vin)))
-    txtmp = CTransaction(txTo)
-
-    for txin in txtmp.vin:
-        txin.scriptSig = b''
-    txtmp.vin[inIdx].scriptSig = FindAndDelete(script, CScript([OP_CODESEPARATOR]))
-
-    if (hashtype & 0x1f) == SIGHASH_NONE:
-        txtmp.vout = []
-
-        for i in range(len(txtmp.vin)):
-            if i != inIdx:
-                txtmp.vin[i].nSequence = 0
-
-    elif (hashtype & 0x1f) == SIGHASH_SINGLE:
-        outIdx = inIdx
-        if outIdx >= len(txtmp.vout):
-            return (None, "outIdx %d out of range (%d)" % (outIdx, len(txtmp.vout)))
 
-        tmp = txtmp.vout[outIdx]
-        txtmp.vout = []
-        for _ in range(outIdx):
-            txtmp.vout.append(CTxOut(nValue=CTxOutValue(), nAsset=CTxOutAsset()))
-        txtmp.vout.append(tmp)
-
-        for i in range(len(txtmp.vin)):
-            if i != inIdx:
-                txtmp.vin[i].nSequence = 0
-
-    if hashtype & SIGHASH_ANYONECANPAY:
-        tmp = txtmp.vin[inIdx]
-        txtmp.vin = []
-        txtmp.vin.append(tmp)
+    hash_none = (hashtype & 0x1f) == SIGHASH_NONE
+    hash_single = (hashtype & 0x1f) == SIGHASH_SINGLE
+    if hash_single and inIdx >= len(txTo.vout):
+        return (None, "outIdx %d out of range (%d)" % (inIdx, len(txTo.vout)))
 
     # sighash serialization is different from non-witness serialization
     # do manual sighash serialization:
-    s = b""
-    s += struct.pack("<i", txtmp.nVersion)
+    s = bytearray(struct.pack("<i", txTo.nVersion))
     # ELEMENTS: vin serialization is different from non-witness serialization (pegin/issuance
     #  flags are not set in the sighash)
-    s += ser_compact_size(len(txtmp.vin))
-    for i in range(len(txtmp.vin)):
-        s += txtmp.vin[i].prevout.serialize()
-        s += ser_string(txtmp.vin[i].scriptSig)
-        s += struct.pack("<I", txtmp.vin[i].nSequence)
-        if not txtmp.vin[i].assetIssuance.isNull():
-            s += txtmp.vin[i].assetIssuance.serialize()
-
+    if hashtype & SIGHASH_ANYONECANPAY:
+        vin = [(inIdx, txTo.vin[inIdx])]
+    else:
+        vin = list(enumerate(txTo.vin))
+    ser_compact_size_into(s, len(vin))
+    for i, txin in vin:
+        txin.prevout.serialize_into(s)
+        if i == inIdx:
+            ser_string_into(s, FindAndDelete(script, CScript([OP_CODESEPARATOR])))
+            s += struct.pack("<I", txin.nSequence)
+        else:
+            s.append(0)
+            s += struct.pack("<I", 0 if hash_none or hash_single else txin.nSequence)
+        if not txin.assetIssuance.isNull():
+            txin.assetIssuance.serialize_into(s)
+
+    if hash_none:
+        vout = []
+    elif hash_single:
+        # Outputs before inIdx are replaced by null ones
+        blank = CTxOut(nValue=CTxOutValue(), nAsset=CTxOutAsset())
+        vout = [blank] * inIdx + [txTo.vout[inIdx]]
+    else:
+        vout = txTo.vout
+    ser_compact_size_into(s, len(vout))
     # If SIGHASH_RANGEPROOF is set, we need to add the rangeproof serialization after each output
     if enable_sighash_rangeproof and hashtype & SIGHASH_RANGEPROOF:
-        s += ser_compact_size(len(txtmp.vout))
-        for i in range(len(txtmp.vout)):
-            s += txtmp.vout[i].serialize()
-            if i < len(txtmp.wit.vtxoutwit):
-                s += ser_string(txtmp.wit.vtxoutwit[i].vchRangeproof)
-                s += ser_string(txtmp.wit.vtxoutwit[i].vchSurjectionproof)
+        vtxoutwit = txTo.wit.vtxoutwit
+        for i, txout in enumerate(vout):
+            txout.serialize_into(s)
+            if i < len(vtxoutwit):
+                ser_string_into(s, vtxoutwit[i].vchRangeproof)
+                ser_string_into(s, vtxoutwit[i].vchSurjectionproof)
             else:
                 s += bytes([0, 0])
     else:
-        s += ser_vector(txtmp.vout)
-    s += struct.pack("<I", txtmp.nLockTime)
+        for txout in vout:
+            txout.serialize_into(s)
+    s += struct.pack("<I", txTo.nLockTime)
 
     # add sighash type
     s += struct.pack(b"<I", hashtype)
 
-    return (s, None)
+    return (bytes(s), None)
 
 def LegacySignatureHash(*args, **kwargs):
     """Consensus-correct SignatureHash
@@ -807,11 +802,14 @@ def LegacySignatureHash(*args, **kwargs):
     else:
         return (hash256(msg), err)
 
-# TODO: Allow cached hashPrevouts/hashSequence/hashOutputs to be provided.
-# Performance optimization probably not necessary for python tests, however.
 # Note that this corresponds to sigversion == 1 in EvalScript, which is used
 # for version 0 witnesses.
-def SegwitV0SignatureMsg(script, txTo, inIdx, hashtype, amount, enable_sighash_rangeproof=True):
+def SegwitV0SignatureMsg(script, txTo, inIdx, hashtype, amount, enable_sighash_rangeproof=True, sighash_cache=None):
+    """BIP143 signature message. Pass a SighashCache of txTo when signing
+    several of its inputs, to compute the hashes over all inputs/outputs once."""
+    if sighash_cache is None:
+        sighash_cache = SighashCache(txTo)
+    assert sighash_cache.tx is txTo
 
     hashPrevouts = 0
     hashSequence = 0
@@ -820,38 +818,19 @@ def SegwitV0SignatureMsg(script, txTo, inIdx, hashtype, amount, enable_sighash_r
     hashRangeproofs = 0
 
     if not (hashtype & SIGHASH_ANYONECANPAY):
-        serialize_prevouts = bytes()
-        for i in txTo.vin:
-            serialize_prevouts += i.prevout.serialize()
-        hashPrevouts = uint256_from_str(hash256(serialize_prevouts))
+        hashPrevouts = sighash_cache.hash_prevouts()
 
     if (not (hashtype & SIGHASH_ANYONECANPAY) and (hashtype & 0x1f) != SIGHASH_SINGLE and (hashtype & 0x1f) != SIGHASH_NONE):
-        serialize_sequence = bytes()
-        for i in txTo.vin:
-            serialize_sequence += struct.pack("<I", i.nSequence)
-        hashSequence = uint256_from_str(hash256(serialize_sequence))
+        hashSequence = sighash_cache.hash_sequence()
 
     if not (hashtype & SIGHASH_ANYONECANPAY):
-        serialize_issuance = bytes()
-        # TODO actually serialize issuances
-        for inp in txTo.vin:
-            if inp.assetIssuance.isNull():
-                serialize_issuance += b'\x00'
-            else:
-                serialize_issuance += inp.assetIssuance.serialize()
-        hashIssuance = uint256_from_str(hash256(serialize_issuance))
+        hashIssuance = sighash_cache.hash_issuance()
 
     if ((hashtype & 0x1f) != SIGHASH_SINGLE and (hashtype & 0x1f) != SIGHASH_NONE):
-        serialize_outputs = bytes()
-        for o in txTo.vout:
-            serialize_outputs += o.serialize()
-        hashOutputs = uint256_from_str(hash256(serialize_outputs))
+        hashOutputs = sighash_cache.hash_outputs()
 
         if enable_sighash_rangeproof and hashtype & SIGHASH_RANGEPROOF:
-            serialize_rangeproofs = bytes()
-            for wit in txTo.wit.vtxoutwit:
-                serialize_rangeproofs += ser_string(wit.vchRangeproof) + ser_string(wit.vchSurjectionproof)
-            hashRangeproofs = uint256_from_str(hash256(serialize_rangeproofs))
+            hashRangeproofs = sighash_cache.hash_rangeproofs()
 
     elif ((hashtype & 0x1f) == SIGHASH_SINGLE and inIdx < len(txTo.vout)):
         serialize_outputs = txTo.vout[inIdx].serialize()
@@ -913,6 +892,43 @@ class TestFrameworkScript(unittest.TestCase):
         for value in values:
             self.assertEqual(CScriptNum.decode(CScriptNum.encode(CScriptNum(value))), value)
 
+    def test_legacy_sighash(self):
+        tx = CTransaction()
+        tx.vin = [CTxIn(COutPoint(i, 0), scriptSig=b"\x51", nSequence=i) for i in range(3)]
+        tx.vout = [CTxOut(1000, CScript([OP_TRUE]))]
+        serialized = tx.serialize()
+        script = CScript([OP_TRUE, OP_CODESEPARATOR, OP_TRUE])
+        msg, err = LegacySignatureMsg(script, tx, 1, SIGHASH_ALL)
+        self.assertIsNone(err)
+        self.assertEqual(tx.serialize(), serialized)
+        # Other scriptSigs are blanked, the script code has OP_CODESEPARATORs removed
+        self.assertIn(COutPoint(2, 0).serialize() + b"\x00" + struct.pack("<I", 2), msg)
+        self.assertIn(ser_string(CScript([OP_TRUE, OP_TRUE])), msg)
+        self.assertEqual(LegacySignatureMsg(script, tx, 1, SIGHASH_SINGLE)[0], None)
+        self.assertEqual(len(LegacySignatureMsg(script, tx, 0, SIGHASH_ALL | SIGHASH_ANYONECANPAY)[0]),
+                         len(msg) - 2 * (36 + 1 + 4))
+
+    def test_sighash_cache(self):
+        tx = CTransaction()
+        tx.vin = [CTxIn(COutPoint(i, 0)) for i in range(3)]
+        tx.vout = [CTxOut(1000, CScript([OP_TRUE]))]
+        utxos = [CTxOut(2000 + i, CScript([OP_1, bytes(32)])) for i in range(3)]
+        cache = SighashCache(tx, utxos)
+
+        def sigmsgs(sighash_cache):
+            return [(TaprootSignatureMsg(tx, utxos, SIGHASH_DEFAULT, 0, i, sighash_cache=sighash_cache),
+                     SegwitV0SignatureMsg(CScript([OP_TRUE]), tx, i, SIGHASH_ALL | SIGHASH_RANGEPROOF, utxos[i].nValue, sighash_cache=sighash_cache))
+                    for i in range(len(tx.vin))]
+        self.assertEqual(sigmsgs(cache), sigmsgs(None))
+        # Added outputs are noticed
+        tx.vout.append(CTxOut(500, CScript([OP_TRUE])))
+        self.assertEqual(sigmsgs(cache), sigmsgs(None))
+        # Inputs modified in place are not
+        tx.vin[0].nSequence = 1
+        self.assertNotEqual(sigmsgs(cache), sigmsgs(None))
+        cache.invalidate()
+        self.assertEqual(sigmsgs(cache), sigmsgs(None))
+
 def BIP341_sha_prevouts(txTo):
     return sha256(b"".join(i.prevout.serialize() for i in txTo.vin))
 
@@ -928,9 +944,90 @@ def BIP341_sha_sequences(txTo):
 def BIP341_sha_outputs(txTo):
     return sha256(b"".join(o.serialize() for o in txTo.vout))
 
-def TaprootSignatureMsg(txTo, spent_utxos, hash_type, genesis_hash, input_index = 0, scriptpath = False, script = CScript(), codeseparator_pos = -1, annex = None, leaf_ver = LEAF_VERSION_TAPSCRIPT):
+class SighashCache:
+    """The hashes over all inputs and outputs of a transaction that its BIP143
+    and BIP341 signature messages commit to, computed once for all inputs.
+
+    They are recomputed when inputs, outputs or their witness lists are added
+    or replaced, or when nVersion/nLockTime change. Call invalidate() after
+    modifying an existing input or output in place. Input scriptSigs and
+    script witnesses are not committed to, so they may be changed freely."""
+
+    def __init__(self, tx, spent_utxos=None):
+        self.tx = tx
+        self.spent_utxos = spent_utxos
+        self.invalidate()
+
+    def invalidate(self):
+        self._hashes = {}
+        self._lists, self._shape = self._get_shape()
+
+    def _get_shape(self):
+        tx = self.tx
+        lists = (tx.vin, tx.vout, tx.wit.vtxinwit, tx.wit.vtxoutwit, self.spent_utxos or [])
+        return lists, (tx.nVersion, tx.nLockTime) + tuple(len(lst) for lst in lists)
+
+    def _get(self, name, compute):
+        lists, shape = self._get_shape()
+        if shape != self._shape or any(a is not b for a, b in zip(lists, self._lists)):
+            self.invalidate()
+        if name not in self._hashes:
+            self._hashes[name] = compute()
+        return self._hashes[name]
+
+    # BIP341 (single SHA256) hashes
+    def sha_outpoint_flags(self):
+        return self._get("outpoint_flags", lambda: sha256(b"".join(struct.pack("B", ((not i.assetIssuance.isNull()) << 7) + (i.m_is_pegin << 6)) for i in self.tx.vin)))
+
+    def sha_prevouts(self):
+        return self._get("prevouts", lambda: BIP341_sha_prevouts(self.tx))
+
+    def sha_amounts(self):
+        return self._get("amounts", lambda: BIP341_sha_amounts(self.spent_utxos))
+
+    def sha_scriptpubkeys(self):
+        return self._get("scriptpubkeys", lambda: BIP341_sha_scriptpubkeys(self.spent_utxos))
+
+    def sha_sequences(self):
+        return self._get("sequences", lambda: BIP341_sha_sequences(self.tx))
+
+    def sha_issuances(self):
+        return self._get("issuances", lambda: sha256(b"".join(i.assetIssuance.taphash_asset_issuance_serialize() for i in self.tx.vin)))
+
+    def sha_issuance_rangeproofs(self):
+        return self._get("issuance_rangeproofs", lambda: sha256(b"".join(iwit.serialize_issuance_proofs() for iwit in self.tx.wit.vtxinwit)))
+
+    def sha_outputs(self):
+        return self._get("outputs", lambda: BIP341_sha_outputs(self.tx))
+
+    def sha_output_witnesses(self):
+        return self._get("output_witnesses", lambda: sha256(b"".join(owit.serialize() for owit in self.tx.wit.vtxoutwit)))
+
+    # BIP143 (double SHA256) hashes, as integers
+    def hash_prevouts(self):
+        return self._get("hash_prevouts", lambda: uint256_from_str(sha256(self.sha_prevouts())))
+
+    def hash_sequence(self):
+        return self._get("hash_sequence", lambda: uint256_from_str(sha256(self.sha_sequences())))
+
+    def hash_issuance(self):
+        return self._get("hash_issuance", lambda: uint256_from_str(hash256(b"".join(
+            b'\x00' if i.assetIssuance.isNull() else i.assetIssuance.serialize() for i in self.tx.vin))))
+
+    def hash_outputs(self):
+        return self._get("hash_outputs", lambda: uint256_from_str(sha256(self.sha_outputs())))
+
+    def hash_rangeproofs(self):
+        return self._get("hash_rangeproofs", lambda: uint256_from_str(hash256(b"".join(
+            ser_string(wit.vchRangeproof) + ser_string(wit.vchSurjectionproof) for wit in self.tx.wit.vtxoutwit))))
+
+def TaprootSignatureMsg(txTo, spent_utxos, hash_type, genesis_hash, input_index = 0, scriptpath = False, script = CScript(), codeseparator_pos = -1, annex = None, leaf_ver = LEAF_VERSION_TAPSCRIPT, sighash_cache = None):
     assert (len(txTo.vin) == len(spent_utxos))
     assert (input_index < len(txTo.vin))
+    if sighash_cache is None:
+        sighash_cache = SighashCache(txTo, spent_utxos)
+    assert sighash_cache.tx is txTo
+    assert all(cached is utxo for cached, utxo in zip(sighash_cache.spent_utxos, spent_utxos))
     out_type = SIGHASH_ALL if hash_type == 0 else hash_type & 3
     in_type = hash_type & SIGHASH_ANYONECANPAY
     spk = spent_utxos[input_index].scriptPubKey
@@ -941,16 +1038,16 @@ def TaprootSignatureMsg(txTo, spent_utxos, hash_type, genesis_hash, input_index
     ss += struct.pack("<i", txTo.nVersion)
     ss += struct.pack("<I", txTo.nLockTime)
     if in_type != SIGHASH_ANYONECANPAY:
-        ss += sha256(b"".join(struct.pack("B", ((not i.assetIssuance.isNull()) << 7) + (i.m_is_pegin << 6)) for i in txTo.vin))
-        ss += BIP341_sha_prevouts(txTo)
-        ss += BIP341_sha_amounts(spent_utxos)
-        ss += BIP341_sha_scriptpubkeys(spent_utxos)
-        ss += BIP341_sha_sequences(txTo)
-        ss += sha256(b"".join(i.assetIssuance.taphash_asset_issuance_serialize() for i in txTo.vin))
-        ss += sha256(b"".join(iwit.serialize_issuance_proofs() for iwit in txTo.wit.vtxinwit))
+        ss += sighash_cache.sha_outpoint_flags()
+        ss += sighash_cache.sha_prevouts()
+        ss += sighash_cache.sha_amounts()
+        ss += sighash_cache.sha_scriptpubkeys()
+        ss += sighash_cache.sha_sequences()
+        ss += sighash_cache.sha_issuances()
+        ss += sighash_cache.sha_issuance_rangeproofs()
     if out_type == SIGHASH_ALL:
-        ss += BIP341_sha_outputs(txTo)
-        ss += sha256(b"".join(owit.serialize() for owit in txTo.wit.vtxoutwit))
+        ss += sighash_cache.sha_outputs()
+        ss += sighash_cache.sha_output_witnesses()
     spend_type = 0
     if annex is not None:
         spend_type |= 1
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# Copyright (c) 2022 The Elements Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Sign the inputs of a transaction in parallel worker processes.
+
+The pure Python EC operations hold the GIL, so threads would not help. The
+workers are forked from the test process and inherit the signing function,
+which may thus be a closure; only the transaction, the spent outputs and the
+per-input arguments are sent to them. Each input is signed with the random
+module seeded from a value drawn from the caller's random state, so the
+results do not depend on the number of workers."""
+
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import random
+import unittest
+
+from .key import ECKey, compute_xonly_pubkey, sign_schnorr, verify_schnorr
+from .messages import COutPoint, CTransaction, CTxIn, CTxOut
+from .script import CScript, OP_1, SIGHASH_DEFAULT, SighashCache, TaprootSignatureHash
+
+# The signing function of the SigningPool a worker process belongs to
+_worker_sign_input = None
+
+
+def _init_worker(sign_input):
+    global _worker_sign_input
+    _worker_sign_input = sign_input
+
+
+def _sign_inputs(sign_input, tx, spent_utxos, jobs):
+    sighash_cache = SighashCache(tx, spent_utxos)
+    state = random.getstate()
+    try:
+        results = []
+        for seed, idx, args in jobs:
+            random.seed(seed)
+            results.append(sign_input(tx, spent_utxos, idx, sighash_cache, *args))
+        return results
+    finally:
+        random.setstate(state)
+
+
+def _sign_inputs_in_worker(tx, spent_utxos, jobs):
+    return _sign_inputs(_worker_sign_input, tx, spent_utxos, jobs)
+
+
+class SigningPool:
+    """A pool of processes calling sign_input(tx, spent_utxos, idx,
+    sighash_cache, *args) for inputs of a transaction.
+
+    Without fork support (e.g. on Windows) or with num_workers <= 1 (the
+    default, as tests run in parallel with others), the inputs are signed in
+    the calling process, with the same results."""
+
+    def __init__(self, sign_input, num_workers=1):
+        self.sign_input = sign_input
+        self.num_workers = num_workers
+        self.executor = None
+        if self.num_workers > 1 and "fork" in multiprocessing.get_all_start_methods():
+            self.executor = ProcessPoolExecutor(
+                self.num_workers,
+                mp_context=multiprocessing.get_context("fork"),
+                initializer=_init_worker,
+                initargs=(sign_input,),
+            )
+
+    def sign(self, tx, spent_utxos, inputs):
+        """Return the results of sign_input for inputs, a list of (idx, args)
+        tuples, in the same order."""
+        jobs = [(random.getrandbits(64), idx, tuple(args)) for idx, args in inputs]
+        if self.executor is None or len(jobs) < 2:
+            return _sign_inputs(self.sign_input, tx, spent_utxos, jobs)
+        num_chunks = min(self.num_workers, len(jobs))
+        futures = [self.executor.submit(_sign_inputs_in_worker, tx, spent_utxos, jobs[i::num_chunks])
+                   for i in range(num_chunks)]
+        results = [None] * len(jobs)
+        for i, future in enumerate(futures):
+            results[i::num_chunks] = future.result()
+        return results
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class TestFrameworkSigning(unittest.TestCase):
+    def test_signing_pool(self):
+        keys = [ECKey() for _ in range(6)]
+        for key in keys:
+            key.generate()
+        tx = CTransaction()
+        tx.vin = [CTxIn(COutPoint(i, 0)) for i in range(len(keys))]
+        tx.vout = [CTxOut(1000, CScript([OP_1, bytes(32)]))]
+        spent_utxos = [CTxOut(2000, CScript([OP_1, compute_xonly_pubkey(key.get_bytes())[0]])) for key in keys]
+
+        def sign_input(tx, spent_utxos, idx, sighash_cache, genesis_hash):
+            sighash = TaprootSignatureHash(tx, spent_utxos, SIGHASH_DEFAULT, genesis_hash, idx, sighash_cache=sighash_cache)
+            aux = random.getrandbits(256).to_bytes(32, 'big')
+            return sighash, sign_schnorr(keys[idx].get_bytes(), sighash, aux=aux)
+
+        inputs = [(idx, (0,)) for idx in range(len(keys))]
+        signatures = []
+        for num_workers in (1, 3):
+            random.seed(42)
+            with SigningPool(sign_input, num_workers) as pool:
+                signatures.append(pool.sign(tx, spent_utxos, inputs))
+        self.assertEqual(signatures[0], signatures[1])
+        for (sighash, sig), utxo in zip(signatures[0], spent_utxos):
+            self.assertTrue(verify_schnorr(utxo.scriptPubKey[2:], sig, sighash))
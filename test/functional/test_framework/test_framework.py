@@ -4,6 +4,7 @@
 # file COPYING or http://www.opensource.org/licenses/mit-license.php.
 """Base class for RPC testing."""
 
+import asyncio
 import configparser
 from enum import Enum
 import argparse
@@ -29,8 +30,10 @@ from .util import (
     PortSeed,
     assert_equal,
     check_json_precision,
+    clone_datadir,
     get_datadir_path,
     initialize_datadir,
+    mempools_diff,
     p2p_port,
     wait_until_helper,
 )
@@ -116,6 +119,11 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
         # Disable ThreadOpenConnections by default, so that adding entries to
         # addrman will not result in automatic connections to them.
         self.disable_autoconnect = True
+        # Number of asyncio event loops (each in a thread of its own) to spread
+        # P2P connections over. Only tests that guard the state of their
+        # P2PInterfaces with their lock attribute, and never with p2p_lock,
+        # may set this above 1 in set_test_params().
+        self.network_loops = 1
         self.set_test_params()
         assert self.wallet_names is None or len(self.wallet_names) <= self.num_nodes
         if self.options.timeout_factor == 0 :
@@ -276,7 +284,7 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
         self.log.debug("PRNG seed is: {}".format(seed))
 
         self.log.debug('Setting up network thread')
-        self.network_thread = NetworkThread()
+        self.network_thread = NetworkThread(num_loops=self.network_loops)
         self.network_thread.start()
 
         if self.options.usecli:
@@ -659,36 +667,128 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
         sync_fun() if sync_fun else self.sync_all()
         return blocks
 
-    def sync_blocks(self, nodes=None, wait=1, timeout=60, expect_disconnected=False):
+    def sync_blocks(self, nodes=None, wait=1, timeout=60, expect_disconnected=False, concurrent=False):
         """
         Wait until everybody has the same tip.
         sync_blocks needs to be called with an rpc_connections set that has least
         one node already synced to the latest, stable tip, otherwise there's a
         chance it might return before all nodes are stably synced.
+        Instead of sleeping between queries, waits (for at most `wait` seconds)
+        until the tip of the lowest node changes. With concurrent=True, the
+        nodes are queried concurrently by sync_blocks_async(), unless some of
+        them use the CLI.
         """
         rpc_connections = nodes or self.nodes
+        if concurrent and all(isinstance(x, TestNode) and not x.use_cli for x in rpc_connections):
+            return NetworkThread.run_coroutine(self.sync_blocks_async(rpc_connections, wait, timeout, expect_disconnected))
         timeout = int(timeout * self.options.timeout_factor)
         stop_time = time.time() + timeout
+        longpoll = True
         while time.time() <= stop_time:
             best_hash = [x.getbestblockhash() for x in rpc_connections]
             if best_hash.count(best_hash[0]) == len(rpc_connections):
                 return
             if not expect_disconnected:
                 assert (all([len(x.getpeerinfo()) for x in rpc_connections]))
+            if longpoll:
+                longpoll = self.wait_for_new_block(rpc_connections, wait)
+            else:
+                time.sleep(wait)
+        raise AssertionError("Block sync timed out after {}s:{}".format(
+            timeout,
+            "".join("\n  {!r}".format(b) for b in best_hash),
+        ))
+
+    @staticmethod
+    def wait_for_new_block(rpc_connections, wait):
+        """
+        Wait until the tip of the node with the lowest block count (may have)
+        changed, or for `wait` seconds, using the waitfornewblock RPC as a
+        longpoll. Returns False (after sleeping) if the node doesn't have it.
+        """
+        heights = [x.getblockcount() for x in rpc_connections]
+        node = rpc_connections[heights.index(min(heights))]
+        try:
+            # A timeout of 0 would make the node wait for a block indefinitely
+            node.waitfornewblock(max(1, int(wait * 1000)))
+        except JSONRPCException as e:
+            if e.error.get('code') != -32601:
+                raise
+            # Method not found (e.g. a previous release): poll instead
             time.sleep(wait)
+            return False
+        return True
+
+    async def sync_blocks_async(self, nodes=None, wait=1, timeout=60, expect_disconnected=False):
+        """
+        Coroutine version of sync_blocks, to be run on the NetworkThread's event
+        loop, e.g. by sync_blocks(concurrent=True) from the test thread.
+        Queries all nodes (TestNodes using RPC, not the CLI) concurrently, and
+        instead of sleeping between queries, waits (for at most `wait` seconds)
+        until the tip of any node changes. The calls bypass the RPC coverage
+        logging.
+        """
+        rpcs = [x.get_async_rpc() for x in nodes or self.nodes]
+        timeout = int(timeout * self.options.timeout_factor)
+        stop_time = time.time() + timeout
+        longpolls = {}
+        try:
+            while time.time() <= stop_time:
+                best_hash = await asyncio.gather(*(rpc.getbestblockhash() for rpc in rpcs))
+                if best_hash.count(best_hash[0]) == len(rpcs):
+                    return
+                if not expect_disconnected:
+                    peer_info = await asyncio.gather(*(rpc.getpeerinfo() for rpc in rpcs))
+                    assert (all([len(x) for x in peer_info]))
+                await self.wait_for_new_block_async(rpcs, longpolls, wait)
+        finally:
+            for task in longpolls.values():
+                if task is not None:
+                    task.cancel()
         raise AssertionError("Block sync timed out after {}s:{}".format(
             timeout,
             "".join("\n  {!r}".format(b) for b in best_hash),
         ))
 
+    @staticmethod
+    async def wait_for_new_block_async(rpcs, longpolls, wait):
+        """
+        Wait until the tip of one of the nodes (may have) changed, or for `wait`
+        seconds. Uses the waitfornewblock RPC as a longpoll, and falls back to
+        sleeping for nodes that don't have it.
+
+        longpolls keeps the outstanding waitfornewblock calls by node index
+        between calls, so that there is never more than one per node (each one
+        occupies an RPC thread of the node until it returns).
+        """
+        for i, rpc in enumerate(rpcs):
+            if i not in longpolls:
+                # A timeout of 0 would make the node wait for a block indefinitely
+                longpolls[i] = asyncio.ensure_future(rpc.waitfornewblock(max(1, int(wait * 1000))))
+        tasks = [task for task in longpolls.values() if task is not None]
+        if not tasks:
+            await asyncio.sleep(wait)
+            return
+        done, _ = await asyncio.wait(tasks, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+        for i, task in list(longpolls.items()):
+            if task in done:
+                del longpolls[i]
+                error = task.exception()
+                if isinstance(error, JSONRPCException) and error.error.get('code') == -32601:
+                    # Method not found (e.g. a previous release): poll instead
+                    longpolls[i] = None
+                elif error is not None:
+                    raise error
+
     def sync_mempools(self, nodes=None, wait=1, timeout=60, flush_scheduler=True):
         """
         Wait until everybody has the same transactions in their memory
-        pools
+        pools, polling at a short interval that backs off to `wait` seconds.
         """
         rpc_connections = nodes or self.nodes
         timeout = int(timeout * self.options.timeout_factor)
         stop_time = time.time() + timeout
+        interval = min(0.05, wait)
         while time.time() <= stop_time:
             pool = [set(r.getrawmempool()) for r in rpc_connections]
             if pool.count(pool[0]) == len(rpc_connections):
@@ -698,10 +798,11 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
                 return
             # Check that each peer has at least one connection
             assert (all([len(x.getpeerinfo()) for x in rpc_connections]))
-            time.sleep(wait)
+            time.sleep(interval)
+            interval = min(interval * 2, wait)
         raise AssertionError("Mempool sync timed out after {}s:{}".format(
             timeout,
-            "".join("\n  {!r}".format(m) for m in pool),
+            mempools_diff(pool),
         ))
 
     def sync_all(self, nodes=None, expect_disconnected=False):
@@ -812,7 +913,10 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
         for i in range(self.num_nodes):
             self.log.debug("Copy cache directory {} to node {}".format(cache_node_dir, i))
             to_dir = get_datadir_path(self.options.tmpdir, i)
-            shutil.copytree(cache_node_dir, to_dir)
+            start_time = time.time()
+            methods = clone_datadir(cache_node_dir, to_dir)
+            self.log.debug("Cloned cache to node {} in {:.3f} s ({})".format(
+                i, time.time() - start_time, ", ".join("{} {}".format(n, m) for m, n in sorted(methods.items()))))
             initialize_datadir(self.options.tmpdir, i, self.chain, self.disable_autoconnect)  # Overwrite port/rpcport in bitcoin.conf
 
     def _initialize_chain_clean(self):
@@ -22,7 +22,12 @@ import shlex
 import sys
 from pathlib import Path
 
-from .authproxy import JSONRPCException
+from .authproxy import (
+    AsyncAuthServiceProxy,
+    ConnectionPool,
+    JSONRPCException,
+    RPCBatch,
+)
 from .descriptors import descsum_create
 from .p2p import P2P_SUBVERSION
 from .util import (
@@ -128,7 +133,10 @@ class TestNode():
         self.process = None
         self.rpc_connected = False
         self.rpc = None
+        # Kept-alive connections of all RPC proxies to the running node
+        self.rpc_pool = None
         self.url = None
+        self.async_rpc = None
         self.log = logging.getLogger('TestFramework.node%d' % i)
         self.cleanup_on_exit = True # Whether to kill the node when this object goes away
         # Cache perf subprocesses here by their data output filename.
@@ -239,11 +247,15 @@ class TestNode():
                 raise FailedToStartError(self._node_msg(
                     'bitcoind exited with status {} during initialization'.format(self.process.returncode)))
             try:
+                url = rpc_url(self.datadir, self.index, self.chain, self.rpchost)
+                if self.rpc_pool is None:
+                    # Shorter timeout to allow for one retry in case of ETIMEDOUT
+                    self.rpc_pool = ConnectionPool.from_url(urllib.parse.urlparse(url), self.rpc_timeout // 2)
                 rpc = get_rpc_proxy(
-                    rpc_url(self.datadir, self.index, self.chain, self.rpchost),
+                    url,
                     self.index,
-                    timeout=self.rpc_timeout // 2,  # Shorter timeout to allow for one retry in case of ETIMEDOUT
                     coveragedir=self.coverage_dir,
+                    pool=self.rpc_pool,
                 )
                 rpc.getblockcount()
                 # If the call to getblockcount() succeeds then the RPC connection is up
@@ -336,6 +348,14 @@ class TestNode():
             wallet_path = "wallet/{}".format(urllib.parse.quote(wallet_name))
             return RPCOverloadWrapper(self.rpc / wallet_path, descriptors=self.descriptors)
 
+    def get_async_rpc(self):
+        """Return an AsyncAuthServiceProxy for the node. Its coroutines must be
+        run on the NetworkThread's event loop."""
+        assert self.rpc_connected and self.url, self._node_msg("RPC not connected")
+        if self.async_rpc is None or self.async_rpc._service_url != self.url:
+            self.async_rpc = AsyncAuthServiceProxy(self.url, timeout=self.rpc_timeout)
+        return self.async_rpc
+
     def version_is_at_least(self, ver):
         return self.version is None or self.version >= ver
 
@@ -389,6 +409,9 @@ class TestNode():
         self.process = None
         self.rpc_connected = False
         self.rpc = None
+        if self.rpc_pool is not None:
+            self.rpc_pool.close()
+            self.rpc_pool = None
         self.log.debug("Node stopped")
         return True
 
@@ -713,7 +736,9 @@ class TestNodeCLI():
     def __getattr__(self, command):
         return TestNodeCLIAttr(self, command)
 
-    def batch(self, requests):
+    def batch(self, requests=None):
+        if requests is None:
+            return RPCBatch(self)
         results = []
         for request in requests:
             try:
@@ -5,20 +5,26 @@
 """Helpful routines for regression testing."""
 
 from base64 import b64encode
+from collections import Counter
 from decimal import Decimal, ROUND_DOWN
 from subprocess import CalledProcessError
+import errno
 import hashlib
 import inspect
 import json
 import logging
 import os
 import re
+import shutil
+import sys
+import tempfile
+import threading
 import time
 import unittest
 
 from . import coverage
-from .authproxy import AuthServiceProxy, JSONRPCException
-from typing import Callable, Optional
+from .authproxy import AuthServiceProxy, ConnectionPool, JSONRPCException
+from typing import Any, Callable, Dict, Optional
 
 logger = logging.getLogger("TestFramework.utils")
 
@@ -261,6 +267,10 @@ def wait_until_helper(predicate, *, attempts=float('inf'), timeout=float('inf'),
     from `BitcoinTestFramework` or `P2PInterface` class ensures the timeout is
     properly scaled. Furthermore, `wait_until()` from `P2PInterface` class in
     `p2p.py` has a preset lock.
+
+    If the lock is a threading.Condition, the predicate is re-evaluated as soon
+    as the condition is notified (e.g. when a P2PInterface receives a message),
+    and otherwise polled as usual.
     """
     if attempts == float('inf') and timeout == float('inf'):
         timeout = 60
@@ -269,6 +279,14 @@ def wait_until_helper(predicate, *, attempts=float('inf'), timeout=float('inf'),
     time_end = time.time() + timeout
 
     while attempt < attempts and time.time() < time_end:
+        if isinstance(lock, threading.Condition):
+            with lock:
+                if predicate():
+                    return
+                # Only count the polls, not the notifications, as attempts
+                if not lock.wait(0.05):
+                    attempt += 1
+            continue
         if lock:
             with lock:
                 if predicate():
@@ -289,6 +307,18 @@ def wait_until_helper(predicate, *, attempts=float('inf'), timeout=float('inf'),
     raise RuntimeError('Unreachable')
 
 
+def mempools_diff(pools, max_txids=10):
+    """Describe how each mempool (a set of txids) differs from their union"""
+    union = set().union(*pools)
+    lines = []
+    for i, pool in enumerate(pools):
+        missing = sorted(union - pool)
+        lines.append("\n  mempool {}: {} txs, missing {}{}{}".format(
+            i, len(pool), len(missing), ": " if missing else "",
+            ", ".join(missing[:max_txids]) + (", ..." if len(missing) > max_txids else "")))
+    return "".join(lines)
+
+
 def sha256sum_file(filename):
     h = hashlib.sha256()
     with open(filename, 'rb') as f:
@@ -314,7 +344,7 @@ class PortSeed:
     n = None
 
 
-def get_rpc_proxy(url: str, node_number: int, *, timeout: int=None, coveragedir: str=None) -> coverage.AuthServiceProxyWrapper:
+def get_rpc_proxy(url: str, node_number: int, *, timeout: int=None, coveragedir: str=None, pool: Optional[ConnectionPool]=None) -> coverage.AuthServiceProxyWrapper:
     """
     Args:
         url: URL of the RPC server to call
@@ -323,14 +353,17 @@ def get_rpc_proxy(url: str, node_number: int, *, timeout: int=None, coveragedir:
     Kwargs:
         timeout: HTTP timeout in seconds
         coveragedir: Directory
+        pool: ConnectionPool to share (its timeout overrides `timeout`)
 
     Returns:
         AuthServiceProxy. convenience object for making RPC calls.
 
     """
-    proxy_kwargs = {}
+    proxy_kwargs: Dict[str, Any] = {}
     if timeout is not None:
         proxy_kwargs['timeout'] = int(timeout)
+    if pool is not None:
+        proxy_kwargs['pool'] = pool
 
     proxy = AuthServiceProxy(url, **proxy_kwargs)
 
@@ -377,6 +410,60 @@ def initialize_datadir(dirname, n, chain, disable_autoconnect=True):
     return datadir
 
 
+# ioctl(2) request to share the extents of a file (Linux, linux/fs.h)
+FICLONE = 0x40049409
+# LevelDB never modifies a table file once written, so node copies may share it
+IMMUTABLE_DATADIR_FILES = re.compile(r"\.(ldb|sst)$")
+# Set once the filesystem rejected a reflink, to not retry it for every file
+_reflink_unsupported = False
+
+
+def _reflink(src, dst):
+    """Make dst a copy-on-write clone of src. Return False if unsupported."""
+    global _reflink_unsupported
+    if _reflink_unsupported or not sys.platform.startswith("linux"):
+        return False
+    import fcntl
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), getattr(fcntl, "FICLONE", FICLONE), fsrc.fileno())
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EXDEV, errno.ENOSYS):
+                raise
+            _reflink_unsupported = True
+    if _reflink_unsupported:
+        os.remove(dst)
+        return False
+    shutil.copystat(src, dst)
+    return True
+
+
+def clone_datadir(src, dst):
+    """Copy the datadir src to dst as cheaply as the filesystem allows: files
+    are reflinked where supported, immutable LevelDB tables are otherwise
+    hardlinked, and anything else is copied.
+
+    Return a Counter of the files cloned by each method."""
+    methods = Counter()
+
+    def clone_file(src_file, dst_file):
+        if _reflink(src_file, dst_file):
+            methods["reflink"] += 1
+            return dst_file
+        if IMMUTABLE_DATADIR_FILES.search(src_file):
+            try:
+                os.link(src_file, dst_file)
+                methods["hardlink"] += 1
+                return dst_file
+            except OSError:
+                pass
+        methods["copy"] += 1
+        return shutil.copy2(src_file, dst_file)
+
+    shutil.copytree(src, dst, copy_function=clone_file)
+    return methods
+
+
 def write_config(config_path, *, n, chain, extra_config="", disable_autoconnect=True):
     # Translate chain subdirectory name to config name
     if chain == 'testnet3':
@@ -656,3 +743,46 @@ class TestFrameworkUtil(unittest.TestCase):
 
         for a, n in test_vectors:
             self.assertEqual(modinv(a, n), pow(a, n-2, n))
+
+    def test_wait_until_helper_condition(self):
+        condition = threading.Condition()
+        state = []
+
+        def notify():
+            with condition:
+                state.append(True)
+                condition.notify_all()
+        threading.Timer(0.1, notify).start()
+        wait_until_helper(lambda: state, timeout=10, lock=condition)
+        with self.assertRaises(AssertionError):
+            wait_until_helper(lambda: False, attempts=3, lock=condition)
+
+    def test_clone_datadir(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            src = os.path.join(tmpdir, "src")
+            files = {
+                os.path.join("regtest", "blocks", "blk00000.dat"): b"blocks",
+                os.path.join("regtest", "chainstate", "000003.ldb"): b"table",
+                os.path.join("regtest", "chainstate", "CURRENT"): b"MANIFEST-000002\n",
+            }
+            for path, data in files.items():
+                os.makedirs(os.path.dirname(os.path.join(src, path)), exist_ok=True)
+                with open(os.path.join(src, path), 'wb') as f:
+                    f.write(data)
+            dst = os.path.join(tmpdir, "dst")
+            methods = clone_datadir(src, dst)
+            self.assertEqual(sum(methods.values()), len(files))
+            for path, data in files.items():
+                with open(os.path.join(dst, path), 'rb') as f:
+                    self.assertEqual(f.read(), data)
+            # Appending to the clone of a mutable file leaves the source alone
+            with open(os.path.join(dst, "regtest", "blocks", "blk00000.dat"), 'ab') as f:
+                f.write(b" and more")
+            with open(os.path.join(src, "regtest", "blocks", "blk00000.dat"), 'rb') as f:
+                self.assertEqual(f.read(), b"blocks")
+
+    def test_mempools_diff(self):
+        txids = ["%064x" % (i * 0x1234567) for i in range(1, 100)]
+        diff = mempools_diff([set(txids), set(txids[2:])])
+        self.assertIn("mempool 0: 99 txs, missing 0", diff)
+        self.assertIn("mempool 1: 97 txs, missing 2: {}, {}".format(*sorted(txids[:2])), diff)
@@ -125,8 +125,10 @@ class MiniWallet:
     def generate(self, num_blocks, **kwargs):
         """Generate blocks with coinbase outputs to the internal address, and append the outputs to the internal list"""
         blocks = self._test_node.generatetodescriptor(num_blocks, self.get_descriptor(), **kwargs)
-        for b in blocks:
-            block_info = self._test_node.getblock(blockhash=b, verbosity=2)
+        with self._test_node.batch() as batch:
+            futures = [batch.getblock(blockhash=b, verbosity=2) for b in blocks]
+        for future in futures:
+            block_info = future.result()
             cb_tx = block_info['tx'][0]
             self._utxos.append({'txid': cb_tx['txid'], 'vout': 0, 'value': cb_tx['vout'][0]['value'], 'height': block_info['height']})
         return blocks
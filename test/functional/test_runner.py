@@ -16,7 +16,10 @@ import argparse
 from collections import deque
 import configparser
 import datetime
+import heapq
+import json
 import os
+import queue
 import time
 import shutil
 import signal
@@ -25,6 +28,7 @@ import sys
 import tempfile
 import re
 import logging
+import threading
 import unittest
 
 # Formatting. Default colors to empty strings.
@@ -67,13 +71,22 @@ if os.name != 'nt' or sys.getwindowsversion() >= (10, 0, 14393): # type: ignore[
 TEST_EXIT_PASSED = 0
 TEST_EXIT_SKIPPED = 77
 
+# Durations of the tests in previous runs, kept next to the cache directory
+TIMINGS_FILENAME = "functional_test_timings.json"
+
 TEST_FRAMEWORK_MODULES = [
     "address",
+    "authproxy",
     "blocktools",
     "muhash",
     "key",
+    "messages",
+    "p2p",
+    "ripemd160",
     "script",
     "segwit_addr",
+    "signing",
+    "siphash",
     "util",
 ]
 
@@ -378,7 +391,9 @@ BASE_SCRIPTS = [
     # Put them in a random line within the section that fits their approximate run-time
 ]
 
-# Place EXTENDED_SCRIPTS first since it has the 3 longest running tests
+# Place EXTENDED_SCRIPTS first since it has the 3 longest running tests. Once
+# durations have been recorded (see TIMINGS_FILENAME), tests are scheduled
+# longest first instead.
 ALL_SCRIPTS = EXTENDED_SCRIPTS + BASE_SCRIPTS
 
 NON_SCRIPTS = [
@@ -404,6 +419,7 @@ def main():
     parser.add_argument('--extended', action='store_true', help='run the extended test suite in addition to the basic tests')
     parser.add_argument('--help', '-h', '-?', action='store_true', help='print help text and exit')
     parser.add_argument('--jobs', '-j', type=int, default=4, help='how many test scripts to run in parallel. Default=4.')
+    parser.add_argument('--node-budget', type=int, help='maximum number of nodes started by the test scripts running in parallel, in addition to --jobs. A test script needing more nodes runs on its own.')
     parser.add_argument('--keepcache', '-k', action='store_true', help='the default behavior is to flush the cache directory on startup. --keepcache retains the cache from the previous testrun.')
     parser.add_argument('--quiet', '-q', action='store_true', help='only print dots, results summary and failure logs')
     parser.add_argument('--tmpdirprefix', '-t', default=tempfile.gettempdir(), help="Root directory for datadirs")
@@ -514,14 +530,16 @@ def main():
         build_dir=config["environment"]["BUILDDIR"],
         tmpdir=tmpdir,
         jobs=args.jobs,
+        node_budget=args.node_budget,
         enable_coverage=args.coverage,
         args=passon_args,
         combined_logs_len=args.combinedlogslen,
         failfast=args.failfast,
         use_term_control=args.ansi,
+        timings_file="%s/test/%s" % (config["environment"]["BUILDDIR"], TIMINGS_FILENAME),
     )
 
-def run_tests(*, test_list, src_dir, build_dir, tmpdir, jobs=1, enable_coverage=False, args=None, combined_logs_len=0, failfast=False, use_term_control):
+def run_tests(*, test_list, src_dir, build_dir, tmpdir, jobs=1, node_budget=None, enable_coverage=False, args=None, combined_logs_len=0, failfast=False, use_term_control, timings_file=None):
     args = args or []
 
     # Warn if bitcoind is already running
@@ -567,9 +585,15 @@ def run_tests(*, test_list, src_dir, build_dir, tmpdir, jobs=1, enable_coverage=
             sys.stdout.buffer.write(e.output)
             raise
 
+    timings = load_timings(timings_file) if timings_file else {}
+    test_list, predicted_runtime = schedule_tests(test_list, timings, jobs)
+    if predicted_runtime is not None:
+        logging.debug("Predicted runtime from previous durations: %d s" % predicted_runtime)
+
     #Run Tests
     job_queue = TestHandler(
         num_tests_parallel=jobs,
+        node_budget=node_budget,
         tests_dir=tests_dir,
         tmpdir=tmpdir,
         test_list=test_list,
@@ -615,7 +639,13 @@ def run_tests(*, test_list, src_dir, build_dir, tmpdir, jobs=1, enable_coverage=
                     logging.debug("Early exiting after test failure")
                     break
 
-    print_results(test_results, max_len_name, (int(time.time() - start_time)))
+    print_results(test_results, max_len_name, (int(time.time() - start_time)), predicted_runtime, job_queue.idle_time)
+
+    if timings_file:
+        for test_result in test_results:
+            if test_result.status == "Passed":
+                timings[test_result.name] = test_result.duration
+        save_timings(timings_file, timings)
 
     if coverage:
         coverage_passed = coverage.report_rpc_coverage()
@@ -639,7 +669,46 @@ def run_tests(*, test_list, src_dir, build_dir, tmpdir, jobs=1, enable_coverage=
 
     sys.exit(not all_passed)
 
-def print_results(test_results, max_len_name, runtime):
+def load_timings(timings_file):
+    """Return the test durations recorded in timings_file, by test name"""
+    try:
+        with open(timings_file, encoding="utf8") as f:
+            timings = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return {name: float(duration) for name, duration in timings.items()}
+
+
+def save_timings(timings_file, timings):
+    try:
+        with open(timings_file + ".tmp", "w", encoding="utf8") as f:
+            json.dump(timings, f, indent=1, sort_keys=True)
+        os.replace(timings_file + ".tmp", timings_file)
+    except OSError as e:
+        logging.debug("Could not save test durations to %s: %s" % (timings_file, e))
+
+
+def schedule_tests(test_list, timings, jobs):
+    """Order the tests longest processing time first, which keeps the total
+    runtime close to the optimum when running them on `jobs` slots.
+
+    Returns the ordered list and the predicted runtime, or None (and the list
+    unchanged) if no durations are known. Tests without a recorded duration
+    are assumed to take the mean duration of the others."""
+    known = [timings[test] for test in test_list if test in timings]
+    if not known:
+        return test_list, None
+    default = sum(known) / len(known)
+    predicted = {test: timings.get(test, default) for test in test_list}
+    # sorted() is stable, so ties keep the order of the test lists
+    test_list = sorted(test_list, key=lambda test: -predicted[test])
+    slots = [0.0] * min(jobs, len(test_list))
+    for test in test_list:
+        heapq.heapreplace(slots, slots[0] + predicted[test])
+    return test_list, max(slots)
+
+
+def print_results(test_results, max_len_name, runtime, predicted_runtime=None, idle_time=None):
     results = "\n" + BOLD[1] + "%s | %s | %s\n\n" % ("TEST".ljust(max_len_name), "STATUS   ", "DURATION") + BOLD[0]
 
     test_results.sort(key=TestResult.sort_key)
@@ -659,6 +728,10 @@ def print_results(test_results, max_len_name, runtime):
     if not all_passed:
         results += RED[0]
     results += "Runtime: %s s\n" % (runtime)
+    if predicted_runtime is not None:
+        results += "Predicted runtime: %d s\n" % (predicted_runtime)
+    if idle_time is not None:
+        results += "Scheduler idle time: %.1f s\n" % (idle_time)
     print(results)
 
 class TestHandler:
@@ -666,9 +739,13 @@ class TestHandler:
     Trigger the test scripts passed in via the list.
     """
 
-    def __init__(self, *, num_tests_parallel, tests_dir, tmpdir, test_list, flags, use_term_control):
+    def __init__(self, *, num_tests_parallel, node_budget=None, tests_dir, tmpdir, test_list, flags, use_term_control):
         assert num_tests_parallel >= 1
+        assert node_budget is None or node_budget >= 1
         self.num_jobs = num_tests_parallel
+        self.node_budget = node_budget
+        self.num_nodes_running = 0
+        self.num_nodes_cache = {}
         self.tests_dir = tests_dir
         self.tmpdir = tmpdir
         self.test_list = test_list
@@ -676,12 +753,50 @@ class TestHandler:
         self.num_running = 0
         self.jobs = []
         self.use_term_control = use_term_control
+        # Jobs whose process has exited, put there by their waiter thread
+        self.finished = queue.Queue()
+        # Exit times of the jobs whose slot has not been refilled yet
+        self.free_slots = []
+        # Total time slots stayed free while tests were left to run
+        self.idle_time = 0.0
+
+    def num_nodes(self, test):
+        """Return the number of nodes the test script sets up, as declared
+        by its `self.num_nodes = N` assignments (the largest one if several)"""
+        script = test.split()[0]
+        if script not in self.num_nodes_cache:
+            try:
+                with open(self.tests_dir + script, encoding="utf8") as f:
+                    counts = [int(n) for n in re.findall(r"self\.num_nodes\s*=\s*(\d+)", f.read())]
+            except OSError:
+                counts = []
+            self.num_nodes_cache[script] = max(counts, default=1)
+        return self.num_nodes_cache[script]
+
+    def _pop_next_test(self):
+        """Return the first queued test that fits in the node budget, if any"""
+        if self.node_budget is None:
+            return self.test_list.pop(0)
+        for i, test in enumerate(self.test_list):
+            # Always admit a test when nothing runs, even if it exceeds the budget
+            if not self.jobs or self.num_nodes_running + self.num_nodes(test) <= self.node_budget:
+                return self.test_list.pop(i)
+        return None
+
+    def _wait_for_exit(self, job):
+        job[2].wait()
+        self.finished.put((job, time.time()))
 
     def get_next(self):
         while self.num_running < self.num_jobs and self.test_list:
             # Add tests
+            test = self._pop_next_test()
+            if test is None:
+                break
+            if self.free_slots:
+                self.idle_time += time.time() - self.free_slots.pop()
             self.num_running += 1
-            test = self.test_list.pop(0)
+            self.num_nodes_running += self.num_nodes(test)
             portseed = len(self.test_list)
             portseed_arg = ["--portseed={}".format(portseed)]
             log_stdout = tempfile.SpooledTemporaryFile(max_size=2**16)
@@ -689,15 +804,17 @@ class TestHandler:
             test_argv = test.split()
             testdir = "{}/{}_{}".format(self.tmpdir, re.sub(".py$", "", test_argv[0]), portseed)
             tmpdir_arg = ["--tmpdir={}".format(testdir)]
-            self.jobs.append((test,
-                              time.time(),
-                              subprocess.Popen([sys.executable, self.tests_dir + test_argv[0]] + test_argv[1:] + self.flags + portseed_arg + tmpdir_arg,
-                                               universal_newlines=True,
-                                               stdout=log_stdout,
-                                               stderr=log_stderr),
-                              testdir,
-                              log_stdout,
-                              log_stderr))
+            job = (test,
+                   time.time(),
+                   subprocess.Popen([sys.executable, self.tests_dir + test_argv[0]] + test_argv[1:] + self.flags + portseed_arg + tmpdir_arg,
+                                    universal_newlines=True,
+                                    stdout=log_stdout,
+                                    stderr=log_stderr),
+                   testdir,
+                   log_stdout,
+                   log_stderr)
+            self.jobs.append(job)
+            threading.Thread(target=self._wait_for_exit, args=(job,), daemon=True).start()
         if not self.jobs:
             raise IndexError('pop from empty list')
 
@@ -707,40 +824,46 @@ class TestHandler:
 
         dot_count = 0
         while True:
-            # Return all procs that have finished, if any. Otherwise sleep until there is one.
-            time.sleep(.5)
+            # Return all procs that have finished, if any. Otherwise wait until there is one,
+            # printing a dot every half second.
+            try:
+                finished = [self.finished.get(timeout=.5)]
+            except queue.Empty:
+                if self.use_term_control:
+                    print('.', end='', flush=True)
+                dot_count += 1
+                continue
+            while not self.finished.empty():
+                finished.append(self.finished.get_nowait())
+            if self.use_term_control:
+                clearline = '\r' + (' ' * dot_count) + '\r'
+                print(clearline, end='', flush=True)
             ret = []
-            for job in self.jobs:
+            for job, end_time in finished:
                 (name, start_time, proc, testdir, log_out, log_err) = job
-                if proc.poll() is not None:
-                    log_out.seek(0), log_err.seek(0)
-                    [stdout, stderr] = [log_file.read().decode('utf-8') for log_file in (log_out, log_err)]
-                    log_out.close(), log_err.close()
-                    if proc.returncode == TEST_EXIT_PASSED and stderr == "":
-                        status = "Passed"
-                    elif proc.returncode == TEST_EXIT_SKIPPED:
-                        status = "Skipped"
-                    else:
-                        status = "Failed"
-                    self.num_running -= 1
-                    self.jobs.remove(job)
-                    if self.use_term_control:
-                        clearline = '\r' + (' ' * dot_count) + '\r'
-                        print(clearline, end='', flush=True)
-                    dot_count = 0
-                    ret.append((TestResult(name, status, int(time.time() - start_time)), testdir, stdout, stderr))
-            if ret:
-                return ret
-            if self.use_term_control:
-                print('.', end='', flush=True)
-            dot_count += 1
+                log_out.seek(0), log_err.seek(0)
+                [stdout, stderr] = [log_file.read().decode('utf-8') for log_file in (log_out, log_err)]
+                log_out.close(), log_err.close()
+                if proc.returncode == TEST_EXIT_PASSED and stderr == "":
+                    status = "Passed"
+                elif proc.returncode == TEST_EXIT_SKIPPED:
+                    status = "Skipped"
+                else:
+                    status = "Failed"
+                self.num_running -= 1
+                self.num_nodes_running -= self.num_nodes(name)
+                self.jobs.remove(job)
+                self.free_slots.append(end_time)
+                ret.append((TestResult(name, status, end_time - start_time), testdir, stdout, stderr))
+            return ret
 
 
 class TestResult():
-    def __init__(self, name, status, time):
+    def __init__(self, name, status, duration):
         self.name = name
         self.status = status
-        self.time = time
+        self.duration = duration
+        self.time = int(duration)
         self.padding = 0
 
     def sort_key(self):